@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import absolute_import
+import functools
+from contextlib import contextmanager
 from .__version__ import __version__
 from .agent import Agent
 
@@ -19,3 +21,35 @@ def init(**kwargs):
     __agent__.start()
 
     return __agent__
+
+
+@contextmanager
+def _untraced():
+    yield
+
+
+def tracing():
+    """Return a context manager which traces the code run inside it, on the
+    current thread.
+
+    With the `scoped` option, tracing is limited to these scopes, such as
+    request handlers or batch jobs; otherwise, all code is traced anyway.
+    """
+    if not __agent__:
+        return _untraced()
+
+    return __agent__.tracing()
+
+
+def traced(func):
+    """Decorate a function, so that every call to it is traced, as if it
+    were run inside `tracing()`.
+
+    For a coroutine function, this only covers creating the coroutine; use
+    `tracing()` inside of it instead.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with tracing():
+            return func(*args, **kwargs)
+    return wrapper
@@ -4,14 +4,24 @@
 """Primary agent which orchestrates everything that Beacon does."""
 from __future__ import absolute_import
 import atexit
+import errno
 import os
 import grpc
 import logging
+import threading
+import zlib
+from collections import Counter
+from contextlib import contextmanager
 from .__version__ import __version__
-from .buffer import Buffer
-from .tracer import Tracer
+from .aggregator import HostAggregator, LeaderLock, default_directory
+from .buffer import Buffer, FlushWorker, HistogramBuffer
+from .exceptions import ConfigurationError
+from .governor import Governor, SAMPLING, TRACING
+from .spool import Spool
+from .transport import CircuitBreaker, RetryPolicy, Transport
+from .tracer import ExceptionTracer, SamplingTracer, get_tracer
 from .utils import Timer, DSN
-from . import beacon_pb2_grpc as pb2_grpc
+from . import beacon_pb2, beacon_pb2_grpc as pb2_grpc
 from . import defaults
 
 
@@ -40,6 +50,10 @@ class Agent(object):
 
     FLUSH_INTERVAL = 10
 
+    EXCEPTION_FLUSH_INTERVAL = 30
+
+    GOVERNOR_INTERVAL = 5
+
     def __init__(self, dsn=None, **options):
 
         o = options
@@ -59,10 +73,13 @@ class Agent(object):
 
         # set other additional options
 
-        # list of paths that should be excluded from tracking,
-        # relative to the project root
+        # list of paths or glob patterns that should be excluded from
+        # tracking, relative to the project root
         self.exclude_paths = set(o.get('exclude_paths') or [])
 
+        # list of additional root directories that should be tracked
+        self.include_paths = list(o.get('include_paths') or [])
+
         # name of this agent; defaults to the hostname of this machine
         self.name = (o.get('name') or os.environ.get('BEACON_NAME') or
                      defaults.NAME)
@@ -73,17 +90,145 @@ class Agent(object):
         # denote the environment the application is running in
         self.environment = o.get('environment')
 
+        # with the `presence` option, only whether each function was called
+        # is tracked, and not how often; this is enough to find dead code,
+        # at almost no overhead
+        presence = bool(o.get('presence'))
+
+        # the events which could not be transmitted are kept for up to
+        # `max_pending_locations` locations per buffer; beyond that, the
+        # `drop_policy` decides which ones are dropped, `new` or `old`.
+        # With the `columnar` option, batches are encoded in columns, and the
+        # path of every file is sent only once per stream. Batches larger than
+        # `max_batch_size` bytes are split into chunks. A buffer is flushed
+        # early once it has events at `flush_high_water_mark` distinct
+        # locations since its last flush, but not within `min_flush_interval`
+        # seconds of it.
+        buffer_options = dict(max_pending=o.get('max_pending_locations'),
+                              drop_policy=o.get('drop_policy'),
+                              columnar=bool(o.get('columnar')),
+                              max_batch_size=o.get('max_batch_size'),
+                              high_water_mark=o.get('flush_high_water_mark'))
+        self.min_flush_interval = o.get('min_flush_interval')
+
         # create buffers to track functions and exceptions
         self.buffers = {
-            'function': Buffer(self, 'f'),
-            'exception': Buffer(self, 'e')
+            'function': Buffer(self, 'f', presence=presence,
+                               **buffer_options),
+            'exception': Buffer(self, 'e', **buffer_options)
         }
 
-        # create a container to hold timers
+        # generators and coroutines are counted once per invocation; with the
+        # `count_resumes` option, their resumes are counted separately
+        if o.get('count_resumes'):
+            self.buffers['resume'] = Buffer(self, 'r', **buffer_options)
+
+        # aggregate the events of all the processes of this application on
+        # the host, and transmit them from one elected process; the option is
+        # the directory shared by the processes, or True for a default one.
+        # Only the counts are aggregated: in presence mode, the locations
+        # seen, and the latency histograms, are sent by every process, and
+        # only the leader reports the changes of its tracing mode.
+        self.host_leader = None
+        if o.get('host_aggregation'):
+            self._set_host_aggregation(o['host_aggregation'])
+
+        # with the `latency_histograms` option, the durations of the calls of
+        # the functions are recorded too, in a histogram per function. The
+        # histograms of the processes are merged by the server, so they are
+        # not aggregated on the host.
+        if o.get('latency_histograms'):
+            if presence:
+                raise ConfigurationError(
+                    "Latency histograms are not supported in presence mode")
+            self.buffers['histogram'] = HistogramBuffer(
+                self, 'h', buckets=o.get('histogram_buckets'),
+                **buffer_options)
+
+        # write the batches which could not be transmitted to a spool file,
+        # so that they are not lost when the process exits; the spool is
+        # drained in the background when the agent starts, and whenever the
+        # server can be reached again
+        self.spool = None
+        self._spool_thread = None
+        if o.get('spool_path'):
+            self.spool = Spool(o['spool_path'],
+                               max_size=o.get('spool_max_size'),
+                               max_age=o.get('spool_max_age'),
+                               max_batch_size=o.get('max_batch_size'))
+            for buffer in self.buffers.values():
+                buffer.spool = self.spool
+
+        # compress the messages larger than `compression_threshold` bytes
+        # with the `compression` algorithm, `gzip` or `deflate`. Before
+        # grpcio 1.23, which added per-call compression, every message is
+        # compressed by the channel instead, with `channel_compression`.
+        self.channel_compression = None
+        if o.get('compression'):
+            self._set_compression(o['compression'],
+                                  o.get('compression_threshold'))
+
+        # create a container to hold timers, and the worker for early flushes
         self.timers = {}
-
-        # create a tracer for this agent
-        self.tracer = Tracer(buffer=self.buffers['function'], **options)
+        self.flush_worker = None
+
+        # the batches are sent from the thread of a transport, with a
+        # deadline of `transmit_timeout` seconds on every RPC, and at most
+        # `max_in_flight` RPCs in flight at once. An RPC is tried up to
+        # `retry_attempts` times, and the server is not called for a while
+        # after `breaker_failure_threshold` failed RPCs in a row. With the
+        # `streaming` option, batches of events are written to a long-lived
+        # stream instead.
+        self.transport = None
+        self.transport_options = dict(timeout=o.get('transmit_timeout'),
+                                      max_in_flight=o.get('max_in_flight'),
+                                      streaming=bool(o.get('streaming')))
+        self.retry_attempts = o.get('retry_attempts')
+        self.breaker_failure_threshold = o.get('breaker_failure_threshold')
+
+        # fraction of wall time that tracing may take, e.g. `0.02` for 2%;
+        # when set, the agent switches to sampling when it goes over budget
+        overhead_budget = o.get('overhead_budget')
+
+        # create a tracer for this agent; `sys.monitoring` is used where it
+        # is available, with `sys.setprofile` as the fallback
+        tracer_options = dict(options,
+                              project_root=self.project_root,
+                              include_paths=self.include_paths,
+                              exclude_paths=sorted(self.exclude_paths),
+                              measure_overhead=bool(overhead_budget),
+                              presence=False)
+        function_options = dict(
+            tracer_options, resume_buffer=self.buffers.get('resume'),
+            histogram_buffer=self.buffers.get('histogram'), presence=presence)
+        self.tracer = get_tracer(buffer=self.buffers['function'],
+                                 **function_options)
+        self.tracer_mode = (SAMPLING if isinstance(self.tracer, SamplingTracer)
+                            else TRACING)
+        self.tracers = {self.tracer_mode: self.tracer}
+        self.buffers['function'].tracer_mode = self.tracer_mode
+
+        # create the governor, which keeps the tracing overhead within the
+        # budget by switching between tracing and sampling
+        self.governor = None
+        if overhead_budget and o.get('scoped'):
+            raise ConfigurationError(
+                "The overhead budget is not supported with scoped tracing")
+        if overhead_budget and self.tracer_mode == TRACING:
+            self.tracers[SAMPLING] = SamplingTracer(
+                buffer=self.buffers['function'], **function_options)
+            self.governor = Governor(self, overhead_budget)
+
+        # create a tracer for exceptions raised in the project, unless
+        # disabled with the `track_exceptions` option. Before Python 3.12,
+        # only the exceptions which are not handled can be counted; the
+        # batches of exceptions report which ones they count.
+        self.exception_tracer = None
+        if o.get('track_exceptions', True):
+            self.exception_tracer = ExceptionTracer(
+                buffer=self.buffers['exception'], **tracer_options)
+            self.buffers['exception'].capture_mode = (
+                self.exception_tracer.capture_mode)
 
         # create a stub for this agent
         channel = self._get_grpc_channel()
@@ -96,29 +241,49 @@ class Agent(object):
         self.is_started = False
         self.is_stopped = False
 
+        # number of outstanding calls to `pause`; tracing is paused while
+        # this is not zero
+        self._pause_count = 0
+        self._pause_lock = threading.Lock()
+
     def start(self):
         """Start this agent."""
 
         if self.is_started:
             return
 
-        # start the tracer
+        # start the tracers
         self.tracer.start()
+        if self.exception_tracer:
+            self.exception_tracer.start()
+        with self._pause_lock:
+            if self.is_paused:
+                self._pause_tracers()
 
-        # schedule a flush every 5 seconds
-        self.timers['function_flush'] = Timer(self.FLUSH_INTERVAL,
-                                              self.buffers['function'].flush)
-        self.timers['function_flush'].start()
+        self._start_timers()
+
+        # transmit the batches left in the spool by earlier runs
+        if self.spool and self.spool.has_records():
+            self.drain_spool()
 
         # register exit handlers
         atexit.register(self.stop)
 
+        # keep the agent working in the children of prefork servers, like
+        # gunicorn and uwsgi; the handlers cannot be unregistered, so they
+        # check whether this agent is still running.
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(before=self._before_fork,
+                                after_in_parent=self._after_fork_in_parent,
+                                after_in_child=self._after_fork_in_child)
+
         # mark this agent as started
         self.is_started = True
 
         self.logger.info(
             "Beacon agent started. "
-            "DSN: {}, Project Root: {}".format(self.dsn, self.project_root)
+            "DSN: {}, Project Root: {}, Tracing mode: {}".format(
+                self.dsn, self.project_root, self.tracer_mode)
         )
 
     def stop(self):
@@ -127,16 +292,289 @@ class Agent(object):
         if self.is_stopped:
             return
 
-        # stop the tracer
-        self.tracer.stop()
+        # stop the tracers
+        for tracer in self.tracers.values():
+            tracer.stop()
+        if self.exception_tracer:
+            self.exception_tracer.stop()
 
         # clear all timers
         for _, timer in self.timers.items():
             timer.stop()
+        if self.flush_worker:
+            self.flush_worker.stop()
+        if self.transport:
+            self.transport.stop()
+
+        # let another process of the host take over the transmission
+        if self.host_leader:
+            self.host_leader.release()
 
         # mark this agent as stopped
         self.is_stopped = True
 
+    def _start_timers(self):
+        """Schedule the periodic flushes of the buffers, and the checks of the
+        governor, and start the transport and the worker for the early
+        flushes.
+        """
+        # send the flushed events from the thread of the transport
+        self.transport = Transport(
+            retry=RetryPolicy(attempts=self.retry_attempts),
+            breaker=CircuitBreaker(
+                failure_threshold=self.breaker_failure_threshold),
+            **self.transport_options)
+        self.transport.start()
+        for buffer in self.buffers.values():
+            buffer.transport = self.transport
+
+        # flush the buffers early from a background worker, when they have
+        # seen many new locations
+        self.flush_worker = FlushWorker(self.min_flush_interval)
+        for buffer in self.buffers.values():
+            self.flush_worker.watch(buffer)
+        self.flush_worker.start()
+
+        # schedule a flush of each buffer
+        self.timers['function_flush'] = Timer(self.FLUSH_INTERVAL,
+                                              self.buffers['function'].flush)
+        self.timers['function_flush'].start()
+
+        if 'resume' in self.buffers:
+            self.timers['resume_flush'] = Timer(self.FLUSH_INTERVAL,
+                                                self.buffers['resume'].flush)
+            self.timers['resume_flush'].start()
+
+        if 'histogram' in self.buffers:
+            self.timers['histogram_flush'] = Timer(
+                self.FLUSH_INTERVAL, self.buffers['histogram'].flush)
+            self.timers['histogram_flush'].start()
+
+        if self.exception_tracer:
+            self.timers['exception_flush'] = Timer(
+                self.EXCEPTION_FLUSH_INTERVAL,
+                self.buffers['exception'].flush)
+            self.timers['exception_flush'].start()
+
+        # periodically check the tracing overhead
+        if self.governor:
+            self.timers['governor'] = Timer(self.GOVERNOR_INTERVAL,
+                                            self.governor.check)
+            self.timers['governor'].start()
+
+    def drain_spool(self):
+        """Transmit the batches in the spool from a background thread, unless
+        that is running already.
+        """
+        with self._pause_lock:
+            if self._spool_thread and self._spool_thread.is_alive():
+                return
+            self._spool_thread = threading.Thread(target=self._drain_spool,
+                                                  name='beacon-spool')
+            self._spool_thread.daemon = True
+            self._spool_thread.start()
+
+    def _drain_spool(self):
+        try:
+            sent = self.spool.drain(self._transmit_spooled)
+        except Exception as e:
+            self.logger.error("Error draining the spool.")
+            self.logger.error(e)
+            return
+
+        self.logger.info(
+            "Spool drained. {} batches sent.".format(sent))
+
+    def get_stats(self):
+        """Return the statistics of the transmissions of this agent, as a
+        dict of the numbers of messages, events and uncompressed bytes
+        transmitted, of batches split into chunks and their chunks, and of
+        compressed messages, along with the compression ratio measured on a
+        sample of them, which is None if none was measured. Once the agent
+        has started, these include the depth of the queue of the transport,
+        and the latency of the recent RPCs.
+        """
+        stats = Counter()
+        for buffer in self.buffers.values():
+            stats.update(buffer.stats)
+
+        stats = dict(stats)
+        sampled_bytes = stats.pop('sampled_bytes')
+        sampled_compressed_bytes = stats.pop('sampled_compressed_bytes')
+        stats['compression_ratio'] = (
+            float(sampled_bytes) / sampled_compressed_bytes
+            if sampled_compressed_bytes else None)
+        if self.transport:
+            stats.update(self.transport.get_stats())
+        return stats
+
+    def _transmit_spooled(self, batch):
+        for buffer in self.buffers.values():
+            if buffer.event_type == batch.event_type:
+                return buffer.transmit_spooled(batch)
+        if self.transport:
+            return self.transport.call(self.stub.Transmit, batch)
+        return self.stub.Transmit(batch)
+
+    def _initialize_stream(self):
+        """Ask the server for a new stream to transmit the batches of this
+        agent on, and use it from now on.
+        """
+        request = beacon_pb2.AuthRequest(
+            beacon_api_key=self.dsn.api_key,
+            repository_id=int(self.dsn.repository_id),
+            beacon_client_version=__version__,
+            source_version=self.source_version or '',
+            hostname=self.name)
+        try:
+            response = self.stub.InitializeStream(
+                request, timeout=(self.transport_options['timeout'] or
+                                  defaults.TRANSMIT_TIMEOUT))
+        except Exception as e:
+            self.stream_id = None
+            self.logger.error("Error initializing a stream.")
+            self.logger.error(e)
+            return
+        self.stream_id = response.stream_id
+
+    def _is_running(self):
+        return self.is_started and not self.is_stopped
+
+    def _before_fork(self):
+        """Wait for running flushes to finish, and hold off new ones until the
+        process has forked.
+        """
+        if not self._is_running():
+            return
+
+        for buffer in self.buffers.values():
+            buffer.before_fork()
+
+    def _after_fork_in_parent(self):
+        """Resume flushing in the parent after a fork."""
+        if not self._is_running():
+            return
+
+        for buffer in self.buffers.values():
+            buffer.after_fork_in_parent()
+
+    def _after_fork_in_child(self):
+        """Set the agent up again in a forked child.
+
+        Only the forking thread survives a fork, so the timers of the parent
+        are gone; the child gets its own buffers, timers, and gRPC channel.
+        """
+        if not self._is_running():
+            return
+
+        # a thread of the parent may have held the lock on pausing; the
+        # count of pauses is kept, as the tracers are still paused
+        self._pause_lock = threading.Lock()
+        if self.host_leader:
+            self.host_leader.after_fork_in_child()
+        if self.spool:
+            self.spool.after_fork_in_child()
+            self._spool_thread = None
+        for buffer in self.buffers.values():
+            buffer.after_fork_in_child()
+
+        # the tracers of the parent keep working, except for their threads
+        for tracer in self.tracers.values():
+            tracer.after_fork_in_child()
+        if self.exception_tracer:
+            self.exception_tracer.after_fork_in_child()
+
+        # a gRPC channel can not be shared with the parent; and the child
+        # assigns its own location IDs, so it needs a stream of its own
+        channel = self._get_grpc_channel()
+        self.stub = pb2_grpc.BeaconStub(channel)
+        if getattr(self, 'stream_id', None):
+            self._initialize_stream()
+
+        self.timers = {}
+        self._start_timers()
+
+        self.logger.info(
+            "Beacon agent restarted in forked process {}.".format(os.getpid()))
+
+    @property
+    def is_paused(self):
+        return self._pause_count > 0
+
+    def pause(self):
+        """Pause tracing on all threads, e.g. during a latency-critical
+        section of the application.
+
+        Tracing resumes once `resume` has been called as often as `pause`,
+        so that pauses from several threads or nested sections do not end
+        each other.
+        """
+        with self._pause_lock:
+            self._pause_count += 1
+            if self._pause_count == 1:
+                self._pause_tracers()
+
+    def resume(self):
+        """Resume tracing after it has been paused."""
+        with self._pause_lock:
+            if not self._pause_count:
+                return
+            self._pause_count -= 1
+            if not self._pause_count:
+                self._resume_tracers()
+
+    def _pause_tracers(self):
+        self.tracer.pause()
+        if self.exception_tracer:
+            self.exception_tracer.pause()
+
+    def _resume_tracers(self):
+        self.tracer.resume()
+        if self.exception_tracer:
+            self.exception_tracer.resume()
+
+    @contextmanager
+    def tracing(self):
+        """Trace the code run inside this context on the current thread.
+
+        This is how tracing is turned on when the agent runs with the `scoped`
+        option; otherwise, every thread is traced already, and this does
+        nothing.
+        """
+        tracer = self.tracer
+        token = tracer.enter_scope()
+        try:
+            yield
+        finally:
+            tracer.exit_scope(token)
+
+    def set_tracer_mode(self, mode):
+        """Switch the function tracer between `tracing` and `sampling`.
+
+        The tracer of the current mode is paused, and the one of the new mode
+        is started or resumed. The change is logged, and reported in the next
+        batch of function events.
+        """
+        if mode == self.tracer_mode:
+            return
+
+        tracer = self.tracers[mode]
+        with self._pause_lock:
+            if self.is_started and not self.is_stopped:
+                self.tracer.pause()
+                if tracer.stopped:
+                    tracer.start()
+                    if self.is_paused:
+                        tracer.pause()
+                elif not self.is_paused:
+                    tracer.resume()
+
+            self.tracer = tracer
+            self.tracer_mode = mode
+        self.buffers['function'].record_mode_change(mode)
+
+        self.logger.info("Tracing mode switched to {}.".format(mode))
+
     def _set_dsn(self, dsn):
         dsn = str(dsn).lower()
         self.dsn = DSN(dsn)
@@ -148,12 +586,60 @@ class Agent(object):
     def _set_source_version(self, source_version):
         self.source_version = source_version
 
+    def _set_host_aggregation(self, directory):
+        """Aggregate the counts of the buffers on the host, through segments
+        in `directory`. The presence buffer is not aggregated; its batches
+        are small, and sent by every process.
+        """
+        if directory is True:
+            directory = default_directory(self.dsn, self.project_root)
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        self.host_leader = LeaderLock(os.path.join(directory, 'leader.lock'))
+        for event_type, buffer in self.buffers.items():
+            if buffer.presence:
+                continue
+            buffer.aggregator = HostAggregator(
+                os.path.join(directory, '{}.segment'.format(event_type)),
+                self.host_leader)
+
+    def _set_compression(self, algorithm, threshold=None):
+        # the `zlib` window bits of the format of each algorithm
+        wbits = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+        if algorithm not in wbits:
+            raise ConfigurationError(
+                "Invalid compression algorithm: {}".format(algorithm))
+
+        # per-call compression was added in grpcio 1.23; older versions can
+        # only compress every message of a channel, with the option taking
+        # the value of the algorithm in gRPC core
+        compression = getattr(grpc, 'Compression', None)
+        if compression is None:
+            self.channel_compression = {'deflate': 1, 'gzip': 2}[algorithm]
+            return
+
+        for buffer in self.buffers.values():
+            buffer.compression = getattr(compression, algorithm.title())
+            buffer.compression_wbits = wbits[algorithm]
+            if threshold is not None:
+                buffer.compression_threshold = threshold
+
     def _get_grpc_channel(self):
         """Returns a secure/insecure gRPC Channel instance"""
+        options = []
+        if self.channel_compression is not None:
+            options.append(('grpc.default_compression_algorithm',
+                            self.channel_compression))
+
         if self.dsn.has_secure_scheme():
             ssl_credentials = grpc.ssl_channel_credentials()
-            channel = grpc.secure_channel(self.dsn.host, ssl_credentials)
+            channel = grpc.secure_channel(self.dsn.host, ssl_credentials,
+                                          options=options)
         else:
-            channel = grpc.insecure_channel(self.dsn.host)
+            channel = grpc.insecure_channel(self.dsn.host, options=options)
 
         return channel
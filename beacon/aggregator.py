@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Aggregation of events across the worker processes of a host, so that a
+single process, the leader, transmits them for the whole host."""
+import errno
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from . import defaults
+from .exceptions import ConfigurationError
+from .utils import intern
+
+# the shared segment starts with a header, which is followed by a hash table
+# of slots, and a heap of the encoded keys that the slots point into. The
+# header holds the magic, version, number of slots, heap size, number of used
+# slots, bytes used in the heap and flags.
+HEADER = struct.Struct('<4sIIIIII')
+HEADER_SIZE = 32
+MAGIC = b'BCNA'
+VERSION = 1
+
+# every slot holds the hash of a key, the count of its events, and the
+# offset and length of the key in the heap. An empty slot has no key.
+SLOT = struct.Struct('<QQII')
+
+# set in the flags when any of the counts in the segment were sampled
+FLAG_SAMPLED = 1
+
+# the segment is cleared once the leader has taken the counts out of it, and
+# more than this fraction of the slots or the heap is used
+MAX_LOAD = 0.75
+
+
+def default_directory(*keys):
+    """Return the directory shared by the processes of one application on
+    this host, identified by `keys`.
+    """
+    key = ':'.join(str(key) for key in keys).encode('utf-8')
+    return os.path.join(tempfile.gettempdir(),
+                        'beacon-{}'.format(hashlib.md5(key).hexdigest()[:12]))
+
+
+class LeaderLock(object):
+    def __init__(self, path):
+        """The LeaderLock elects one process of the host as the leader,
+           through an exclusive lock on a file.
+
+        The lock is released by the OS when the leader exits, and the next
+        process that tries to acquire it takes over.
+
+        :param path: path of the lock file.
+
+        :return: an instance of LeaderLock.
+        """
+        if fcntl is None:
+            raise ConfigurationError(
+                "Host aggregation is not supported on this platform.")
+
+        self.path = path
+
+        self.fd = None
+
+        self.is_leader = False
+
+    def acquire(self):
+        """Try to become the leader, without blocking. Return whether this
+        process is the leader.
+        """
+        if self.is_leader:
+            return True
+
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+
+        # note the leader in the lock file, for debugging
+        os.ftruncate(self.fd, 0)
+        os.write(self.fd, str(os.getpid()).encode('ascii'))
+        self.is_leader = True
+        return True
+
+    def release(self):
+        """Step down as the leader, if this process is the leader."""
+        if self.fd is None:
+            return
+
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+        self.is_leader = False
+
+    def after_fork_in_child(self):
+        """Forget the lock in a forked child. The child shares the lock of the
+        parent through the inherited file descriptor, so it is closed without
+        unlocking, and the child runs its own election.
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+        self.is_leader = False
+
+
+class HostAggregator(object):
+    def __init__(self, path, leader, **options):
+        """The HostAggregator sums the counts of events of all the processes
+           on a host, in a segment of memory shared through a file.
+
+        Each process adds its counts to the segment when its buffer is
+        flushed, keyed by filename and location. The leader then takes the
+        counts of the whole host out of the segment, and transmits them in a
+        single batch. Counts that do not fit into the segment are transmitted
+        by the process itself.
+
+        :param path: path of the file that backs the shared segment.
+
+        :param leader: the LeaderLock shared by the aggregators of this
+                       process.
+
+        :return: an instance of HostAggregator.
+        """
+        self.path = path
+
+        self.leader = leader
+
+        self.slots = options.get('slots') or defaults.AGGREGATION_SLOTS
+        self.heap_size = (options.get('heap_size') or
+                          defaults.AGGREGATION_HEAP_SIZE)
+
+        # the hash and encoded key of every location, keyed by the two-tuple
+        # of filename and location
+        self.keys = {}
+
+        self.fd = None
+        self.segment = None
+        self._open()
+
+    def exchange(self, counts, sampled=False):
+        """Add the counts of this process to the shared segment. If this
+        process is the leader, take the counts of the whole host out of it.
+
+        :param counts: dict of counts, keyed by filename and location.
+
+        :param sampled: whether the counts were sampled.
+
+        :return: a two-tuple of the counts this process should transmit,
+                 which is None if there are none, and whether they were
+                 sampled.
+        """
+        is_leader = self.leader.acquire()
+
+        with self._lock():
+            overflow = self._add(counts, sampled)
+            if not is_leader:
+                return (overflow or None), sampled
+
+            host_counts, host_sampled = self._drain()
+
+        for key, count in overflow.items():
+            host_counts[key] = host_counts.get(key, 0) + count
+        return host_counts, host_sampled or sampled
+
+    def close(self):
+        """Unmap the shared segment."""
+        if self.segment is not None:
+            self.segment.close()
+            os.close(self.fd)
+        self.segment = None
+        self.fd = None
+
+    def after_fork_in_child(self):
+        """Reopen the file of the segment in a forked child. The mapping is
+        shared with the parent as it should be, but a lock on the inherited
+        file would be shared as well, and would not keep the two apart.
+        """
+        fd = os.open(self.path, os.O_RDWR)
+        os.close(self.fd)
+        self.fd = fd
+
+    def _open(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._lock():
+            size = os.fstat(self.fd).st_size
+            header = None
+            if size >= HEADER_SIZE:
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                header = HEADER.unpack(os.read(self.fd, HEADER.size))
+
+            if (header is not None and header[0] == MAGIC and
+                    header[1] == VERSION):
+                # join the segment created by another process
+                self.slots, self.heap_size = header[2], header[3]
+                self.segment = mmap.mmap(self.fd, self._size())
+            else:
+                os.ftruncate(self.fd, self._size())
+                self.segment = mmap.mmap(self.fd, self._size())
+                self._write_header(0, 0, 0)
+
+    def _size(self):
+        return HEADER_SIZE + self.slots * SLOT.size + self.heap_size
+
+    @contextmanager
+    def _lock(self):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _read_state(self):
+        """Return the number of used slots, bytes used in the heap, and the
+        flags of the segment."""
+        return HEADER.unpack_from(self.segment, 0)[4:]
+
+    def _write_header(self, used, heap_used, flags):
+        HEADER.pack_into(self.segment, 0, MAGIC, VERSION, self.slots,
+                         self.heap_size, used, heap_used, flags)
+
+    def _encode(self, key):
+        """Return the hash and encoded bytes of a filename and location."""
+        try:
+            return self.keys[key]
+        except KeyError:
+            pass
+
+        filename, location = key
+        data = u'{}\0{}'.format(filename, location).encode('utf-8')
+        key_hash = struct.unpack('<Q', hashlib.md5(data).digest()[:8])[0]
+        self.keys[key] = (key_hash, data)
+        return key_hash, data
+
+    @staticmethod
+    def _decode(data):
+        filename, location = data.decode('utf-8').rsplit(u'\0', 1)
+        return intern(str(filename)), int(location)
+
+    def _add(self, counts, sampled):
+        """Add counts to the segment, and return the ones that did not fit."""
+        segment = self.segment
+        used, heap_used, flags = self._read_state()
+        heap_start = HEADER_SIZE + self.slots * SLOT.size
+
+        overflow = {}
+        for key, count in counts.items():
+            key_hash, data = self._encode(key)
+            index = key_hash % self.slots
+            for _ in range(self.slots):
+                offset = HEADER_SIZE + index * SLOT.size
+                (slot_hash, slot_count,
+                 key_offset, key_length) = SLOT.unpack_from(segment, offset)
+
+                if not key_length:
+                    # claim this empty slot for the key, if it fits the heap
+                    if heap_used + len(data) > self.heap_size:
+                        break
+                    key_offset = heap_start + heap_used
+                    segment[key_offset:key_offset + len(data)] = data
+                    heap_used += len(data)
+                    used += 1
+                    SLOT.pack_into(segment, offset, key_hash, count,
+                                   key_offset, len(data))
+                    count = 0
+                    break
+
+                if (slot_hash == key_hash and key_length == len(data) and
+                        segment[key_offset:key_offset + key_length] == data):
+                    SLOT.pack_into(segment, offset, key_hash,
+                                   slot_count + count, key_offset, key_length)
+                    count = 0
+                    break
+
+                index = (index + 1) % self.slots
+
+            if count:
+                overflow[key] = count
+
+        if sampled:
+            flags |= FLAG_SAMPLED
+        self._write_header(used, heap_used, flags)
+        return overflow
+
+    def _drain(self):
+        """Take all the counts out of the segment, and return them along with
+        whether any of them were sampled.
+        """
+        segment = self.segment
+        used, heap_used, flags = self._read_state()
+
+        counts = {}
+        for index in range(self.slots):
+            offset = HEADER_SIZE + index * SLOT.size
+            (slot_hash, slot_count,
+             key_offset, key_length) = SLOT.unpack_from(segment, offset)
+            if not slot_count:
+                continue
+
+            key = self._decode(segment[key_offset:key_offset + key_length])
+            counts[key] = counts.get(key, 0) + slot_count
+            SLOT.pack_into(segment, offset, slot_hash, 0,
+                           key_offset, key_length)
+
+        if (used > self.slots * MAX_LOAD or
+                heap_used > self.heap_size * MAX_LOAD):
+            # every count is zero now, so the keys can be dropped
+            end = HEADER_SIZE + self.slots * SLOT.size
+            segment[HEADER_SIZE:end] = b'\0' * (end - HEADER_SIZE)
+            used = heap_used = 0
+
+        self._write_header(used, heap_used, 0)
+        return counts, bool(flags & FLAG_SAMPLED)
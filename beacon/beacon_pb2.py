@@ -19,7 +19,7 @@ DESCRIPTOR = _descriptor.FileDescriptor(
   name='beacon.proto',
   package='beacon',
   syntax='proto3',
-  serialized_pb=_b('\n\x0c\x62\x65\x61\x63on.proto\x12\x06\x62\x65\x61\x63on\"\x07\n\x05\x45mpty\"\x85\x01\n\x0b\x41uthRequest\x12\x16\n\x0e\x62\x65\x61\x63on_api_key\x18\x01 \x01(\t\x12\x15\n\rrepository_id\x18\x02 \x01(\x03\x12\x1d\n\x15\x62\x65\x61\x63on_client_version\x18\x03 \x01(\t\x12\x16\n\x0esource_version\x18\x04 \x01(\t\x12\x10\n\x08hostname\x18\x05 \x01(\t\"!\n\x0c\x41uthResponse\x12\x11\n\tstream_id\x18\x01 \x01(\t\";\n\x05\x45vent\x12\x11\n\tfile_path\x18\x01 \x01(\t\x12\x10\n\x08location\x18\x02 \x01(\x03\x12\r\n\x05\x63ount\x18\x03 \x01(\x03\"\x8a\x01\n\x05\x42\x61tch\x12\x11\n\tstream_id\x18\x01 \x01(\t\x12&\n\nevent_type\x18\x02 \x01(\x0e\x32\x12.beacon.Batch.Type\x12\x1d\n\x06\x65vents\x18\x03 \x03(\x0b\x32\r.beacon.Event\x12\x11\n\ttimestamp\x18\x04 \x01(\x03\"\x14\n\x04Type\x12\x05\n\x01\x66\x10\x00\x12\x05\n\x01\x65\x10\x01\x32u\n\x06\x42\x65\x61\x63on\x12?\n\x10InitializeStream\x12\x13.beacon.AuthRequest\x1a\x14.beacon.AuthResponse\"\x00\x12*\n\x08Transmit\x12\r.beacon.Batch\x1a\r.beacon.Empty\"\x00\x62\x06proto3')
+  serialized_pb=_b('\n\x0c\x62\x65\x61\x63on.proto\x12\x06\x62\x65\x61\x63on\"\x07\n\x05\x45mpty\"\x85\x01\n\x0b\x41uthRequest\x12\x16\n\x0e\x62\x65\x61\x63on_api_key\x18\x01 \x01(\t\x12\x15\n\rrepository_id\x18\x02 \x01(\x03\x12\x1d\n\x15\x62\x65\x61\x63on_client_version\x18\x03 \x01(\t\x12\x16\n\x0esource_version\x18\x04 \x01(\t\x12\x10\n\x08hostname\x18\x05 \x01(\t\"!\n\x0c\x41uthResponse\x12\x11\n\tstream_id\x18\x01 \x01(\t\"L\n\x05\x45vent\x12\x11\n\tfile_path\x18\x01 \x01(\t\x12\x10\n\x08location\x18\x02 \x01(\x03\x12\r\n\x05\x63ount\x18\x03 \x01(\x03\x12\x0f\n\x07\x62uckets\x18\x04 \x03(\x03\"-\n\nModeChange\x12\x11\n\ttimestamp\x18\x01 \x01(\x03\x12\x0c\n\x04mode\x18\x02 \x01(\t\"\xf1\x02\n\x05\x42\x61tch\x12\x11\n\tstream_id\x18\x01 \x01(\t\x12&\n\nevent_type\x18\x02 \x01(\x0e\x32\x12.beacon.Batch.Type\x12\x1d\n\x06\x65vents\x18\x03 \x03(\x0b\x32\r.beacon.Event\x12\x11\n\ttimestamp\x18\x04 \x01(\x03\x12\x0f\n\x07sampled\x18\x05 \x01(\x08\x12\x13\n\x0btracer_mode\x18\x06 \x01(\t\x12(\n\x0cmode_changes\x18\x07 \x03(\x0b\x32\x12.beacon.ModeChange\x12\x10\n\x08presence\x18\x08 \x01(\x08\x12\x0c\n\x04seen\x18\t \x01(\x0c\x12\x17\n\x0flocation_offset\x18\n \x01(\x03\x12 \n\tlocations\x18\x0b \x03(\x0b\x32\r.beacon.Event\x12\x16\n\x0e\x64ropped_events\x18\x0c \x01(\x03\x12\x14\n\x0c\x63\x61pture_mode\x18\r \x01(\t\"\"\n\x04Type\x12\x05\n\x01\x66\x10\x00\x12\x05\n\x01\x65\x10\x01\x12\x05\n\x01r\x10\x02\x12\x05\n\x01h\x10\x03\"\xc5\x02\n\rColumnarBatch\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x11\n\tstream_id\x18\x02 \x01(\t\x12&\n\nevent_type\x18\x03 \x01(\x0e\x32\x12.beacon.Batch.Type\x12\x11\n\ttimestamp\x18\x04 \x01(\x03\x12\x0f\n\x07sampled\x18\x05 \x01(\x08\x12\x13\n\x0btracer_mode\x18\x06 \x01(\t\x12(\n\x0cmode_changes\x18\x07 \x03(\x0b\x32\x12.beacon.ModeChange\x12\x13\n\x0bpath_offset\x18\x08 \x01(\x03\x12\r\n\x05paths\x18\t \x03(\t\x12\x10\n\x08path_ids\x18\n \x03(\x03\x12\x11\n\tlocations\x18\x0b \x03(\x03\x12\x0e\n\x06\x63ounts\x18\x0c \x03(\x03\x12\x16\n\x0e\x64ropped_events\x18\r \x01(\x03\x12\x14\n\x0c\x63\x61pture_mode\x18\x0e \x01(\t2\xe5\x01\n\x06\x42\x65\x61\x63on\x12?\n\x10InitializeStream\x12\x13.beacon.AuthRequest\x1a\x14.beacon.AuthResponse\"\x00\x12*\n\x08Transmit\x12\r.beacon.Batch\x1a\r.beacon.Empty\"\x00\x12:\n\x10TransmitColumnar\x12\x15.beacon.ColumnarBatch\x1a\r.beacon.Empty\"\x00\x12\x32\n\x0eTransmitStream\x12\r.beacon.Batch\x1a\r.beacon.Empty\"\x00(\x01\x62\x06proto3')
 )
 
 
@@ -38,11 +38,19 @@ _BATCH_TYPE = _descriptor.EnumDescriptor(
       name='e', index=1, number=1,
       options=None,
       type=None),
+    _descriptor.EnumValueDescriptor(
+      name='r', index=2, number=2,
+      options=None,
+      type=None),
+    _descriptor.EnumValueDescriptor(
+      name='h', index=3, number=3,
+      options=None,
+      type=None),
   ],
   containing_type=None,
   options=None,
-  serialized_start=384,
-  serialized_end=404,
+  serialized_start=665,
+  serialized_end=699,
 )
 _sym_db.RegisterEnumDescriptor(_BATCH_TYPE)
 
@@ -189,6 +197,13 @@ _EVENT = _descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='buckets', full_name='beacon.Event.buckets', index=3,
+      number=4, type=3, cpp_type=2, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
   ],
   extensions=[
   ],
@@ -202,7 +217,45 @@ _EVENT = _descriptor.Descriptor(
   oneofs=[
   ],
   serialized_start=204,
-  serialized_end=263,
+  serialized_end=280,
+)
+
+
+_MODECHANGE = _descriptor.Descriptor(
+  name='ModeChange',
+  full_name='beacon.ModeChange',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='timestamp', full_name='beacon.ModeChange.timestamp', index=0,
+      number=1, type=3, cpp_type=2, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='mode', full_name='beacon.ModeChange.mode', index=1,
+      number=2, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b("").decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=282,
+  serialized_end=327,
 )
 
 
@@ -241,6 +294,69 @@ _BATCH = _descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='sampled', full_name='beacon.Batch.sampled', index=4,
+      number=5, type=8, cpp_type=7, label=1,
+      has_default_value=False, default_value=False,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='tracer_mode', full_name='beacon.Batch.tracer_mode', index=5,
+      number=6, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b("").decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='mode_changes', full_name='beacon.Batch.mode_changes', index=6,
+      number=7, type=11, cpp_type=10, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='presence', full_name='beacon.Batch.presence', index=7,
+      number=8, type=8, cpp_type=7, label=1,
+      has_default_value=False, default_value=False,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='seen', full_name='beacon.Batch.seen', index=8,
+      number=9, type=12, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b(""),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='location_offset', full_name='beacon.Batch.location_offset', index=9,
+      number=10, type=3, cpp_type=2, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='locations', full_name='beacon.Batch.locations', index=10,
+      number=11, type=11, cpp_type=10, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='dropped_events', full_name='beacon.Batch.dropped_events', index=11,
+      number=12, type=3, cpp_type=2, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='capture_mode', full_name='beacon.Batch.capture_mode', index=12,
+      number=13, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b("").decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
   ],
   extensions=[
   ],
@@ -254,18 +370,146 @@ _BATCH = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=266,
-  serialized_end=404,
+  serialized_start=330,
+  serialized_end=699,
+)
+
+
+_COLUMNARBATCH = _descriptor.Descriptor(
+  name='ColumnarBatch',
+  full_name='beacon.ColumnarBatch',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='version', full_name='beacon.ColumnarBatch.version', index=0,
+      number=1, type=5, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='stream_id', full_name='beacon.ColumnarBatch.stream_id', index=1,
+      number=2, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b("").decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='event_type', full_name='beacon.ColumnarBatch.event_type', index=2,
+      number=3, type=14, cpp_type=8, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='timestamp', full_name='beacon.ColumnarBatch.timestamp', index=3,
+      number=4, type=3, cpp_type=2, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='sampled', full_name='beacon.ColumnarBatch.sampled', index=4,
+      number=5, type=8, cpp_type=7, label=1,
+      has_default_value=False, default_value=False,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='tracer_mode', full_name='beacon.ColumnarBatch.tracer_mode', index=5,
+      number=6, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b("").decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='mode_changes', full_name='beacon.ColumnarBatch.mode_changes', index=6,
+      number=7, type=11, cpp_type=10, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='path_offset', full_name='beacon.ColumnarBatch.path_offset', index=7,
+      number=8, type=3, cpp_type=2, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='paths', full_name='beacon.ColumnarBatch.paths', index=8,
+      number=9, type=9, cpp_type=9, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='path_ids', full_name='beacon.ColumnarBatch.path_ids', index=9,
+      number=10, type=3, cpp_type=2, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='locations', full_name='beacon.ColumnarBatch.locations', index=10,
+      number=11, type=3, cpp_type=2, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='counts', full_name='beacon.ColumnarBatch.counts', index=11,
+      number=12, type=3, cpp_type=2, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='dropped_events', full_name='beacon.ColumnarBatch.dropped_events', index=12,
+      number=13, type=3, cpp_type=2, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='capture_mode', full_name='beacon.ColumnarBatch.capture_mode', index=13,
+      number=14, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b("").decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=702,
+  serialized_end=1027,
 )
 
 _BATCH.fields_by_name['event_type'].enum_type = _BATCH_TYPE
 _BATCH.fields_by_name['events'].message_type = _EVENT
+_BATCH.fields_by_name['mode_changes'].message_type = _MODECHANGE
+_BATCH.fields_by_name['locations'].message_type = _EVENT
 _BATCH_TYPE.containing_type = _BATCH
+_COLUMNARBATCH.fields_by_name['event_type'].enum_type = _BATCH_TYPE
+_COLUMNARBATCH.fields_by_name['mode_changes'].message_type = _MODECHANGE
 DESCRIPTOR.message_types_by_name['Empty'] = _EMPTY
 DESCRIPTOR.message_types_by_name['AuthRequest'] = _AUTHREQUEST
 DESCRIPTOR.message_types_by_name['AuthResponse'] = _AUTHRESPONSE
 DESCRIPTOR.message_types_by_name['Event'] = _EVENT
+DESCRIPTOR.message_types_by_name['ModeChange'] = _MODECHANGE
 DESCRIPTOR.message_types_by_name['Batch'] = _BATCH
+DESCRIPTOR.message_types_by_name['ColumnarBatch'] = _COLUMNARBATCH
 _sym_db.RegisterFileDescriptor(DESCRIPTOR)
 
 Empty = _reflection.GeneratedProtocolMessageType('Empty', (_message.Message,), dict(
@@ -296,6 +540,13 @@ Event = _reflection.GeneratedProtocolMessageType('Event', (_message.Message,), d
   ))
 _sym_db.RegisterMessage(Event)
 
+ModeChange = _reflection.GeneratedProtocolMessageType('ModeChange', (_message.Message,), dict(
+  DESCRIPTOR = _MODECHANGE,
+  __module__ = 'beacon_pb2'
+  # @@protoc_insertion_point(class_scope:beacon.ModeChange)
+  ))
+_sym_db.RegisterMessage(ModeChange)
+
 Batch = _reflection.GeneratedProtocolMessageType('Batch', (_message.Message,), dict(
   DESCRIPTOR = _BATCH,
   __module__ = 'beacon_pb2'
@@ -303,6 +554,13 @@ Batch = _reflection.GeneratedProtocolMessageType('Batch', (_message.Message,), d
   ))
 _sym_db.RegisterMessage(Batch)
 
+ColumnarBatch = _reflection.GeneratedProtocolMessageType('ColumnarBatch', (_message.Message,), dict(
+  DESCRIPTOR = _COLUMNARBATCH,
+  __module__ = 'beacon_pb2'
+  # @@protoc_insertion_point(class_scope:beacon.ColumnarBatch)
+  ))
+_sym_db.RegisterMessage(ColumnarBatch)
+
 
 
 _BEACON = _descriptor.ServiceDescriptor(
@@ -311,8 +569,8 @@ _BEACON = _descriptor.ServiceDescriptor(
   file=DESCRIPTOR,
   index=0,
   options=None,
-  serialized_start=406,
-  serialized_end=523,
+  serialized_start=1030,
+  serialized_end=1259,
   methods=[
   _descriptor.MethodDescriptor(
     name='InitializeStream',
@@ -332,6 +590,24 @@ _BEACON = _descriptor.ServiceDescriptor(
     output_type=_EMPTY,
     options=None,
   ),
+  _descriptor.MethodDescriptor(
+    name='TransmitColumnar',
+    full_name='beacon.Beacon.TransmitColumnar',
+    index=2,
+    containing_service=None,
+    input_type=_COLUMNARBATCH,
+    output_type=_EMPTY,
+    options=None,
+  ),
+  _descriptor.MethodDescriptor(
+    name='TransmitStream',
+    full_name='beacon.Beacon.TransmitStream',
+    index=3,
+    containing_service=None,
+    input_type=_BATCH,
+    output_type=_EMPTY,
+    options=None,
+  ),
 ])
 _sym_db.RegisterServiceDescriptor(_BEACON)
 
@@ -24,6 +24,16 @@ class BeaconStub(object):
         request_serializer=beacon__pb2.Batch.SerializeToString,
         response_deserializer=beacon__pb2.Empty.FromString,
         )
+    self.TransmitColumnar = channel.unary_unary(
+        '/beacon.Beacon/TransmitColumnar',
+        request_serializer=beacon__pb2.ColumnarBatch.SerializeToString,
+        response_deserializer=beacon__pb2.Empty.FromString,
+        )
+    self.TransmitStream = channel.stream_unary(
+        '/beacon.Beacon/TransmitStream',
+        request_serializer=beacon__pb2.Batch.SerializeToString,
+        response_deserializer=beacon__pb2.Empty.FromString,
+        )
 
 
 class BeaconServicer(object):
@@ -44,6 +54,20 @@ class BeaconServicer(object):
     context.set_details('Method not implemented!')
     raise NotImplementedError('Method not implemented!')
 
+  def TransmitColumnar(self, request, context):
+    """flush a columnar batch to the server
+    """
+    context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+    context.set_details('Method not implemented!')
+    raise NotImplementedError('Method not implemented!')
+
+  def TransmitStream(self, request_iterator, context):
+    """flush batches to the server over a long-lived stream
+    """
+    context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+    context.set_details('Method not implemented!')
+    raise NotImplementedError('Method not implemented!')
+
 
 def add_BeaconServicer_to_server(servicer, server):
   rpc_method_handlers = {
@@ -57,6 +81,16 @@ def add_BeaconServicer_to_server(servicer, server):
           request_deserializer=beacon__pb2.Batch.FromString,
           response_serializer=beacon__pb2.Empty.SerializeToString,
       ),
+      'TransmitColumnar': grpc.unary_unary_rpc_method_handler(
+          servicer.TransmitColumnar,
+          request_deserializer=beacon__pb2.ColumnarBatch.FromString,
+          response_serializer=beacon__pb2.Empty.SerializeToString,
+      ),
+      'TransmitStream': grpc.stream_unary_rpc_method_handler(
+          servicer.TransmitStream,
+          request_deserializer=beacon__pb2.Batch.FromString,
+          response_serializer=beacon__pb2.Empty.SerializeToString,
+      ),
   }
   generic_handler = grpc.method_handlers_generic_handler(
       'beacon.Beacon', rpc_method_handlers)
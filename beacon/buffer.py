@@ -6,21 +6,199 @@ of filename and location, and stores them in a batch, which can be flushed
 to the server at defined time intervals."""
 import threading
 import time
-from collections import Counter, deque
-from copy import deepcopy
+import zlib
+from array import array
+from collections import Counter, OrderedDict, deque
 
-from . import beacon_pb2
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import beacon_pb2, defaults
+from .exceptions import CircuitOpenError, ConfigurationError
+from .transport import STREAMED
+from .utils import perf_counter
+
+# type code for the arrays of counts: unsigned 64-bit integers where the
+# platform supports them (Python 3.3+), and unsigned longs otherwise.
+try:
+    COUNT_TYPECODE = array('Q').typecode
+except ValueError:
+    COUNT_TYPECODE = 'L'
+
+# type code for the arrays of path IDs and line numbers of the locations
+LOCATION_TYPECODE = 'l'
+
+# version of the encoding of columnar batches
+COLUMNAR_VERSION = 1
+
+# the statistics kept on the transmissions of a buffer: the numbers of
+# messages, events, and uncompressed bytes transmitted; the number of batches
+# split into chunks, and of their chunks; and the number of compressed
+# messages, with the sizes of the ones sampled to measure the compression
+# ratio, before and after compression
+STATS = ('messages', 'events', 'bytes', 'chunked_batches', 'chunks',
+         'compressed_messages', 'sampled_bytes', 'sampled_compressed_bytes')
+
+
+def _zeros(size):
+    """Return an array of `size` zero counts."""
+    return array(COUNT_TYPECODE, [0]) * size
+
+
+def _clear(counts):
+    """Reset all the counts of an array to zero, in place."""
+    counts[:] = _zeros(len(counts))
+
+
+class _Shard(object):
+    """The counts of events recorded by a single thread, indexed by
+    location ID.
+
+    The shard is double-buffered: a flush swaps `counts` with the cleared
+    `spare`, and clears the old counts after it has merged them, so that the
+    lock is only held for the swap.
+    """
+
+    __slots__ = ('counts', 'spare', 'thread', 'distinct')
+
+    def __init__(self, thread, size):
+        self.counts = _zeros(size)
+        self.spare = _zeros(size)
+        self.thread = thread
+
+        # the number of distinct locations in `counts`, which the thread
+        # keeps without a lock; see `Buffer.needs_flush`
+        self.distinct = 0
+
+
+class _Pending(object):
+    """The batches which could not be transmitted, coalesced into one."""
+
+    __slots__ = ('counts', 'timestamp', 'sampled', 'mode_changes', 'dropped')
+
+    def __init__(self, counts=None, timestamp=None, sampled=False,
+                 mode_changes=(), dropped=0):
+        # the counts keyed by location ID, in the order they failed first
+        self.counts = OrderedDict(counts or ())
+        self.timestamp = timestamp
+        self.sampled = sampled
+        self.mode_changes = list(mode_changes)
+        # the number of events dropped since the last transmission
+        self.dropped = dropped
+
+
+class FlushWorker(object):
+    def __init__(self, min_interval=None):
+        """The FlushWorker flushes buffers early from a background thread,
+           when they ask for it, or when it finds that they have grown large
+           as it checks the buffers it watches every `min_interval`.
+
+        :param min_interval: the minimum number of seconds between two
+                             flushes of a buffer; an early flush waits until
+                             then.
+
+        :return: an instance of FlushWorker.
+        """
+        self.min_interval = min_interval or defaults.MIN_FLUSH_INTERVAL
+
+        # the buffers whose high-water mark is checked by the thread
+        self.buffers = []
+
+        # the buffers which asked to be flushed, and the event that wakes up
+        # the thread for them
+        self.requested = []
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run,
+                                       name='beacon-flush-worker')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+    def watch(self, buffer):
+        """Check the high-water mark of a buffer from the thread, and let the
+        buffer request early flushes.
+        """
+        buffer.flush_worker = self
+        self.buffers.append(buffer)
+
+    def request(self, buffer):
+        """Ask for an early flush of a buffer. This does not block, so it can
+        be called from the traced threads.
+        """
+        with self.lock:
+            if buffer not in self.requested:
+                self.requested.append(buffer)
+        self.wakeup.set()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.min_interval)
+            if self.stopped.is_set():
+                return
+            with self.lock:
+                self.wakeup.clear()
+                requested, self.requested = self.requested, []
+
+            # the traced threads do not ask for the flushes of their events,
+            # so that they take no lock; their buffers are checked here
+            requested.extend(buffer for buffer in self.buffers
+                             if buffer not in requested and
+                             buffer.needs_flush())
+
+            for buffer in requested:
+                delay = buffer.flushed_at + self.min_interval - perf_counter()
+                if self.stopped.wait(max(delay, 0)):
+                    return
+                # a periodic flush may have taken the events meanwhile
+                if buffer.needs_flush():
+                    buffer.flush()
 
 
 class Buffer(object):
-    def __init__(self, agent, event_type):
+    def __init__(self, agent, event_type, presence=False, max_pending=None,
+                 drop_policy=None, columnar=False, max_batch_size=None,
+                 high_water_mark=None):
         """The Buffer stores the batch of events that can be sent to the
            server periodically.
 
         :param agent: the agent instance that is using this buffer.
 
         :param event_type: the type of events that are being stored in
-                           this buffer. Should be one of `f` and `e`.
+                           this buffer. Should be one of `f`, `e` and `r`.
+
+        :param presence: if True, only record whether each location was seen
+                         since the last flush, and not how often.
+
+        :param max_pending: the maximum number of locations kept for the
+                            events which could not be transmitted.
+
+        :param drop_policy: which events are dropped beyond `max_pending`
+                            locations; `new` drops the events of locations
+                            which are not pending yet, and `old` the
+                            locations which have been pending the longest.
+
+        :param columnar: if True, transmit columnar batches, which send the
+                         path of every file only once per stream. This does
+                         not apply in presence mode.
+
+        :param max_batch_size: the size in bytes above which a batch is split
+                               into several, which are transmitted
+                               concurrently.
+
+        :param high_water_mark: the number of distinct locations with events
+                                since the last flush at which the buffer
+                                asks its `flush_worker` for an early flush.
 
         :return: an instance of Buffer.
         """
@@ -29,103 +207,1101 @@ class Buffer(object):
 
         self.event_type = event_type
 
-        # this attribute stores the counter of events; the keys are a
-        # two-tuple of filename and location.
-        self.counter = Counter()
+        # every distinct two-tuple of filename and location is assigned a
+        # small integer ID once; `locations` maps the IDs back to the tuples.
+        self.locations = []
+        self.location_ids = {}
+
+        # likewise, every distinct filename is assigned a path ID, which is
+        # stored for every location ID along with the line number; these are
+        # the columns of columnar batches.
+        self.paths = []
+        self.path_ids = {}
+        self.location_path_ids = array(LOCATION_TYPECODE)
+        self.location_lines = array(LOCATION_TYPECODE)
+        self.columnar = columnar
+
+        # each thread counts events into its own shard, an array indexed by
+        # location ID, so that no lock is needed on the hot path.
+        self._local = threading.local()
+        self._shards = []
+
+        # in presence mode, `seen` holds one byte per location ID, which is
+        # set when the location is seen. Setting a byte needs no lock, and
+        # unlike setting a bit, does not race with other threads. Like the
+        # counts, it is double-buffered with `_spare_seen`.
+        self.presence = presence
+        self.seen = bytearray()
+        self._spare_seen = bytearray()
+        if presence:
+            self.increment = self._mark_seen
 
-        # create a mutex for operations on the counter, for thread safety
+        # the number of locations, in the order of their IDs, which the
+        # server has acknowledged; presence batches carry the newer ones.
+        # The same goes for the paths, and columnar batches.
+        self.acknowledged = 0
+        self.acknowledged_paths = 0
+
+        # functions called on every flush, once the events have been taken
+        # out of the buffer. In presence mode, tracers use this to capture the
+        # locations which were seen again.
+        self.flush_callbacks = []
+
+        # create a mutex for operations on the location table and the list
+        # of shards; this is only taken when a new location or thread records
+        # its first event, and on flush.
         self.counter_lock = threading.Lock()
 
+        # whether the events in this buffer are being sampled statistically,
+        # rather than counted exactly. This is set by the sampling tracer.
+        self._sampled = False
+
+        # whether any of the events since the last flush have been sampled
+        self._sampled_since_flush = False
+
+        # the tracing mode of the agent, and the pending changes to it, as
+        # two-tuples of timestamp and mode. These are reported in batches.
+        self.tracer_mode = ''
+        self.mode_changes = []
+
+        # which exceptions the events of an exception buffer count, as set
+        # by the agent from its exception tracer; see `ExceptionTracer`
+        self.capture_mode = ''
+
         # initialization time of this buffer
         self.init_time = int(time.time())
 
-        # store the message batches that could not be flushed due to the server
-        # due to some reason, hoping we'd be able to flush them later
-        self.unflushed = deque()
+        # the events which could not be transmitted to the server, coalesced
+        # by location, hoping we'd be able to transmit them with the next
+        # batch. This holds up to `max_pending` locations.
+        self.pending = _Pending()
+        self.max_pending = max_pending or defaults.MAX_PENDING_LOCATIONS
+        self.drop_policy = drop_policy or defaults.DROP_POLICY
+        if self.drop_policy not in ('new', 'old'):
+            raise ConfigurationError(
+                "Invalid drop policy: {}".format(self.drop_policy))
+
+        # create a mutex that is held for the whole of a flush, so that
+        # flushes never overlap, and can be paused around a fork.
+        self.flush_lock = threading.Lock()
+
+        # the aggregator of the counts of all the processes on this host, if
+        # host aggregation is enabled; see `beacon.aggregator`.
+        self.aggregator = None
+
+        # batches larger than this are split into chunks
+        self.max_batch_size = max_batch_size or defaults.MAX_BATCH_SIZE
+
+        # the gRPC compression algorithm for the messages larger than the
+        # threshold, if compression is enabled, and the `zlib` window bits of
+        # its format; these are set by the agent.
+        self.compression = None
+        self.compression_wbits = zlib.MAX_WBITS
+        self.compression_threshold = defaults.COMPRESSION_THRESHOLD
+
+        # once the shards have events at `high_water_mark` distinct locations
+        # since the last flush, the `flush_worker` flushes the buffer early;
+        # in presence mode, once `new_locations` were seen for the first
+        # time, and the buffer asks for it. `flushed_at` is the time of the
+        # last flush, on the clock of `perf_counter`.
+        self.new_locations = 0
+        self.high_water_mark = (high_water_mark or
+                                defaults.FLUSH_HIGH_WATER_MARK)
+        self.flush_worker = None
+        self.flushed_at = perf_counter()
+
+        # statistics of the transmissions, reported by `Agent.get_stats`
+        self.stats = Counter(dict.fromkeys(STATS, 0))
+
+        # the transport which sends the batches from its own thread, if any,
+        # and the events queued for it; see `beacon.transport`. Without a
+        # transport, the batches are sent by the thread that flushes.
+        self.transport = None
+        self.outgoing = None
+        self.outgoing_lock = threading.Lock()
+
+        # the spool on disk for the batches which could not be transmitted,
+        # if one is configured; see `beacon.spool`. The batches are written
+        # to it instead of being kept as the pending events.
+        self.spool = None
+
+    @property
+    def sampled(self):
+        """Whether the events in this buffer are currently being sampled."""
+        return self._sampled
+
+    @sampled.setter
+    def sampled(self, value):
+        self._sampled = value
+        self._sampled_since_flush = self._sampled_since_flush or value
+
+    def record_mode_change(self, mode):
+        """Record a change of the tracing mode of the agent, to be reported
+        in the next batch.
+        """
+        with self.counter_lock:
+            self.tracer_mode = mode
+            self.mode_changes.append((int(time.time()), mode))
+
+    @property
+    def counter(self):
+        """A snapshot of the events in this buffer, merged across all threads,
+        as a counter keyed by the two-tuple of filename and location.
+        """
+        with self.counter_lock:
+            arrays = [shard.counts for shard in self._shards]
+
+        return Counter(dict(
+            (self.locations[loc_id], count)
+            for (loc_id, count) in self._merge(arrays).items()))
+
+    def intern(self, filename, location):
+        """Return the ID of the filename and location, assigning a new one if
+        this location has not been seen before.
+        """
+        key = (filename, location)
+        try:
+            return self.location_ids[key]
+        except KeyError:
+            pass
+
+        with self.counter_lock:
+            loc_id = self.location_ids.get(key)
+            if loc_id is None:
+                path_id = self.path_ids.get(filename)
+                if path_id is None:
+                    path_id = self.path_ids[filename] = len(self.paths)
+                    self.paths.append(filename)
+                self.location_path_ids.append(path_id)
+                self.location_lines.append(location)
+
+                loc_id = len(self.locations)
+                self.locations.append(key)
+                self.location_ids[key] = loc_id
+
+                # the batches of presence mode grow with the locations
+                # which the server does not know yet
+                if self.presence:
+                    self._count_new_location()
+        return loc_id
+
+    def _count_new_location(self):
+        """Count a location towards the high-water mark, and ask for an early
+        flush once it is reached. This is called with `counter_lock` held.
+        """
+        self.new_locations += 1
+        if (self.new_locations == self.high_water_mark and
+                self.flush_worker is not None):
+            self.flush_worker.request(self)
+
+    def increment(self, loc_id):
+        """Count one event at the location with the given ID, in the shard of
+        the current thread.
+        """
+        try:
+            counts = self._local.shard.counts
+            if counts[loc_id]:
+                counts[loc_id] += 1
+                return
+        except (AttributeError, IndexError):
+            pass
+        self._increment_slow(loc_id)
+
+    def _increment_slow(self, loc_id):
+        """Count one event when the current thread has no shard yet, its
+        shard is too small for the location ID, or it has no events at the
+        location since the last flush.
+        """
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._add_shard()
+
+        counts = shard.counts
+        if loc_id >= len(counts):
+            counts.extend(_zeros(max(loc_id + 1, self._size()) - len(counts)))
+        counts[loc_id] += 1
+        if counts[loc_id] == 1 and self._is_new_location(counts, loc_id):
+            shard.distinct += 1
+
+    def _is_new_location(self, counts, index):
+        """Whether the first event at the given index of the counts is also
+        the first one at its location.
+        """
+        return True
+
+    def _size(self):
+        """Return the number of counts in a shard that has room for every
+        location.
+        """
+        return len(self.locations)
+
+    def _mark_seen(self, loc_id):
+        """Mark the location with the given ID as seen; this replaces
+        `increment` in presence mode.
+        """
+        try:
+            self.seen[loc_id] = 1
+        except IndexError:
+            with self.counter_lock:
+                size = max(loc_id + 1, len(self.locations))
+                if size > len(self.seen):
+                    self.seen.extend(bytearray(size - len(self.seen)))
+            self.seen[loc_id] = 1
 
     def add(self, filename, location):
-        """Take the filename and location, and add it to the counter.
+        """Take the filename and location, and add it to the counts of the
+        current thread.
         """
+        self.increment(self.intern(filename, location))
+
+    def _add_shard(self):
+        """Create the shard for the current thread."""
+        shard = _Shard(threading.current_thread(), self._size())
+        self._local.shard = shard
         with self.counter_lock:
-            self.counter[(filename, location)] += 1
+            self._shards.append(shard)
+        return shard
+
+    @staticmethod
+    def _merge(arrays):
+        """Merge the arrays of counts of several threads, and return a dict
+        of the non-zero counts, keyed by location ID.
+        """
+        # copying an array is a single operation under the GIL, so it is safe
+        # even if its thread is still adding to it.
+        arrays = [counts[:] for counts in arrays if len(counts)]
+        if not arrays:
+            return {}
+
+        if numpy is not None:
+            dtype = 'u{}'.format(arrays[0].itemsize)
+            totals = numpy.zeros(max(len(counts) for counts in arrays),
+                                 dtype=dtype)
+            for counts in arrays:
+                totals[:len(counts)] += numpy.frombuffer(counts, dtype=dtype)
+            loc_ids = numpy.flatnonzero(totals)
+            return dict(zip(loc_ids.tolist(), totals[loc_ids].tolist()))
+
+        totals = {}
+        for counts in arrays:
+            for loc_id, count in enumerate(counts):
+                if count:
+                    totals[loc_id] = totals.get(loc_id, 0) + count
+        return totals
 
     def flush(self):
         """Send the data in this buffer to the server after serializing it,
-        and then clear the buffer.
+        and then clear the buffer. With a transport, the data is only queued
+        for its sender thread.
 
-        If the data transmission fails, the serialized messages are stored
-        separately.
+        If the data transmission fails, the events are kept, and sent along
+        with the next flush; or written to the spool, if there is one.
         """
+        with self.flush_lock:
+            self._flush()
+            self.flushed_at = perf_counter()
 
-        # create a copy of the current counter and clear it
-        counter_data = None
-        init_time = self.init_time
+    def needs_flush(self):
+        """Whether the buffer has reached its high-water mark. A location
+        with events in several threads counts once in each of their shards.
+        """
+        if self.presence:
+            return self.new_locations >= self.high_water_mark
+        distinct = sum(shard.distinct for shard in list(self._shards))
+        return distinct >= self.high_water_mark
+
+    def _flush(self):
+        if self.presence:
+            return self._flush_presence()
+
+        # swap the current counts for zeros, and process the old ones
+        counts = None
+
+        with self.counter_lock:
+            # swap in the spare counts of every thread, and keep the old ones
+            # for further processing; this takes constant time per thread.
+            arrays = []
+            for shard in self._shards:
+                arrays.append(shard.counts)
+                shard.counts, shard.spare = shard.spare, shard.counts
+                shard.distinct = 0
+
+            # forget the shards of threads that have exited
+            self._shards = [shard for shard in self._shards
+                            if shard.thread.is_alive()]
+
+            init_time, sampled, mode_changes = self._start_interval()
+
+        self._run_flush_callbacks()
 
+        # merge the thread counts outside of the lock. An event added by a
+        # thread while its counts were being swapped might still land in the
+        # old array; such an event is lost.
+        counts = self._merge(arrays)
+
+        # clear the old counts, to be swapped in again on the next flush
+        for old_counts in arrays:
+            _clear(old_counts)
+
+        if self.aggregator is not None:
+            counts, sampled = self._exchange(counts, sampled)
+            if counts is None:
+                # the leader of the host transmits the counts; the mode
+                # changes of this process are not reported.
+                return
+
+        self._dispatch(counts, init_time, sampled, mode_changes)
+
+    def _flush_presence(self):
         with self.counter_lock:
-            # create a copy of the counter for further processing
-            counter_data = deepcopy(self.counter)
+            seen, self.seen = self.seen, self._spare_seen
+            init_time, sampled, mode_changes = self._start_interval()
+
+        # the locations are seen again only after the swap, so that none of
+        # them is skipped in the new interval
+        self._run_flush_callbacks()
+
+        counts = dict((loc_id, 1) for (loc_id, is_seen) in enumerate(seen)
+                      if is_seen)
+
+        # clear the old bytes, to be swapped in again on the next flush
+        seen[:] = bytearray(len(seen))
+        self._spare_seen = seen
+
+        self._dispatch(counts, init_time, sampled, mode_changes)
+
+    def _dispatch(self, counts, timestamp, sampled, mode_changes):
+        """Send the counts keyed by location ID right away, or queue them for
+        the sender thread of the transport, if there is one.
+        """
+        if self.transport is None:
+            return self._send(counts, timestamp, sampled, mode_changes)
+
+        if not counts and not mode_changes:
+            return
+
+        with self.outgoing_lock:
+            outgoing = self.outgoing
+            if outgoing is None:
+                self.outgoing = _Pending(counts, timestamp, sampled,
+                                         mode_changes)
+            else:
+                outgoing.counts = self._coalesce(outgoing.counts, counts)
+                outgoing.timestamp = min(outgoing.timestamp, timestamp)
+                outgoing.sampled = outgoing.sampled or sampled
+                outgoing.mode_changes.extend(mode_changes)
+        self.transport.submit(self)
+
+    def send(self):
+        """Send the events queued for the transport; this is called from its
+        sender thread.
+        """
+        with self.outgoing_lock:
+            outgoing, self.outgoing = self.outgoing, None
 
-            # clear the counter
-            self.counter.clear()
+        if outgoing is not None:
+            self._send(outgoing.counts, outgoing.timestamp, outgoing.sampled,
+                       outgoing.mode_changes)
 
-            # reset the init_time
-            self.init_time = int(time.time())
+    def _send(self, counts, timestamp, sampled, mode_changes):
+        """Coalesce the counts keyed by location ID with the pending ones, and
+        transmit them in a single batch, or in chunks if it is larger than
+        `max_batch_size`. The counts which could not be transmitted become
+        the pending counts.
+        """
+        pending = self.pending
+        if pending.counts:
+            counts = self._coalesce(pending.counts, counts)
+            timestamp = min(pending.timestamp, timestamp)
+            sampled = sampled or pending.sampled
+        mode_changes = pending.mode_changes + mode_changes
+
+        if not counts:
+            # keep the mode changes, and dropped events, for the next batch
+            with self.counter_lock:
+                self.mode_changes[:0] = mode_changes
+            self.pending = _Pending(dropped=pending.dropped)
+            return
+
+        message = self._serialize(counts, timestamp, sampled, mode_changes)
+        message.dropped_events = pending.dropped
+
+        size = message.ByteSize()
+        if size > self.max_batch_size and len(counts) > 1:
+            failed = self._transmit_chunks(
+                counts, timestamp, sampled, mode_changes, pending.dropped,
+                chunk_count=size // self.max_batch_size + 1)
+        elif self._transmit(message):
+            failed = None
+        else:
+            failed = _Pending(counts, timestamp, sampled, mode_changes,
+                              pending.dropped)
+
+        if failed is None:
+            self.pending = _Pending()
+            if self.spool is not None and self.spool.has_records():
+                self.agent.drain_spool()
+        elif self.spool is not None and not self.presence:
+            # the spool holds batches of events, which do not depend on the
+            # path table of the stream. Presence batches do, and their counts
+            # are not exact, so they are kept pending instead.
+            message = self._serialize_batch(
+                counts=failed.counts, timestamp=failed.timestamp,
+                sampled=failed.sampled, mode_changes=failed.mode_changes)
+            message.dropped_events = failed.dropped
+            self._spool(message)
+        else:
+            self._defer(failed)
+
+    def _serialize(self, counts, timestamp, sampled, mode_changes,
+                   table=None):
+        """Return the batch message of the counts keyed by location ID, in the
+        encoding of this buffer. In presence mode, `table` is the range of
+        the IDs of the locations to send along, if not all the new ones.
+        """
+        if self.presence:
+            return self._serialize_presence_batch(
+                counts, timestamp=timestamp, sampled=sampled,
+                mode_changes=mode_changes, table=table)
+        elif self.columnar:
+            serialize = self._serialize_columnar_batch
+        else:
+            serialize = self._serialize_batch
+        return serialize(counts, timestamp=timestamp, sampled=sampled,
+                         mode_changes=mode_changes)
+
+    def _transmit_chunks(self, counts, timestamp, sampled, mode_changes,
+                         dropped, chunk_count):
+        """Split the counts keyed by location ID into `chunk_count` batches,
+        and transmit them. Return the pending events of the batches which
+        could not be transmitted, or None.
+
+        The first batch carries the mode changes and dropped events, as well
+        as the paths which the server does not know yet, so it is transmitted
+        before the others, which are transmitted concurrently. In presence
+        mode, the locations which the server does not know yet are split
+        across the batches instead: each one carries the new locations up to
+        the last one it has seen.
+        """
+        loc_ids = sorted(counts) if self.presence else list(counts)
+        size = -(-len(loc_ids) // chunk_count)
+        chunks = [OrderedDict((loc_id, counts[loc_id])
+                              for loc_id in loc_ids[start:start + size])
+                  for start in range(0, len(loc_ids), size)]
+
+        tables = [None] * len(chunks)
+        if self.presence:
+            start, total = self.acknowledged, len(self.locations)
+            for index, chunk in enumerate(chunks):
+                end = min(max(start, next(reversed(chunk)) + 1), total)
+                if index == len(chunks) - 1:
+                    end = total
+                tables[index] = (start, end)
+                start = end
+
+        message = self._serialize(chunks[0], timestamp, sampled, mode_changes,
+                                  tables[0])
+        message.dropped_events = dropped
+        if not self._transmit(message):
+            return _Pending(counts, timestamp, sampled, mode_changes, dropped)
+
+        # with a transport, no more than its `max_in_flight` RPCs are
+        # started at once
+        chunks_left = chunks[1:]
+        window = len(chunks_left)
+        if self.transport is not None:
+            window = self.transport.max_in_flight
+
+        failed = OrderedDict()
+        for start in range(0, len(chunks_left), window):
+            calls = []
+            for chunk, table in zip(chunks_left[start:start + window],
+                                    tables[1 + start:1 + start + window]):
+                message = self._serialize(chunk, timestamp, sampled, (),
+                                          table)
+                try:
+                    calls.append((chunk, message,
+                                  self._call(message, future=True)))
+                except CircuitOpenError:
+                    failed.update(chunk)
+
+            for chunk, message, future in calls:
+                try:
+                    future.result()
+                except Exception as e:
+                    self.agent.logger.error(
+                        "Error sending events. "
+                        "Keeping them for the next batch."
+                    )
+                    self.agent.logger.error(e)
+                    failed.update(chunk)
+                else:
+                    self._transmitted(message)
+
+        self.stats['chunked_batches'] += 1
+        self.stats['chunks'] += len(chunks)
+        if failed:
+            return _Pending(failed, timestamp, sampled)
+        return None
+
+    @staticmethod
+    def _coalesce(pending_counts, counts):
+        """Add the counts to a copy of the pending ones."""
+        coalesced = OrderedDict(pending_counts)
+        for loc_id, count in counts.items():
+            coalesced[loc_id] = coalesced.get(loc_id, 0) + count
+        return coalesced
+
+    def _defer(self, pending):
+        """Keep the events which could not be transmitted, dropping the ones
+        beyond `max_pending` locations.
+        """
+        excess = len(pending.counts) - self.max_pending
+        if excess > 0:
+            loc_ids = list(pending.counts)
+            if self.drop_policy == 'new':
+                dropped = loc_ids[-excess:]
+            else:
+                dropped = loc_ids[:excess]
+
+            dropped_events = sum(pending.counts.pop(loc_id)
+                                 for loc_id in dropped)
+            pending.dropped += dropped_events
+            self.agent.logger.warning(
+                "Too many pending events. "
+                "{} events dropped.".format(dropped_events))
+
+        self.pending = pending
+
+    def confirm(self, batch):
+        """Count a batch which was written to a stream, once the server has
+        confirmed it; this is called from the sender thread of the transport.
+        """
+        self._transmitted(batch)
+
+    def restore(self, batch):
+        """Take back the events of a batch which was written to a stream that
+        failed, and could not be transmitted again either; this is called
+        from the sender thread of the transport.
+        """
+        if self.spool is not None:
+            try:
+                if self.spool.append(batch):
+                    return
+            except (IOError, OSError) as e:
+                self.agent.logger.error("Error writing events to the spool.")
+                self.agent.logger.error(e)
+
+        counts = self._event_counts(batch)
+        mode_changes = [(change.timestamp, change.mode)
+                        for change in batch.mode_changes]
+
+        pending = self.pending
+        timestamp = batch.timestamp
+        if pending.counts:
+            timestamp = min(timestamp, pending.timestamp)
+        self._defer(_Pending(
+            self._coalesce(counts, pending.counts), timestamp,
+            batch.sampled or pending.sampled,
+            mode_changes + pending.mode_changes,
+            pending.dropped + batch.dropped_events))
+
+    def _event_counts(self, batch):
+        """Return the counts of the events of a batch, keyed by location
+        ID.
+        """
+        counts = OrderedDict()
+        for event in batch.events:
+            loc_id = self.intern(event.file_path, event.location)
+            counts[loc_id] = counts.get(loc_id, 0) + event.count
+        return counts
+
+    def _spool(self, batch):
+        """Write a batch which could not be transmitted to the spool, split
+        into batches of up to `max_batch_size` bytes, and drop the ones that
+        do not fit if the spool is full.
+        """
+        dropped = events = 0
+        for part in self._split_batch(batch):
+            try:
+                spooled = self.spool.append(part)
+            except (IOError, OSError) as e:
+                self.agent.logger.error("Error writing events to the spool.")
+                self.agent.logger.error(e)
+                spooled = False
+
+            if not spooled:
+                part_events = sum(event.count for event in part.events)
+                dropped += part.dropped_events + part_events
+                events += part_events
 
-        message = self._serialize_batch(counter=counter_data,
-                                        timestamp=init_time)
+        self.pending = _Pending(dropped=dropped)
+        if events:
+            self.agent.logger.warning(
+                "The spool is full. {} events dropped.".format(events))
 
-        # TODO: do this in a better way
-        if not len(message.events):
+    def _split_batch(self, batch):
+        """Split a batch with counts in halves until they are no larger than
+        `max_batch_size` bytes, or hold a single event, and return them. The
+        first one carries the mode changes and dropped events.
+        """
+        events = batch.events
+        if (batch.presence or len(events) < 2 or
+                batch.ByteSize() <= self.max_batch_size):
+            return [batch]
+
+        parts = []
+        half = len(events) // 2
+        for part_events in (events[:half], events[half:]):
+            part = beacon_pb2.Batch(stream_id=batch.stream_id,
+                                    event_type=batch.event_type,
+                                    events=part_events,
+                                    timestamp=batch.timestamp,
+                                    sampled=batch.sampled,
+                                    tracer_mode=batch.tracer_mode,
+                                    capture_mode=batch.capture_mode)
+            if not parts:
+                part.mode_changes.extend(batch.mode_changes)
+                part.dropped_events = batch.dropped_events
+            parts.extend(self._split_batch(part))
+        return parts
+
+    def transmit_spooled(self, batch):
+        """Transmit a batch drained from the spool, split into batches of up
+        to `max_batch_size` bytes, and compressed like the others. This is
+        called from the thread that drains the spool.
+
+        If the first batch cannot be transmitted, the exception is raised,
+        so that the spool keeps the batch. The batches after it which cannot
+        be transmitted are written back to the spool instead, since the
+        server has received part of the events already.
+        """
+        parts = self._split_batch(batch)
+        self._call(parts[0], stream=False)
+        self._transmitted(parts[0], acknowledge=False)
+
+        for index, part in enumerate(parts[1:], 1):
+            try:
+                self._call(part, stream=False)
+            except Exception as e:
+                self.agent.logger.error(
+                    "Error sending events from the spool. "
+                    "Writing them back to it.")
+                self.agent.logger.error(e)
+                break
+            self._transmitted(part, acknowledge=False)
+        else:
             return
-        self._transmit(message)
 
-    def _serialize_batch(self, counter, timestamp):
-        """Take the counter data and return a serialized batch message that
-        can be sent to the server. Additionally, it needs the start_time and
-        end_time of capture of this set of events.
+        for part in parts[index:]:
+            try:
+                spooled = self.spool.append(part)
+            except (IOError, OSError) as e:
+                self.agent.logger.error("Error writing events to the spool.")
+                self.agent.logger.error(e)
+                spooled = False
+            if not spooled:
+                self.agent.logger.warning(
+                    "The spool is full. {} events dropped.".format(
+                        sum(event.count for event in part.events)))
+
+    def _start_interval(self):
+        """Reset the batch metadata for the next interval, and return the
+        init time, whether any events were sampled, and the mode changes of
+        the one that ended. This is called with `counter_lock` held.
+        """
+        init_time = self.init_time
+        self.init_time = int(time.time())
+        self.new_locations = 0
+
+        sampled = self._sampled_since_flush
+        self._sampled_since_flush = self._sampled
+        mode_changes, self.mode_changes = self.mode_changes, []
+        return init_time, sampled, mode_changes
+
+    def _run_flush_callbacks(self):
+        for callback in self.flush_callbacks:
+            callback()
+
+    def _exchange(self, counts, sampled):
+        """Hand the counts keyed by location ID over to the host aggregator,
+        and return the counts this process should transmit, if any, along
+        with whether they were sampled.
+        """
+        locations = self.locations
+        try:
+            host_counts, sampled = self.aggregator.exchange(
+                dict((locations[loc_id], count)
+                     for (loc_id, count) in counts.items()),
+                sampled)
+        except (IOError, OSError) as e:
+            self.agent.logger.error(
+                "Error aggregating events on this host. "
+                "Transmitting them directly.")
+            self.agent.logger.error(e)
+            return counts, sampled
+
+        if host_counts is None:
+            return None, sampled
+
+        return dict((self.intern(filename, location), count)
+                    for ((filename, location), count)
+                    in host_counts.items()), sampled
+
+    def before_fork(self):
+        """Pause flushing and adding locations before the process forks, so
+        that the child does not inherit a lock held by another thread.
+        """
+        self.flush_lock.acquire()
+        self.counter_lock.acquire()
+
+    def after_fork_in_parent(self):
+        """Resume flushing in the parent process after a fork."""
+        self.counter_lock.release()
+        self.flush_lock.release()
+
+    def after_fork_in_child(self):
+        """Reset this buffer in the child process after a fork.
+
+        The events and pending batches inherited from the parent are
+        dropped, since the parent still flushes them. The child transmits on
+        a stream of its own, so the location and path tables are started
+        anew, and sent in full with its first batches; the tracers forget
+        the location IDs they have cached.
+        """
+        self.flush_lock = threading.Lock()
+        self.counter_lock = threading.Lock()
+        self._local = threading.local()
+        self._shards = []
+        self.locations = []
+        self.location_ids = {}
+        self.paths = []
+        self.path_ids = {}
+        self.location_path_ids = array(LOCATION_TYPECODE)
+        self.location_lines = array(LOCATION_TYPECODE)
+        self.acknowledged = 0
+        self.acknowledged_paths = 0
+        self.seen = bytearray()
+        self._spare_seen = bytearray()
+        self._sampled_since_flush = self._sampled
+        self.mode_changes = []
+        self.init_time = int(time.time())
+        self.pending = _Pending()
+        self.outgoing = None
+        self.outgoing_lock = threading.Lock()
+        self.stats = Counter(dict.fromkeys(STATS, 0))
+        self.new_locations = 0
+        self.flushed_at = perf_counter()
+        if self.aggregator is not None:
+            self.aggregator.after_fork_in_child()
+
+    def _serialize_batch(self, counts, timestamp, sampled=False,
+                         mode_changes=()):
+        """Take the counts keyed by location ID and return a serialized batch
+        message that can be sent to the server. Additionally, it needs the
+        start_time and end_time of capture of this set of events, whether the
+        counts were sampled, and the changes of the tracing mode during this
+        time.
         """
-        events = deque(maxlen=len(counter))
-        for (loc, count) in counter.items():
-            event = beacon_pb2.Event(file_path=loc[0], location=loc[1],
+        locations = self.locations
+        events = deque(maxlen=len(counts))
+        for (loc_id, count) in counts.items():
+            filename, location = locations[loc_id]
+            event = beacon_pb2.Event(file_path=filename, location=location,
                                      count=count)
             events.append(event)
 
-        batch = beacon_pb2.Batch(stream_id=self.agent.stream_id,
-                                 event_type=self.event_type,
-                                 events=events,
-                                 timestamp=timestamp)
+        batch = beacon_pb2.Batch(
+            stream_id=self.agent.stream_id,
+            event_type=self.event_type,
+            events=events,
+            timestamp=timestamp,
+            sampled=sampled,
+            tracer_mode=self.tracer_mode,
+            capture_mode=self.capture_mode,
+            mode_changes=[
+                beacon_pb2.ModeChange(timestamp=changed_at, mode=mode)
+                for (changed_at, mode) in mode_changes
+            ])
+
+        return batch
+
+    def _serialize_presence_batch(self, loc_ids, timestamp, sampled=False,
+                                  mode_changes=(), table=None):
+        """Take the IDs of the locations seen, and return a serialized batch
+        message with their bitmap, and the locations which the server does
+        not know yet; or the ones in the range of IDs `table`, if given.
+        """
+        bitmap = bytearray((max(loc_ids) + 8) // 8 if loc_ids else 0)
+        for loc_id in loc_ids:
+            bitmap[loc_id >> 3] |= 1 << (loc_id & 7)
+
+        offset, end = table or (self.acknowledged, len(self.locations))
+        locations = [beacon_pb2.Event(file_path=filename, location=location)
+                     for (filename, location) in self.locations[offset:end]]
+
+        batch = self._serialize_batch(counts={}, timestamp=timestamp,
+                                      sampled=sampled,
+                                      mode_changes=mode_changes)
+        batch.presence = True
+        batch.seen = bytes(bitmap)
+        batch.location_offset = offset
+        batch.locations.extend(locations)
+        return batch
+
+    def _serialize_columnar_batch(self, counts, timestamp, sampled=False,
+                                  mode_changes=()):
+        """Take the counts keyed by location ID and return a columnar batch
+        message, with the paths which the server does not know yet.
+        """
+        loc_ids = list(counts)
+        # copy the columns, which other threads may extend meanwhile
+        path_ids = self.location_path_ids[:]
+        lines = self.location_lines[:]
+        if numpy is not None and loc_ids:
+            index = numpy.array(loc_ids, dtype='i8')
+            dtype = 'i{}'.format(path_ids.itemsize)
+            path_ids = numpy.frombuffer(path_ids, dtype=dtype)[index].tolist()
+            lines = numpy.frombuffer(lines, dtype=dtype)[index].tolist()
+        else:
+            path_ids = [path_ids[loc_id] for loc_id in loc_ids]
+            lines = [lines[loc_id] for loc_id in loc_ids]
 
+        offset = self.acknowledged_paths
+        batch = beacon_pb2.ColumnarBatch(
+            version=COLUMNAR_VERSION,
+            stream_id=self.agent.stream_id,
+            event_type=self.event_type,
+            timestamp=timestamp,
+            sampled=sampled,
+            tracer_mode=self.tracer_mode,
+            capture_mode=self.capture_mode,
+            mode_changes=[
+                beacon_pb2.ModeChange(timestamp=changed_at, mode=mode)
+                for (changed_at, mode) in mode_changes
+            ],
+            path_offset=offset,
+            paths=self.paths[offset:])
+        batch.path_ids.extend(path_ids)
+        batch.locations.extend(lines)
+        batch.counts.extend(counts.values())
         return batch
 
+    def _acknowledge(self, batch):
+        """Remember the locations, or paths, the server has received with a
+        batch.
+        """
+        if isinstance(batch, beacon_pb2.ColumnarBatch):
+            self.acknowledged_paths = max(self.acknowledged_paths,
+                                          batch.path_offset +
+                                          len(batch.paths))
+        elif batch.presence and batch.location_offset <= self.acknowledged:
+            # the locations are only acknowledged up to the first ones that
+            # the server has not received, which are sent again
+            self.acknowledged = max(self.acknowledged,
+                                    batch.location_offset +
+                                    len(batch.locations))
+
     def _transmit(self, batch):
-        """Take a batch message and transmit it to the server. If transmission
-        fails, add the message to the unflushed list of messages.
+        """Take a batch message and transmit it to the server. Return whether
+        the transmission was successful.
         """
         try:
-            for event in batch.events:
-                print("{}:{} {}".format(event.file_path, event.location,
-                                        event.count))
-            self.agent.stub.Transmit(batch)
-            self.agent.logger.info(
-                "Transmission successful. "
-                "{} events sent.".format(len(batch.events)))
+            if self._call(batch) is STREAMED:
+                # counted once the server confirms the stream
+                return True
+        except CircuitOpenError:
+            # the transport logs when it stops calling the server
+            return False
         except Exception as e:
             self.agent.logger.error(
-                "Error sending events. Adding the batch to unflushed."
+                "Error sending events. Keeping them for the next batch."
             )
             self.agent.logger.error(e)
-            self.unflushed.append(batch)
+            return False
+
+        self._transmitted(batch)
+        return True
+
+    def _call(self, batch, future=False, stream=True):
+        """Call the RPC that transmits the batch, compressing it if it is
+        larger than `compression_threshold`. With a transport, the RPC has a
+        deadline, and is retried or failed fast as the transport decides; or
+        the batch is written to the stream of the transport, if it streams
+        batches of events and `stream` is set. Return the response, or a
+        future of it if `future` is set.
+        """
+        stub = self.agent.stub
+        if isinstance(batch, beacon_pb2.ColumnarBatch):
+            method = stub.TransmitColumnar
         else:
-            # since the transmission is successful, try to flush pending
-            # messages, if any.
-            while len(self.unflushed):
-                # try to send the leftmost message from unflushed
-                message = self.unflushed.popleft()
-                try:
-                    self.agent.stub.Transmit(message)
-                except Exception:
-                    # if there is an error sending the message, then append the
-                    # message back to the left of unflushed,
-                    # and exit this loop.
-                    self.unflushed.appendleft(message)
-                    break
+            method = stub.Transmit
+
+        options = {}
+        if (self.compression is not None and
+                batch.ByteSize() > self.compression_threshold):
+            self._measure_compression(batch)
+            options['compression'] = self.compression
+
+        transport = self.transport
+        if (transport is not None and transport.streaming and stream and
+                not future and not options and
+                isinstance(batch, beacon_pb2.Batch) and not batch.presence):
+            return transport.call_stream(self.agent.stub, self, batch)
+
+        if future:
+            if transport is not None:
+                return transport.call_future(method, batch, **options)
+            return method.future(batch, **options)
+
+        if transport is not None:
+            return transport.call(method, batch, **options)
+        return method(batch, **options)
+
+    def _measure_compression(self, batch):
+        """Count a compressed message, and measure the compression ratio on
+        every `COMPRESSION_SAMPLE_INTERVAL`th one; gRPC compresses the
+        messages internally, so they are compressed again for this.
+        """
+        if (self.stats['compressed_messages'] %
+                defaults.COMPRESSION_SAMPLE_INTERVAL == 0):
+            data = batch.SerializeToString()
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                          zlib.DEFLATED,
+                                          self.compression_wbits)
+            compressed = compressor.compress(data) + compressor.flush()
+            self.stats['sampled_bytes'] += len(data)
+            self.stats['sampled_compressed_bytes'] += len(compressed)
+        self.stats['compressed_messages'] += 1
+
+    def _transmitted(self, batch, acknowledge=True):
+        """Acknowledge a batch which was transmitted, and count it. The
+        batches drained from the spool may come from another process, whose
+        tables they refer to, so they are only counted, with `acknowledge`
+        unset.
+        """
+        if acknowledge:
+            self._acknowledge(batch)
+        if isinstance(batch, beacon_pb2.ColumnarBatch):
+            events = len(batch.counts)
+        elif batch.presence:
+            events = sum(bin(byte).count('1')
+                         for byte in bytearray(batch.seen))
+        else:
+            events = len(batch.events)
+
+        self.stats['messages'] += 1
+        self.stats['events'] += events
+        self.stats['bytes'] += batch.ByteSize()
+        self.agent.logger.info(
+            "Transmission successful. "
+            "{} events sent.".format(events))
+
+
+class HistogramBuffer(Buffer):
+    def __init__(self, agent, event_type, buckets=None, **options):
+        """The HistogramBuffer stores a histogram of the durations of the
+           calls at every location, in buckets whose bounds grow by powers of
+           two.
+
+        The histograms are kept in the arrays of counts of the Buffer, where
+        the location with ID `i` has the `buckets` counts starting at index
+        `i * buckets`; so recording a call only increments a count, and the
+        histograms are merged, coalesced and split into chunks like any
+        other counts. They are transmitted as events with `buckets`, in
+        batches of events; `max_pending` then limits the number of pending
+        buckets.
+
+        :param agent: the agent instance that is using this buffer.
+
+        :param event_type: the type of events that are being stored in
+                           this buffer. Should be `h`.
+
+        :param buckets: the number of buckets of every histogram.
+
+        :return: an instance of HistogramBuffer.
+        """
+        super(HistogramBuffer, self).__init__(agent, event_type, **options)
+
+        self.buckets = buckets or defaults.HISTOGRAM_BUCKETS
+
+        # histograms are always sent in batches of events
+        self.columnar = False
+
+    @property
+    def counter(self):
+        """A snapshot of the histograms in this buffer, merged across all
+        threads, as a counter keyed by the three-tuple of filename, location
+        and bucket.
+        """
+        with self.counter_lock:
+            arrays = [shard.counts for shard in self._shards]
+
+        counter = Counter()
+        for index, count in self._merge(arrays).items():
+            loc_id, bucket = divmod(index, self.buckets)
+            counter[self.locations[loc_id] + (bucket,)] = count
+        return counter
+
+    def record(self, loc_id, duration):
+        """Count a call of `duration` seconds at the location with the given
+        ID, in the bucket of its duration.
+        """
+        bucket = int(duration * 1000000).bit_length()
+        if bucket >= self.buckets:
+            bucket = self.buckets - 1
+        self.increment(loc_id * self.buckets + bucket)
+
+    def _size(self):
+        return len(self.locations) * self.buckets
+
+    def _is_new_location(self, counts, index):
+        start = index - index % self.buckets
+        return not any(counts[start:index]) and not any(
+            counts[index + 1:start + self.buckets])
+
+    def _serialize_batch(self, counts, timestamp, sampled=False,
+                         mode_changes=()):
+        """Take the counts keyed by their index in the arrays, and return a
+        batch message with the histogram of every location. The count of an
+        event is the number of calls in its histogram.
+        """
+        histograms = OrderedDict()
+        for index, count in counts.items():
+            loc_id, bucket = divmod(index, self.buckets)
+            histogram = histograms.get(loc_id)
+            if histogram is None:
+                histogram = histograms[loc_id] = [0] * self.buckets
+            histogram[bucket] += count
+
+        locations = self.locations
+        events = []
+        for loc_id, histogram in histograms.items():
+            while histogram and not histogram[-1]:
+                histogram.pop()
+            filename, location = locations[loc_id]
+            events.append(beacon_pb2.Event(file_path=filename,
+                                           location=location,
+                                           count=sum(histogram),
+                                           buckets=histogram))
+
+        batch = super(HistogramBuffer, self)._serialize_batch(
+            counts={}, timestamp=timestamp, sampled=sampled,
+            mode_changes=mode_changes)
+        batch.events.extend(events)
+        return batch
+
+    def _event_counts(self, batch):
+        """Return the counts of the buckets of the events of a batch, keyed
+        by their index in the arrays.
+        """
+        last = self.buckets - 1
+        counts = OrderedDict()
+        for event in batch.events:
+            loc_id = self.intern(event.file_path, event.location)
+            for bucket, count in enumerate(event.buckets):
+                if count:
+                    index = loc_id * self.buckets + min(bucket, last)
+                    counts[index] = counts.get(index, 0) + count
+        return counts
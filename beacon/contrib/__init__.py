@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Integrations of Beacon with web frameworks and servers."""
+from __future__ import absolute_import
+import itertools
+import threading
+from contextlib import contextmanager
+
+import beacon
+from ..exceptions import ConfigurationError
+from ..utils import perf_counter
+
+
+class RequestSampler(object):
+    def __init__(self, every=None, rate=None):
+        """The RequestSampler picks the requests which are traced.
+
+        :param every: trace one in every `every` requests.
+
+        :param rate: trace up to `rate` requests per second.
+
+        :return: an instance of RequestSampler. Without any of the arguments,
+                 every request is traced.
+        """
+        if every is not None and rate is not None:
+            raise ConfigurationError(
+                "Only one of `every` and `rate` can be given")
+        if every is not None and every < 1:
+            raise ConfigurationError(
+                "Invalid sampling interval: {}".format(every))
+        if rate is not None and rate <= 0:
+            raise ConfigurationError("Invalid sampling rate: {}".format(rate))
+
+        self.every = every
+
+        self.rate = rate
+
+        self._counter = itertools.count()
+
+        # whether the agent was found not to trace in scopes, which has been
+        # logged already
+        self.unscoped = False
+
+        # a token bucket for the rate, which holds up to a second of tokens
+        self._lock = threading.Lock()
+        self._tokens = max(rate or 0, 1)
+        self._last_time = perf_counter()
+
+    @property
+    def is_sampling(self):
+        """Whether only some of the requests are traced."""
+        return bool(self.rate) or bool(self.every and self.every > 1)
+
+    def should_trace(self):
+        """Return whether the next request should be traced."""
+        if self.rate:
+            return self._take_token()
+
+        if self.every and self.every > 1:
+            # `next` on a count is atomic, so no lock is needed
+            return next(self._counter) % self.every == 0
+
+        return True
+
+    def _take_token(self):
+        with self._lock:
+            now = perf_counter()
+            self._tokens = min(self._tokens +
+                               (now - self._last_time) * self.rate,
+                               max(self.rate, 1))
+            self._last_time = now
+            if self._tokens < 1:
+                return False
+
+            self._tokens -= 1
+            return True
+
+
+@contextmanager
+def sampled_request(sampler, agent=None):
+    """Trace the code run inside this context, if the sampler picks it.
+
+    The agent should run with the `scoped` option, so that the requests which
+    are not picked run without a profiler. The function events are reported
+    as sampled when the sampler only picks some of the requests. Without the
+    option, every request is traced, and a warning is logged once.
+
+    :param sampler: the RequestSampler of the requests.
+
+    :param agent: the agent to trace with; defaults to the one started with
+                  `beacon.init`.
+    """
+    agent = agent or beacon.__agent__
+    if agent is None:
+        yield
+        return
+
+    if not agent.tracer.scoped:
+        # every request is traced, so the counts are not sampled
+        if sampler.is_sampling and not sampler.unscoped:
+            sampler.unscoped = True
+            agent.logger.warning(
+                "Requests are only sampled when the agent runs with the "
+                "`scoped` option. Tracing every request.")
+        yield
+        return
+
+    if sampler.is_sampling:
+        agent.buffers['function'].sampled = True
+
+    if not sampler.should_trace():
+        yield
+        return
+
+    with agent.tracing():
+        yield
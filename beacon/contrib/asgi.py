@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""ASGI middleware, which traces a fraction of the requests.
+
+This module needs Python 3.7+, where the tracing scopes of concurrent tasks
+are kept apart.
+"""
+from . import RequestSampler, sampled_request
+
+# the types of ASGI connections that are requests
+REQUEST_TYPES = ('http', 'websocket')
+
+
+class BeaconMiddleware(object):
+    def __init__(self, app, every=None, rate=None, agent=None):
+        """Wrap an ASGI application, so that the requests picked by a
+           RequestSampler are traced by Beacon.
+
+        The whole request is traced, including the response. Other tasks
+        that run on the event loop meanwhile are not traced.
+
+        :param app: the ASGI application.
+
+        :param every: trace one in every `every` requests.
+
+        :param rate: trace up to `rate` requests per second.
+
+        :param agent: the agent to trace with; defaults to the one started
+                      with `beacon.init`.
+
+        :return: an instance of BeaconMiddleware.
+        """
+        self.app = app
+
+        self.sampler = RequestSampler(every=every, rate=rate)
+
+        self.agent = agent
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] not in REQUEST_TYPES:
+            return await self.app(scope, receive, send)
+
+        with sampled_request(self.sampler, self.agent):
+            return await self.app(scope, receive, send)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""WSGI middleware, which traces a fraction of the requests."""
+from __future__ import absolute_import
+
+from . import RequestSampler, sampled_request
+
+
+class BeaconMiddleware(object):
+    def __init__(self, app, every=None, rate=None, agent=None):
+        """Wrap a WSGI application, so that the requests picked by a
+           RequestSampler are traced by Beacon.
+
+        Only the call of the application is traced, and not the iteration of
+        its response.
+
+        :param app: the WSGI application.
+
+        :param every: trace one in every `every` requests.
+
+        :param rate: trace up to `rate` requests per second.
+
+        :param agent: the agent to trace with; defaults to the one started
+                      with `beacon.init`.
+
+        :return: an instance of BeaconMiddleware.
+        """
+        self.app = app
+
+        self.sampler = RequestSampler(every=every, rate=rate)
+
+        self.agent = agent
+
+    def __call__(self, environ, start_response):
+        with sampled_request(self.sampler, self.agent):
+            return self.app(environ, start_response)
@@ -5,3 +5,89 @@
 import socket
 
 NAME = socket.gethostname() if hasattr(socket, 'gethostname') else None
+
+# maximum number of code objects for which the tracer remembers whether
+# calls into them should be captured
+CAPTURE_CACHE_SIZE = 16384
+
+# `sys.monitoring` tool identifier used by the tracer on Python 3.12+; this is
+# the identifier reserved for profilers (`sys.monitoring.PROFILER_ID`)
+MONITORING_TOOL_ID = 2
+
+# number of seconds between two samples taken by the sampling tracer
+SAMPLE_INTERVAL = 0.01
+
+# `sys.monitoring` tool identifier used to track exceptions on Python 3.12+
+EXCEPTION_MONITORING_TOOL_ID = 4
+
+# the overhead governor steps back up from sampling to tracing once the load
+# of the process drops below this ratio of the load at which it stepped down,
+# and the cool-down period, in seconds, has passed. The cool-down doubles,
+# up to the maximum, whenever tracing has to be stepped down again right
+# after stepping up.
+GOVERNOR_RECOVERY_RATIO = 0.5
+GOVERNOR_COOLDOWN = 30
+GOVERNOR_MAX_COOLDOWN = 600
+
+# number of slots, and size in bytes of the heap of location keys, of the
+# segment shared by the processes of a host with host aggregation
+AGGREGATION_SLOTS = 65536
+AGGREGATION_HEAP_SIZE = 4 * 1024 * 1024
+
+# maximum number of distinct locations kept for the batches that could not be
+# transmitted, and which ones are dropped beyond that: the counts of `new`
+# locations, or the `old` locations which failed first
+MAX_PENDING_LOCATIONS = 100000
+DROP_POLICY = 'new'
+
+# maximum size in bytes of the spool of batches that could not be
+# transmitted, and the number of seconds after which its batches are dropped
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+SPOOL_MAX_AGE = 24 * 60 * 60
+
+# batches larger than this many bytes are split into several, which stay
+# below the default limit of 4 MiB on the size of gRPC messages
+MAX_BATCH_SIZE = 3 * 1024 * 1024
+
+# with compression enabled, only the messages larger than this many bytes
+# are compressed, and the ratio is measured on one in this many of them
+COMPRESSION_THRESHOLD = 64 * 1024
+COMPRESSION_SAMPLE_INTERVAL = 10
+
+# a buffer is flushed early, by a background worker, once this many locations
+# were seen for the first time since its last flush; but not sooner than this
+# many seconds after the last flush
+FLUSH_HIGH_WATER_MARK = 50000
+MIN_FLUSH_INTERVAL = 1
+
+# the deadline in seconds of every RPC that transmits a batch, the maximum
+# number of RPCs in flight at once, and the number of recent RPCs whose
+# latency is reported
+TRANSMIT_TIMEOUT = 10
+MAX_IN_FLIGHT = 4
+LATENCY_WINDOW = 100
+
+# an RPC which failed with a transient error is tried up to this many times,
+# waiting twice as long before every retry, up to the maximum delay, and less
+# a random fraction up to the jitter
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 5
+RETRY_JITTER = 0.5
+
+# the transport stops calling the server after this many failed RPCs in a
+# row, until it probes it again after the reset timeout, in seconds; the
+# timeout doubles with every failed probe, up to the maximum
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 10
+BREAKER_MAX_RESET_TIMEOUT = 300
+
+# with streaming, the stream of batches is closed, and the server confirms
+# them, after this many batches or seconds
+STREAM_MAX_BATCHES = 30
+STREAM_MAX_AGE = 60
+
+# the number of buckets of the latency histogram of every function: bucket 0
+# counts the calls shorter than a microsecond, bucket `i` the calls of 2^(i-1)
+# up to 2^i microseconds, and the last bucket all the longer ones
+HISTOGRAM_BUCKETS = 32
@@ -11,3 +11,9 @@ class ConfigurationError(ValueError):
 
 class InvalidDSN(ConfigurationError):
     pass
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the server, while the circuit breaker of the
+    transport is open."""
+    pass
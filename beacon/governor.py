@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""The governor keeps the overhead of Beacon within a budget, by switching
+the agent between full tracing and sampling as the load changes."""
+import os
+import time
+
+from . import defaults
+
+TRACING = 'tracing'
+SAMPLING = 'sampling'
+
+
+def _cpu_time():
+    """Return the CPU time used by this process so far, in seconds."""
+    times = os.times()
+    return times[0] + times[1]
+
+
+class Governor(object):
+    def __init__(self, agent, budget, **options):
+        """The Governor periodically compares the time spent inside the
+           tracer with the wall time.
+
+        When this fraction goes over the budget, the agent steps down from
+        full tracing to sampling. It steps back up to tracing once the load of
+        the process, measured as its CPU usage, has dropped below
+        `recovery_ratio` of the load at which it stepped down, and a cool-down
+        period has passed. The cool-down doubles every time tracing has to be
+        stepped down again right after it was stepped up, up to
+        `max_cooldown` seconds.
+
+        :param agent: the agent instance that is governed.
+
+        :param budget: the fraction of wall time that can be spent in the
+                       tracer, e.g. `0.02` for 2%.
+
+        :return: an instance of Governor.
+        """
+
+        self.agent = agent
+
+        self.budget = budget
+
+        self.recovery_ratio = (options.get('recovery_ratio') or
+                               defaults.GOVERNOR_RECOVERY_RATIO)
+
+        self.base_cooldown = (options.get('cooldown') or
+                              defaults.GOVERNOR_COOLDOWN)
+        self.max_cooldown = (options.get('max_cooldown') or
+                             defaults.GOVERNOR_MAX_COOLDOWN)
+        self.cooldown = self.base_cooldown
+
+        # the most recent measurements; `overhead` is the fraction of wall
+        # time spent in the tracer, and `load` the CPU usage of the process
+        self.overhead = 0.0
+        self.load = 0.0
+
+        # the load at which tracing was last stepped down
+        self.step_down_load = None
+
+        # the time of the last switch of the tracing mode
+        self.switched_at = None
+
+        self._last_time = None
+        self._last_cpu_time = None
+        self._last_overhead = None
+
+    def check(self):
+        """Take a measurement, and switch the tracing mode of the agent if
+        needed. This is called periodically by the agent.
+        """
+        now = time.time()
+        cpu_time = _cpu_time()
+        overhead = self.agent.tracer.overhead
+
+        if self._last_time is None or now <= self._last_time:
+            self._reset(now, cpu_time, overhead)
+            return
+
+        elapsed = now - self._last_time
+        self.overhead = max(overhead - self._last_overhead, 0) / elapsed
+        self.load = (cpu_time - self._last_cpu_time) / elapsed
+
+        mode = self.agent.tracer_mode
+        if mode == TRACING and self.overhead > self.budget:
+            self._step_down(now)
+        elif (mode == SAMPLING and self.step_down_load is not None and
+                now - self.switched_at >= self.cooldown and
+                self.load < self.step_down_load * self.recovery_ratio):
+            self._step_up(now)
+
+        # the tracer may have been switched, so read its overhead again
+        self._reset(now, cpu_time, self.agent.tracer.overhead)
+
+    def _step_down(self, now):
+        if (self.switched_at is not None and
+                now - self.switched_at < self.cooldown):
+            # tracing had to be stepped down again right away; wait longer
+            # before stepping up the next time
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+        else:
+            self.cooldown = self.base_cooldown
+
+        self.step_down_load = self.load
+        self.switched_at = now
+        self.agent.logger.info(
+            "Tracing overhead {:.2%} is over the budget of {:.2%}; "
+            "switching to sampling.".format(self.overhead, self.budget))
+        self.agent.set_tracer_mode(SAMPLING)
+
+    def _step_up(self, now):
+        self.switched_at = now
+        self.agent.logger.info(
+            "Load dropped to {:.2f} from {:.2f}; switching to tracing.".format(
+                self.load, self.step_down_load))
+        self.agent.set_tracer_mode(TRACING)
+
+    def _reset(self, now, cpu_time, overhead):
+        self._last_time = now
+        self._last_cpu_time = cpu_time
+        self._last_overhead = overhead
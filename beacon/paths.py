@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Matching of source file paths against the paths Beacon should track."""
+import os
+import re
+
+# characters which make an exclude path a glob pattern
+GLOB_CHARS = re.compile(r'[*?\[]')
+
+
+class PathMatcher(object):
+    """Decide if a source file should be tracked by Beacon.
+
+    The matcher is compiled once into two regular expressions: one
+    alternation of all the include roots, and one alternation of all the
+    exclude paths, which is applied to the path relative to the matched root.
+    Evaluating it is linear in the length of the path.
+
+    The first include root is the project root: the paths of the files
+    inside it are given relative to it, and the paths of the files inside
+    the other roots only are given in full, so that files with the same
+    relative path under two roots are kept apart.
+
+    Exclude paths are relative to the include roots, and can be:
+        - subpaths, like `tests/` or `app/migrations`, which exclude the file
+          or directory and everything below it.
+        - glob patterns, like `*_test.py` or `**/site-packages`. In a pattern,
+          `*` and `?` do not match `/`, while `**` matches across
+          directories. A pattern without any `/` is matched against every
+          directory level, e.g. `*_test.py` anywhere inside the project.
+    """
+
+    def __init__(self, include_paths, exclude_paths=()):
+        """
+        :param include_paths: list of root directories that should be
+                              tracked, starting with the project root.
+
+        :param exclude_paths: list of subpaths or glob patterns, relative to
+                              the include roots, that should not be tracked.
+
+        :return: an instance of PathMatcher.
+        """
+        self.include_paths = [self._normalize_root(path)
+                              for path in include_paths if path]
+        self.exclude_paths = [path for path in exclude_paths if path]
+
+        # the prefix of the paths of the files inside the project root
+        self.project_prefix = None
+        if self.include_paths:
+            self.project_prefix = self.include_paths[0] + os.sep
+
+        self.include_regex = self._compile_include(self.include_paths)
+        self.exclude_regex = self._compile_exclude(self.exclude_paths)
+
+    def __repr__(self):
+        return "<PathMatcher include={!r} exclude={!r}>".format(
+            self.include_paths, self.exclude_paths)
+
+    def match(self, filename):
+        """Return the path of `filename` relative to the project root, or its
+        full path if it is only inside another include root, if it should be
+        tracked; return None otherwise.
+        """
+        match = self.include_regex.match(filename)
+        if match is None:
+            return None
+
+        path = match.group('path')
+        if self.exclude_regex is not None and self.exclude_regex.match(path):
+            return None
+
+        if filename.startswith(self.project_prefix):
+            return filename[len(self.project_prefix):]
+        return filename
+
+    @staticmethod
+    def _normalize_root(path):
+        return os.path.abspath(path).rstrip(os.sep)
+
+    @staticmethod
+    def _compile_include(include_paths):
+        if not include_paths:
+            # a regex that never matches
+            return re.compile(r'(?!)(?P<path>)')
+
+        # try longer roots first, so that nested roots win
+        roots = sorted(include_paths, key=len, reverse=True)
+        pattern = r'(?:{}){}(?P<path>.+)'.format(
+            '|'.join(re.escape(root) for root in roots), re.escape(os.sep))
+        return re.compile(pattern, re.DOTALL)
+
+    @classmethod
+    def _compile_exclude(cls, exclude_paths):
+        if not exclude_paths:
+            return None
+
+        alternatives = []
+        for path in exclude_paths:
+            path = path.strip('/')
+            if GLOB_CHARS.search(path):
+                pattern = cls._translate_glob(path)
+                if '/' not in path:
+                    pattern = r'(?:.*/)?' + pattern
+            else:
+                pattern = re.escape(path)
+            alternatives.append(pattern)
+
+        pattern = r'(?:{})(?:/|$)'.format('|'.join(alternatives))
+        return re.compile(pattern, re.DOTALL)
+
+    @staticmethod
+    def _translate_glob(pattern):
+        """Translate a glob pattern to a regular expression."""
+        index, length = 0, len(pattern)
+        result = []
+        while index < length:
+            char = pattern[index]
+            index += 1
+            if char == '*':
+                if pattern[index:index + 2] == '*/':
+                    index += 2
+                    result.append('(?:.*/)?')
+                elif pattern[index:index + 1] == '*':
+                    index += 1
+                    result.append('.*')
+                else:
+                    result.append('[^/]*')
+            elif char == '?':
+                result.append('[^/]')
+            elif char == '[':
+                end = pattern.find(']', index)
+                if end < 0:
+                    result.append(re.escape(char))
+                else:
+                    body = pattern[index:end].replace('\\', '\\\\')
+                    if body.startswith('!'):
+                        body = '^' + body[1:]
+                    result.append('[{}]'.format(body))
+                    index = end + 1
+            else:
+                result.append(re.escape(char))
+        return ''.join(result)
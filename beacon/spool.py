@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""A file on disk which keeps the batches that could not be transmitted, so
+that they survive a restart of the application."""
+import errno
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from . import beacon_pb2, defaults
+
+# every record is the serialized batch, preceded by its length and the time
+# at which it was written
+RECORD_HEADER = struct.Struct('<IQ')
+
+
+class Spool(object):
+    def __init__(self, path, **options):
+        """The Spool appends batches to a file as length-delimited records.
+
+        The records are read back through a memory map, and removed from the
+        file once they have been transmitted, by writing the ones that are
+        left to a new file, which replaces the spool.
+
+        :param path: path of the spool file.
+
+        :param max_size: the maximum size of the file, in bytes; batches that
+                         would make it larger are dropped.
+
+        :param max_age: the number of seconds after which batches in the
+                        spool are dropped.
+
+        :param max_batch_size: the size in bytes up to which batches are
+                               merged on drain.
+
+        :return: an instance of Spool.
+        """
+        self.path = path
+
+        self.max_size = options.get('max_size') or defaults.SPOOL_MAX_SIZE
+
+        self.max_age = options.get('max_age') or defaults.SPOOL_MAX_AGE
+
+        self.max_batch_size = (options.get('max_batch_size') or
+                               defaults.MAX_BATCH_SIZE)
+
+        # the lock for the threads of this process; the file is locked as
+        # well, for the other processes
+        self.lock = threading.Lock()
+
+        # the lock held while draining the spool; a lock file next to the
+        # spool keeps other processes from draining it at the same time
+        self.drain_lock = threading.Lock()
+
+    def append(self, batch):
+        """Append a batch to the spool. Return False if the batch was dropped,
+        because the spool is full.
+        """
+        data = batch.SerializeToString()
+        record = RECORD_HEADER.pack(len(data), int(time.time())) + data
+
+        with self._locked() as fd:
+            if os.fstat(fd).st_size + len(record) > self.max_size:
+                return False
+            os.lseek(fd, 0, os.SEEK_END)
+            os.write(fd, record)
+        return True
+
+    def has_records(self):
+        """Return whether there are any batches in the spool."""
+        try:
+            return os.path.getsize(self.path) > 0
+        except OSError:
+            return False
+
+    def drain(self, transmit):
+        """Transmit the batches in the spool, and remove them from it.
+
+        The batches with counts are coalesced into one per event type first,
+        up to `max_batch_size` bytes each.
+        The batches which were written while draining, or which could not be
+        transmitted, are kept. Only one process drains the spool at a time;
+        the others return right away.
+
+        :param transmit: function that transmits a batch, and raises an
+                         exception if that fails.
+
+        :return: the number of batches transmitted.
+        """
+        with self._draining() as is_draining:
+            if not is_draining:
+                return 0
+            return self._drain(transmit)
+
+    def _drain(self, transmit):
+        with self._locked() as fd:
+            end = os.fstat(fd).st_size
+            records = self._read(fd, end)
+
+        now = time.time()
+        batches = [(written_at, beacon_pb2.Batch.FromString(data))
+                   for (written_at, data) in records
+                   if now - written_at <= self.max_age]
+
+        sent = 0
+        failed = []
+        for written_at, batch in self._coalesce(batches, self.max_batch_size):
+            if not failed:
+                try:
+                    transmit(batch)
+                except Exception:
+                    pass
+                else:
+                    sent += 1
+                    continue
+            failed.append((written_at, batch))
+
+        self._compact(end, failed)
+        return sent
+
+    def after_fork_in_child(self):
+        """Replace the locks in a forked child, where the thread that might
+        have held them is gone.
+        """
+        self.lock = threading.Lock()
+        self.drain_lock = threading.Lock()
+
+    @staticmethod
+    def _coalesce(batches, max_size):
+        """Merge the batches with counts into one per event type, and return
+        them along with the presence batches, which are kept as they are.
+        The buckets of the histograms of a location are added up. Once a
+        merged batch would grow beyond `max_size` bytes, the next batches of
+        its event type are merged into a new one.
+
+        :param batches: two-tuples of the time a batch was written, and the
+                        batch; a merged batch keeps the earliest time.
+        """
+        # the merged batch of every event type, as a list of the time it was
+        # written, the batch, its counts, and the sum of the sizes of the
+        # batches merged into it, which bounds its size
+        merged = OrderedDict()
+        result = []
+        for written_at, batch in batches:
+            if batch.presence:
+                result.append((written_at, batch))
+                continue
+
+            size = batch.ByteSize()
+            group = merged.get(batch.event_type)
+            if group is not None and group[3] + size > max_size:
+                result.append(Spool._merged_batch(*group[:3]))
+                group = None
+
+            if group is None:
+                target = beacon_pb2.Batch()
+                target.CopyFrom(batch)
+                del target.events[:]
+                group = merged[batch.event_type] = [written_at, target,
+                                                    OrderedDict(), 0]
+            else:
+                group[0] = min(group[0], written_at)
+                target = group[1]
+                target.timestamp = min(target.timestamp, batch.timestamp)
+                target.sampled = target.sampled or batch.sampled
+                target.tracer_mode = batch.tracer_mode
+                target.mode_changes.extend(batch.mode_changes)
+                target.dropped_events += batch.dropped_events
+            group[3] += size
+
+            type_counts = group[2]
+            for event in batch.events:
+                key = (event.file_path, event.location)
+                total = type_counts.get(key)
+                if total is None:
+                    type_counts[key] = [event.count, list(event.buckets)]
+                    continue
+                total[0] += event.count
+                buckets = total[1]
+                buckets.extend([0] * (len(event.buckets) - len(buckets)))
+                for bucket, count in enumerate(event.buckets):
+                    buckets[bucket] += count
+
+        for group in merged.values():
+            result.append(Spool._merged_batch(*group[:3]))
+        return result
+
+    @staticmethod
+    def _merged_batch(written_at, target, counts):
+        """Add the merged counts to a batch, and return it with the time it
+        was written.
+        """
+        target.events.extend(
+            beacon_pb2.Event(file_path=filename, location=location,
+                             count=count, buckets=buckets)
+            for ((filename, location), (count, buckets)) in counts.items())
+        return written_at, target
+
+    def _compact(self, end, kept):
+        """Replace the spool with the batches in `kept`, along with the time
+        they were written, and the records which were written after the first
+        `end` bytes.
+        """
+        temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with self._locked() as fd:
+            size = os.fstat(fd).st_size
+            with open(temp_path, 'wb') as temp:
+                for written_at, batch in kept:
+                    data = batch.SerializeToString()
+                    temp.write(RECORD_HEADER.pack(len(data), written_at) +
+                               data)
+                for written_at, data in self._read(fd, size, start=end):
+                    temp.write(RECORD_HEADER.pack(len(data), written_at) +
+                               data)
+            os.rename(temp_path, self.path)
+
+    @staticmethod
+    def _read(fd, end, start=0):
+        """Return the records between the offsets `start` and `end` of the
+        file, as two-tuples of the time they were written and their data. A
+        record which was cut short, by a crash while it was written, ends
+        the spool.
+        """
+        if end <= start:
+            return []
+
+        records = []
+        spool = mmap.mmap(fd, end, access=mmap.ACCESS_READ)
+        try:
+            offset = start
+            while offset + RECORD_HEADER.size <= end:
+                length, written_at = RECORD_HEADER.unpack_from(spool, offset)
+                offset += RECORD_HEADER.size
+                if offset + length > end:
+                    break
+                records.append((written_at, spool[offset:offset + length]))
+                offset += length
+        finally:
+            spool.close()
+        return records
+
+    @contextmanager
+    def _draining(self):
+        """Try to take the lock on draining the spool, without blocking, and
+        yield whether it was taken.
+        """
+        if not self.drain_lock.acquire(False):
+            yield False
+            return
+
+        fd = None
+        try:
+            if fcntl is not None:
+                fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT,
+                             0o600)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError) as e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                    yield False
+                    return
+            yield True
+        finally:
+            if fd is not None:
+                os.close(fd)
+            self.drain_lock.release()
+
+    @contextmanager
+    def _locked(self):
+        """Open the spool file, and lock it against the other threads and
+        processes. If the file was replaced while waiting for the lock, the
+        new one is opened.
+        """
+        with self.lock:
+            while True:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    replaced = (os.fstat(fd).st_ino !=
+                                os.stat(self.path).st_ino)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        os.close(fd)
+                        raise
+                    replaced = True
+                if not replaced:
+                    break
+                os.close(fd)
+
+            try:
+                yield fd
+            finally:
+                os.close(fd)
@@ -3,8 +3,33 @@
 
 """Python tracer for raw data collection."""
 
-import re
+import dis
+import inspect
+import logging
 import sys
+import threading
+from collections import namedtuple
+
+from . import defaults
+from .exceptions import ConfigurationError
+from .paths import PathMatcher
+from .utils import ContextVar, intern, perf_counter
+
+logger = logging.getLogger('beacon')
+
+# the capture modes of the exception tracer: all the exceptions raised in
+# project code are counted, or only the ones that were not handled
+RAISED = 'raised'
+UNHANDLED = 'unhandled'
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+# flags of the code objects whose frames can be suspended and resumed, which
+# the profiler reports as a new `call` on every resume
+RESUMABLE_FLAGS = (getattr(inspect, 'CO_GENERATOR', 0) |
+                   getattr(inspect, 'CO_COROUTINE', 0) |
+                   getattr(inspect, 'CO_ITERABLE_COROUTINE', 0) |
+                   getattr(inspect, 'CO_ASYNC_GENERATOR', 0))
 
 
 class Tracer(object):
@@ -23,12 +48,9 @@ class Tracer(object):
         # is the tracer currently stopped?
         self.stopped = True
 
-        # the threading module to use, if any. This needs to be set after the
-        # tracer has been initialized.
-        self.threading = None
-
-        # store reference to the current thread, if any.
-        self.thread = None
+        # is the tracer currently paused? A paused tracer does not capture
+        # anything, but can be resumed cheaply.
+        self.paused = False
 
         # initialize attributes needed by the tracer
         self.buffer = buffer
@@ -36,8 +58,92 @@ class Tracer(object):
         # TODO: ensure project root is never None.
         self.project_root = options.get('project_root')
 
+        # additional root directories to track, besides the project root
+        self.include_paths = list(options.get('include_paths') or [])
+
+        # subpaths and glob patterns, relative to the tracked roots, that
+        # should not be tracked
+        self.exclude_paths = list(options.get('exclude_paths') or [])
+
         # prepare the path matcher
-        self.path_matcher = self._prepare_path_matcher(self.project_root)
+        self.path_matcher = PathMatcher(
+            [self.project_root] + self.include_paths, self.exclude_paths)
+
+        # the capture decision for each code object is taken once and
+        # remembered here, so that repeated calls into the same function only
+        # cost a dictionary lookup. The cache maps the code objects which are
+        # captured to their location ID in the buffer, and all others to None.
+        # The cache is cleared when it grows beyond `capture_cache_size`
+        # entries.
+        self._capture_cache = {}
+        self.capture_cache_size = (options.get('capture_cache_size') or
+                                   defaults.CAPTURE_CACHE_SIZE)
+
+        # the path of each source file relative to the project root, or its
+        # full path if it is inside another tracked root, or None if the file
+        # is not tracked. The paths are interned, so that every
+        # location in a file shares the same string.
+        self._relative_paths = {}
+
+        # generators and coroutines are only counted when they are entered
+        # for the first time. Resumes are counted in `resume_buffer`, if
+        # given, and are ignored otherwise.
+        self.resume_buffer = options.get('resume_buffer')
+
+        # the instruction offset at which each captured resumable code object
+        # is first entered, and its location ID in the resume buffer; the
+        # entries are cleared along with the capture cache.
+        self._resumable = {}
+
+        # with a `histogram_buffer`, the duration of every call of a captured
+        # function is recorded in it, in the histogram of the function;
+        # generators and coroutines are not timed. `_timed` maps the code
+        # objects which are timed to their location ID in the histogram
+        # buffer, and is cleared along with the capture cache. The calls
+        # which have not returned yet are kept on a stack per thread.
+        self.histogram_buffer = options.get('histogram_buffer')
+        self._timed = {}
+        self._calls = threading.local()
+
+        # in presence mode, the buffer only records whether each location was
+        # seen. A code object is then skipped, through its entry in the
+        # capture cache, once it has been seen, until the buffer is flushed;
+        # `_armed` remembers the location IDs of the skipped code objects.
+        self.presence = options.get('presence', False)
+        self._armed = {}
+        if self.presence:
+            self.buffer.flush_callbacks.append(self.rearm)
+
+        # counters for tuning the size of the capture cache
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # when `measure_overhead` is set, the total time spent in the tracer
+        # is accumulated in `overhead`, in seconds.
+        self.measure_overhead = options.get('measure_overhead', False)
+        self.overhead = 0.0
+
+        # in scoped mode, only the code run inside a tracing scope is traced.
+        # `_scope_depth` is the nesting depth of the scopes of the running
+        # thread or task; the profiler is installed on a thread while any of
+        # its tasks is inside a scope, and `_thread_scopes` holds the number
+        # of such scopes, and the profiler they replaced.
+        self.scoped = options.get('scoped', False)
+        self._scope_depth = ContextVar('beacon_scope_depth', default=0)
+        self._thread_scopes = threading.local()
+
+        # the function which handles the events of the profiler, and the one
+        # installed with `sys.setprofile`
+        if self.histogram_buffer is not None:
+            self._handler = self._histogram_trace
+        else:
+            self._handler = self._trace
+        if self.scoped:
+            self._profiler = self._scoped_trace
+        elif self.measure_overhead:
+            self._profiler = self._timed_trace
+        else:
+            self._profiler = self._handler
 
     def __repr__(self):
         """String representation of this Tracer."""
@@ -51,61 +157,895 @@ class Tracer(object):
         other events, we exit without doing anything.
         """
 
-        filename, lineno = frame.f_code.co_filename, frame.f_lineno
-
-        if (self.stopped and sys.getprofile() == self._trace):
-            sys.setprofile(None)
+        if self.stopped:
+            if sys.getprofile() == self._profiler:
+                sys.setprofile(None)
             return None
 
-        if event == 'call' and self._should_capture(filename):
-            self._capture(filename, lineno)
+        if event != 'call' or self.paused:
+            return self._trace
+
+        code = frame.f_code
+        try:
+            loc_id = self._capture_cache[code]
+            self.cache_hits += 1
+        except KeyError:
+            loc_id = self._cache_capture_decision(code)
+
+        if loc_id is not None:
+            resumable = self._resumable.get(code)
+            if resumable is None or frame.f_lasti <= resumable[0]:
+                self.buffer.increment(loc_id)
+                if self.presence:
+                    self._armed[code] = loc_id
+                    self._capture_cache[code] = None
+            elif resumable[1] is not None:
+                self.resume_buffer.increment(resumable[1])
 
         return self._trace
 
+    def _histogram_trace(self, frame, event, arg):
+        """The trace function which is passed to `sys.setprofile` when the
+        durations of the calls are recorded. A call is timed from its `call`
+        event to the `return` event of its frame, which is also raised when
+        the call ends with an exception.
+        """
+        self._trace(frame, event, arg)
+
+        if event == 'call':
+            if not self.paused and not self.stopped:
+                hist_id = self._timed.get(frame.f_code)
+                if hist_id is not None:
+                    self._enter(frame, hist_id)
+        elif event == 'return' and frame.f_code in self._timed:
+            self._exit(frame)
+
+        return self._histogram_trace
+
+    def _enter(self, key, hist_id):
+        """Start timing a call, identified by its frame, or code object."""
+        try:
+            stack = self._calls.stack
+        except AttributeError:
+            stack = self._calls.stack = []
+
+        # the stack holds three items per call, rather than a tuple, so that
+        # nothing is allocated for it
+        stack.append(key)
+        stack.append(hist_id)
+        stack.append(perf_counter())
+
+    def _exit(self, key):
+        """Stop timing a call, and record its duration in the histogram
+        buffer. The calls started after it, which were not seen to return
+        because the tracer was paused meanwhile, are forgotten; so is a call
+        that started before the tracer.
+        """
+        end = perf_counter()
+        stack = getattr(self._calls, 'stack', None)
+        if not stack:
+            return
+
+        index = len(stack) - 3
+        while index >= 0 and stack[index] is not key:
+            index -= 3
+        if index < 0:
+            return
+
+        hist_id, start = stack[index + 1], stack[index + 2]
+        del stack[index:]
+        self.histogram_buffer.record(hist_id, end - start)
+
+    def _timed_trace(self, frame, event, arg):
+        """The function which is passed to `sys.setprofile` when the overhead
+        of the tracer is measured. A paused tracer is not timed, so that
+        pausing it sheds the cost of measuring as well.
+        """
+        if self.paused and not self.stopped:
+            return self._timed_trace
+
+        start = perf_counter()
+        self._handler(frame, event, arg)
+        self.overhead += perf_counter() - start
+        return self._timed_trace
+
+    def _scoped_trace(self, frame, event, arg):
+        """The function which is passed to `sys.setprofile` in scoped mode.
+        Other tasks may run on a thread while one of them is inside a scope,
+        so the events of those tasks are skipped here.
+        """
+        if self.stopped or self._scope_depth.get():
+            self._handler(frame, event, arg)
+        return self._scoped_trace
+
     def start(self):
         """Start the tracer.
 
+        The profiler is installed on every thread: on all running threads
+        where the interpreter allows it (Python 3.12+), and otherwise on the
+        current thread only; and on all threads started from now on. In
+        scoped mode, it is installed by `enter_scope` instead.
+
         Return a Python function that can be passed to `sys.setprofile`.
         """
         self.stopped = False
-        if self.threading:
-            if self.thread is None:
-                self.thread = self.threading.currentThread()
-            else:
-                if self.thread.ident != self.threading.currentThread().ident:
-                    return self._trace
-        sys.setprofile(self._trace)
-        return self._trace
+        self.paused = False
+        if self.scoped:
+            if getattr(self._thread_scopes, 'count', 0):
+                # the tracer was started inside a scope
+                self._install_in_scope()
+        elif hasattr(threading, 'setprofile_all_threads'):
+            threading.setprofile_all_threads(self._profiler)
+        else:
+            threading.setprofile(self._profiler)
+            sys.setprofile(self._profiler)
+        return self._profiler
 
     def stop(self):
         """Stop this tracer.
+
+        New threads are no longer profiled. The profiler is removed from all
+        threads right away where the interpreter allows it (Python 3.12+);
+        otherwise, from the current thread right away, and from every other
+        thread on its next event.
         """
+        if self.stopped:
+            return
+
         self.stopped = True
 
-        if (self.threading and
-                self.thread.ident != self.threading.currentThread().ident):
+        if (hasattr(threading, 'setprofile_all_threads') and
+                not self.scoped):
+            threading.setprofile_all_threads(None)
+        else:
+            threading.setprofile(None)
+        if sys.getprofile() == self._profiler:
+            sys.setprofile(None)
+
+    def pause(self):
+        """Pause this tracer.
+
+        On Python 3.12+, the profiler is removed from all threads, and
+        installed again on resume. On older versions, and in scoped mode, it
+        could not be installed again on the other running threads, so it
+        stays installed, and returns right away on every event.
+        """
+        if self.stopped or self.paused:
+            return
+
+        self.paused = True
+        if hasattr(threading, 'setprofile_all_threads') and not self.scoped:
+            threading.setprofile_all_threads(None)
+
+    def resume(self):
+        """Resume this tracer after it has been paused.
+        """
+        if self.stopped or not self.paused:
+            return
+
+        self.paused = False
+        if hasattr(threading, 'setprofile_all_threads') and not self.scoped:
+            threading.setprofile_all_threads(self._profiler)
+
+    def enter_scope(self):
+        """Enter a tracing scope in the current thread or task, and return a
+        token to pass to `exit_scope`.
+
+        In scoped mode, the profiler is installed on the thread when the
+        first scope on it is entered; otherwise, every thread is traced
+        already.
+        """
+        if not self.scoped:
+            return None
+
+        token = self._scope_depth.set(self._scope_depth.get() + 1)
+        count = getattr(self._thread_scopes, 'count', 0)
+        self._thread_scopes.count = count + 1
+        if not count and not self.stopped:
+            self._install_in_scope()
+        return token
+
+    def exit_scope(self, token):
+        """Exit a tracing scope, and remove the profiler from the thread when
+        the last scope on it is exited.
+        """
+        if not self.scoped:
             return
 
+        self._scope_depth.reset(token)
+        count = self._thread_scopes.count - 1
+        self._thread_scopes.count = count
+        if not count and sys.getprofile() == self._profiler:
+            sys.setprofile(self._thread_scopes.previous)
+
+    def _install_in_scope(self):
+        self._thread_scopes.previous = sys.getprofile()
+        sys.setprofile(self._profiler)
+
+    def rearm(self):
+        """Capture the code objects which were skipped after being seen
+        again. This is called when the buffer is flushed in presence mode.
+        """
+        self._capture_cache.update(self._armed)
+
+    def after_fork_in_child(self):
+        """Restore this tracer in the child process after a fork.
+
+        The profiler of the forking thread, and the one for new threads, are
+        inherited by the child. The buffers assign new location IDs in the
+        child, so the ones in the capture cache, and those of the calls being
+        timed, are forgotten.
+        """
+        self._clear_capture_cache()
+        self._calls = threading.local()
+
+    def _clear_capture_cache(self):
+        """Clear the capture cache, along with the entries kept for the code
+        objects in it.
+        """
+        self._capture_cache.clear()
+        self._resumable.clear()
+        self._armed.clear()
+        self._timed.clear()
+
     def _should_capture(self, filename):
         """Take a frame and determine if we should capture it.
 
-        For each filename, we should capture if it satisfies at least one of
-        these conditions:
-            - it starts with `self.project_root`
+        For each filename, we should capture if it satisfies both of these
+        conditions:
+            - it is inside `self.project_root` or one of `self.include_paths`
+            - it is not excluded by `self.exclude_paths`
+        """
+        return self._relative_path(filename) is not None
+
+    def _relative_path(self, filename):
+        """Return the interned path of `filename` relative to the project root,
+        or its full path if it is inside another tracked root, or None if it
+        is not tracked. This is computed once per file.
+        """
+        try:
+            return self._relative_paths[filename]
+        except KeyError:
+            pass
+
+        if len(self._relative_paths) >= self.capture_cache_size:
+            self._relative_paths.clear()
+
+        path = self.path_matcher.match(filename)
+        if path is not None:
+            path = intern(path)
+        self._relative_paths[filename] = path
+        return path
+
+    def _cache_capture_decision(self, code):
+        """Decide whether calls into `code` should be captured, and remember
+        the decision in the capture cache.
+        """
+        self.cache_misses += 1
+
+        if len(self._capture_cache) >= self.capture_cache_size:
+            self._clear_capture_cache()
+
+        capture = None
+        if self._should_capture(code.co_filename):
+            capture = self._capture_value(code)
+        self._capture_cache[code] = capture
+        return capture
+
+    def _capture_value(self, code):
+        """Return the value to remember in the capture cache for a code object
+        which is captured: the ID of its location in the buffer.
+
+        Calls are located at the first line of the function, which is where
+        the profiler reports them when they start.
+        """
+        filename = self._relative_path(code.co_filename)
+        if code.co_flags & RESUMABLE_FLAGS:
+            resume_id = None
+            if self.resume_buffer is not None:
+                resume_id = self.resume_buffer.intern(filename,
+                                                      code.co_firstlineno)
+            self._resumable[code] = (self._entry_offset(code), resume_id)
+        elif self.histogram_buffer is not None:
+            self._timed[code] = self.histogram_buffer.intern(
+                filename, code.co_firstlineno)
+
+        return self.buffer.intern(filename, code.co_firstlineno)
+
+    @staticmethod
+    def _entry_offset(code):
+        """Return the last instruction offset of a frame of `code` when it is
+        entered for the first time; any later `call` is a resume.
+
+        On Python 3.11+, this is the offset of the first `RESUME` instruction;
+        before that, a frame that has not started has an offset of -1.
         """
-        return self.path_matcher.search(filename)
+        if not hasattr(dis, 'get_instructions'):
+            # Python 2
+            return -1
+
+        for instruction in dis.get_instructions(code):
+            if instruction.opname == 'RESUME':
+                return instruction.offset
+        return -1
+
+    def cache_info(self):
+        """Return the hit/miss statistics of the capture cache."""
+        return CacheInfo(self.cache_hits, self.cache_misses,
+                         self.capture_cache_size, len(self._capture_cache))
 
     def _capture(self, filename, lineno):
         """Take the relevant data for this frame and store it in the
         data store.
 
-        `filename` is the absolute path of the file where the execution
-            has happened.
+        `filename` is the path of the file where the execution has
+            happened, relative to the project root.
         `lineno` is an integer denoting the exact location of the
             function call.
         """
         self.buffer.add(filename, lineno)
 
-    def _prepare_path_matcher(self, project_root):
-        pattern = r'^{}(?P<path>.*)'.format(re.escape(project_root))
-        return re.compile(pattern)
+
+class MonitoringTracer(Tracer):
+    """Python tracer for Beacon, built on `sys.monitoring` (PEP 669).
+
+    Only the `PY_START` event is registered, and the callback returns
+    `sys.monitoring.DISABLE` for code objects that Beacon does not capture, so
+    that code outside the project root costs nothing after its first call.
+    Events are stored in the same buffer as the profile based tracer.
+
+    `PY_START` is not raised when a generator or coroutine resumes; resumes
+    are tracked through the `PY_RESUME` event when there is a resume buffer.
+    Likewise, calls are timed up to their `PY_RETURN` or `PY_UNWIND` event
+    when there is a histogram buffer.
+
+    This tracer is only available on Python 3.12 and above.
+    """
+
+    TOOL_NAME = 'beacon'
+
+    def __init__(self, buffer, **options):
+        super(MonitoringTracer, self).__init__(buffer, **options)
+
+        # the `sys.monitoring` tool identifier used by this tracer
+        self.tool_id = options.get('monitoring_tool_id',
+                                   defaults.MONITORING_TOOL_ID)
+
+        # the callbacks of the events this tracer is notified of
+        if self.measure_overhead:
+            self.callbacks = {'PY_START': self._timed_on_py_start,
+                              'PY_RESUME': self._timed_on_py_resume,
+                              'PY_RETURN': self._timed_on_py_return,
+                              'PY_UNWIND': self._timed_on_py_unwind}
+        else:
+            self.callbacks = {'PY_START': self._on_py_start,
+                              'PY_RESUME': self._on_py_resume,
+                              'PY_RETURN': self._on_py_return,
+                              'PY_UNWIND': self._on_py_unwind}
+        if self.resume_buffer is None:
+            del self.callbacks['PY_RESUME']
+        if self.histogram_buffer is None:
+            del self.callbacks['PY_RETURN']
+            del self.callbacks['PY_UNWIND']
+
+        # whether rearming was skipped, because of another tool
+        self._rearm_skipped = False
+
+    @classmethod
+    def is_available(cls, tool_id=defaults.MONITORING_TOOL_ID):
+        """Return True if `sys.monitoring` can be used by this tracer."""
+        monitoring = getattr(sys, 'monitoring', None)
+        return monitoring is not None and monitoring.get_tool(tool_id) is None
+
+    def _on_py_start(self, code, instruction_offset):
+        """The callback for the `PY_START` event of `sys.monitoring`."""
+        try:
+            loc_id = self._capture_cache[code]
+            self.cache_hits += 1
+        except KeyError:
+            loc_id = self._cache_capture_decision(code)
+
+        if loc_id is None:
+            return sys.monitoring.DISABLE
+
+        self.buffer.increment(loc_id)
+        if self.presence:
+            # seen; the event is enabled again when the buffer is flushed
+            return sys.monitoring.DISABLE
+
+        if self.histogram_buffer is not None:
+            hist_id = self._timed.get(code)
+            if hist_id is not None:
+                self._enter(code, hist_id)
+
+    def _on_py_resume(self, code, instruction_offset):
+        """The callback for the `PY_RESUME` event of `sys.monitoring`."""
+        try:
+            loc_id = self._capture_cache[code]
+        except KeyError:
+            loc_id = self._cache_capture_decision(code)
+
+        resumable = self._resumable.get(code)
+        if loc_id is None or resumable is None:
+            return sys.monitoring.DISABLE
+
+        self.resume_buffer.increment(resumable[1])
+
+    def _on_py_return(self, code, instruction_offset, retval):
+        """The callback for the `PY_RETURN` event of `sys.monitoring`."""
+        if code in self._timed:
+            self._exit(code)
+        elif self._capture_cache.get(code, code) is None:
+            # not captured, so never timed
+            return sys.monitoring.DISABLE
+
+    def _on_py_unwind(self, code, instruction_offset, exception):
+        """The callback for the `PY_UNWIND` event of `sys.monitoring`, which
+        cannot be disabled.
+        """
+        if code in self._timed:
+            self._exit(code)
+
+    def _timed_on_py_start(self, code, instruction_offset):
+        """The callback for the `PY_START` event when the overhead of the
+        tracer is measured.
+        """
+        start = perf_counter()
+        result = self._on_py_start(code, instruction_offset)
+        self.overhead += perf_counter() - start
+        return result
+
+    def _timed_on_py_resume(self, code, instruction_offset):
+        """The callback for the `PY_RESUME` event when the overhead of the
+        tracer is measured.
+        """
+        start = perf_counter()
+        result = self._on_py_resume(code, instruction_offset)
+        self.overhead += perf_counter() - start
+        return result
+
+    def _timed_on_py_return(self, code, instruction_offset, retval):
+        """The callback for the `PY_RETURN` event when the overhead of the
+        tracer is measured.
+        """
+        start = perf_counter()
+        result = self._on_py_return(code, instruction_offset, retval)
+        self.overhead += perf_counter() - start
+        return result
+
+    def _timed_on_py_unwind(self, code, instruction_offset, exception):
+        """The callback for the `PY_UNWIND` event when the overhead of the
+        tracer is measured.
+        """
+        start = perf_counter()
+        self._on_py_unwind(code, instruction_offset, exception)
+        self.overhead += perf_counter() - start
+
+    def rearm(self):
+        """Enable the `PY_START` events which were disabled after the code was
+        seen. This is called when the buffer is flushed in presence mode.
+
+        Disabled events can only be enabled again for every `sys.monitoring`
+        tool at once, so this is skipped while a tool other than Beacon's is
+        in use, like a debugger or coverage, whose disabled events must stay
+        off; the code seen then stays disabled until the tool is gone. Code
+        outside of the project is disabled again on its next call.
+        """
+        if self.stopped:
+            return
+
+        if not self._is_sole_tool():
+            if not self._rearm_skipped:
+                logger.warning(
+                    "Another sys.monitoring tool is in use. Code seen in "
+                    "presence mode is not traced again until it is gone.")
+                self._rearm_skipped = True
+            return
+
+        self._rearm_skipped = False
+        sys.monitoring.restart_events()
+
+    @staticmethod
+    def _is_sole_tool():
+        """Whether no `sys.monitoring` tool other than Beacon's is in use."""
+        for tool_id in range(6):
+            name = sys.monitoring.get_tool(tool_id)
+            if name is not None and not name.startswith(
+                    MonitoringTracer.TOOL_NAME):
+                return False
+        return True
+
+    @property
+    def events(self):
+        """The set of `sys.monitoring` events this tracer is notified of."""
+        events = 0
+        for event in self.callbacks:
+            events |= getattr(sys.monitoring.events, event)
+        return events
+
+    def start(self):
+        """Start the tracer.
+
+        Register the `PY_START` callback, the `PY_RESUME` one if resumes are
+        counted, and the `PY_RETURN` and `PY_UNWIND` ones if calls are timed,
+        with `sys.monitoring`.
+        """
+        callback = self.callbacks['PY_START']
+        if not self.stopped:
+            return callback
+
+        monitoring = sys.monitoring
+        monitoring.use_tool_id(self.tool_id, self.TOOL_NAME)
+        for event, event_callback in self.callbacks.items():
+            monitoring.register_callback(
+                self.tool_id, getattr(monitoring.events, event),
+                event_callback)
+        monitoring.set_events(self.tool_id, self.events)
+        self.stopped = False
+        self.paused = False
+        return callback
+
+    def stop(self):
+        """Stop this tracer, and release the `sys.monitoring` tool.
+        """
+        if self.stopped:
+            return
+
+        self.stopped = True
+
+        monitoring = sys.monitoring
+        monitoring.set_events(self.tool_id, monitoring.events.NO_EVENTS)
+        for event in self.callbacks:
+            monitoring.register_callback(
+                self.tool_id, getattr(monitoring.events, event), None)
+        monitoring.free_tool_id(self.tool_id)
+
+    def pause(self):
+        """Pause this tracer, by turning off its events.
+        """
+        if self.stopped or self.paused:
+            return
+
+        self.paused = True
+        sys.monitoring.set_events(self.tool_id,
+                                  sys.monitoring.events.NO_EVENTS)
+
+    def resume(self):
+        """Resume this tracer, by turning its events back on.
+        """
+        if self.stopped or not self.paused:
+            return
+
+        self.paused = False
+        sys.monitoring.set_events(self.tool_id, self.events)
+
+
+class SamplingTracer(Tracer):
+    """Statistical sampling tracer for Beacon.
+
+    Instead of hooking into every function call, a background thread wakes
+    up every `sample_interval` seconds and walks the stacks of all running
+    threads via `sys._current_frames()`. Each sample is attributed to the
+    innermost frame that belongs to the project, and added to the same buffer
+    as the deterministic tracers. The buffer is marked as sampled while this
+    tracer runs, so that the counts are flagged as estimates in the batches.
+
+    The time spent taking samples is always accumulated in `overhead`.
+    """
+
+    def __init__(self, buffer, **options):
+        super(SamplingTracer, self).__init__(buffer, **options)
+
+        # number of seconds between two consecutive samples
+        self.sample_interval = (options.get('sample_interval') or
+                                defaults.SAMPLE_INTERVAL)
+
+        # the background thread taking the samples, and an event to stop it
+        self.sampler = None
+        self._stop_event = threading.Event()
+
+    def _sample(self):
+        """Take one sample of the stacks of all threads, except the
+        sampler's own.
+        """
+        sampler_ident = threading.current_thread().ident
+
+        for ident, frame in sys._current_frames().items():
+            if ident == sampler_ident:
+                continue
+
+            # find the innermost frame that belongs to the project
+            while frame is not None:
+                code = frame.f_code
+                try:
+                    capture = self._capture_cache[code]
+                    self.cache_hits += 1
+                except KeyError:
+                    capture = self._cache_capture_decision(code)
+
+                if capture is not None:
+                    self._capture(capture, frame.f_lineno)
+                    break
+                frame = frame.f_back
+
+    def _capture_value(self, code):
+        """Samples are located at the line being executed, so only the
+        relative path of the code object is remembered.
+        """
+        return self._relative_path(code.co_filename)
+
+    def _run(self):
+        while not self._stop_event.wait(self.sample_interval):
+            if self.paused:
+                continue
+            start = perf_counter()
+            self._sample()
+            self.overhead += perf_counter() - start
+
+    def start(self):
+        """Start the sampler thread.
+        """
+        if not self.stopped:
+            return self._sample
+
+        self.stopped = False
+        self.paused = False
+        self.buffer.sampled = True
+        self._stop_event.clear()
+        self._start_sampler()
+        return self._sample
+
+    def _start_sampler(self):
+        self.sampler = threading.Thread(target=self._run,
+                                        name='beacon-sampler')
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def stop(self):
+        """Stop the sampler thread.
+        """
+        if self.stopped:
+            return
+
+        self.stopped = True
+        self.buffer.sampled = False
+        self._stop_event.set()
+        if self.sampler is not threading.current_thread():
+            self.sampler.join()
+        self.sampler = None
+
+    def after_fork_in_child(self):
+        """Restart the sampler thread in the child process after a fork, since
+        threads do not survive a fork.
+        """
+        super(SamplingTracer, self).after_fork_in_child()
+        if self.stopped:
+            return
+
+        self._stop_event = threading.Event()
+        self._start_sampler()
+
+    def pause(self):
+        """Pause this tracer; the sampler thread stops taking samples.
+        """
+        if self.stopped or self.paused:
+            return
+
+        self.paused = True
+        self.buffer.sampled = False
+
+    def resume(self):
+        """Resume taking samples after this tracer has been paused.
+        """
+        if self.stopped or not self.paused:
+            return
+
+        self.paused = False
+        self.buffer.sampled = True
+
+
+class ExceptionTracer(Tracer):
+    """Exception tracer for Beacon.
+
+    Counts the exceptions raised in project code, by the file and line where
+    they were raised. Exceptions raised repeatedly from the same place are
+    only counted; no traceback is built or stored for them.
+
+    On Python 3.12+, this uses the `RAISE` event of `sys.monitoring`, which
+    sees every exception, including the ones that are handled. On older
+    versions, only the exceptions that are not handled are seen, through
+    `sys.excepthook` and `threading.excepthook`; `capture_mode` tells which,
+    and is reported in the batches of the exception buffer. Either way, an
+    exception is only counted if the frame where it was raised is project
+    code.
+    """
+
+    TOOL_NAME = 'beacon-exceptions'
+
+    def __init__(self, buffer, **options):
+        super(ExceptionTracer, self).__init__(buffer, **options)
+
+        # the `sys.monitoring` tool identifier used by this tracer, if any
+        self.tool_id = options.get('exception_monitoring_tool_id',
+                                   defaults.EXCEPTION_MONITORING_TOOL_ID)
+        self.use_monitoring = MonitoringTracer.is_available(self.tool_id)
+        self.capture_mode = RAISED if self.use_monitoring else UNHANDLED
+
+        # the exception hooks that were installed before this tracer started
+        self._original_excepthook = None
+        self._original_threading_excepthook = None
+
+    def _on_raise(self, code, instruction_offset, exception):
+        """The callback for the `RAISE` event of `sys.monitoring`."""
+        if self.paused:
+            return
+
+        # the event also fires in every frame the exception propagates
+        # through; it is only counted in the frame where it was raised.
+        traceback = exception.__traceback__
+        if traceback is not None and traceback.tb_next is not None:
+            return
+
+        try:
+            sites = self._capture_cache[code]
+            self.cache_hits += 1
+        except KeyError:
+            sites = self._cache_capture_decision(code)
+
+        if sites is None:
+            return
+
+        try:
+            loc_id = sites[instruction_offset]
+        except KeyError:
+            loc_id = sites[instruction_offset] = self.buffer.intern(
+                self._relative_path(code.co_filename),
+                self._get_lineno(code, instruction_offset))
+
+        self.buffer.increment(loc_id)
+
+    def _capture_value(self, code):
+        """Return the value to remember in the capture cache for a code object
+        which is captured: a dict mapping the offsets of the instructions that
+        raised an exception to their location ID in the buffer.
+        """
+        return {}
+
+    @staticmethod
+    def _get_lineno(code, instruction_offset):
+        """Return the line number of the instruction at `instruction_offset`
+        in `code`.
+        """
+        for start, end, line in code.co_lines():
+            if start <= instruction_offset < end:
+                if line is not None:
+                    return line
+                break
+        return code.co_firstlineno
+
+    def _excepthook(self, exc_type, exc_value, exc_traceback):
+        """Replacement for `sys.excepthook`, for older Python versions."""
+        self._capture_traceback(exc_traceback)
+        self._original_excepthook(exc_type, exc_value, exc_traceback)
+
+    def _threading_excepthook(self, args):
+        """Replacement for `threading.excepthook`, for older Python
+        versions.
+        """
+        self._capture_traceback(args.exc_traceback)
+        self._original_threading_excepthook(args)
+
+    def _capture_traceback(self, traceback):
+        """Capture the innermost frame of a traceback, which is where the
+        exception was raised, if it is project code. Like the `RAISE` event,
+        an exception raised in a library is not counted, even if it
+        propagated through project code.
+        """
+        if self.stopped or self.paused or traceback is None:
+            return
+
+        while traceback.tb_next is not None:
+            traceback = traceback.tb_next
+
+        code = traceback.tb_frame.f_code
+        try:
+            capture = self._capture_cache[code]
+            self.cache_hits += 1
+        except KeyError:
+            capture = self._cache_capture_decision(code)
+
+        if capture is not None:
+            self._capture(self._relative_path(code.co_filename),
+                          traceback.tb_lineno)
+
+    def start(self):
+        """Start the tracer.
+        """
+        if not self.stopped:
+            return
+
+        self.stopped = False
+        self.paused = False
+
+        if self.use_monitoring:
+            monitoring = sys.monitoring
+            monitoring.use_tool_id(self.tool_id, self.TOOL_NAME)
+            monitoring.register_callback(self.tool_id,
+                                         monitoring.events.RAISE,
+                                         self._on_raise)
+            monitoring.set_events(self.tool_id, monitoring.events.RAISE)
+            return
+
+        self._original_excepthook = sys.excepthook
+        sys.excepthook = self._excepthook
+        if hasattr(threading, 'excepthook'):
+            self._original_threading_excepthook = threading.excepthook
+            threading.excepthook = self._threading_excepthook
+
+    def stop(self):
+        """Stop the tracer, and restore the exception hooks.
+        """
+        if self.stopped:
+            return
+
+        self.stopped = True
+
+        if self.use_monitoring:
+            monitoring = sys.monitoring
+            monitoring.set_events(self.tool_id, monitoring.events.NO_EVENTS)
+            monitoring.register_callback(self.tool_id,
+                                         monitoring.events.RAISE, None)
+            monitoring.free_tool_id(self.tool_id)
+            return
+
+        if sys.excepthook == self._excepthook:
+            sys.excepthook = self._original_excepthook
+        if (self._original_threading_excepthook is not None and
+                threading.excepthook == self._threading_excepthook):
+            threading.excepthook = self._original_threading_excepthook
+
+    def pause(self):
+        """Pause this tracer; exceptions are not counted until resumed.
+        """
+        self.paused = True
+
+    def resume(self):
+        """Resume counting exceptions after this tracer has been paused.
+        """
+        self.paused = False
+
+
+def get_tracer(buffer, **options):
+    """Return a tracer instance for the running interpreter.
+
+    The `tracer_backend` option selects the backend; it should be one of
+    `auto`, `monitoring`, `setprofile` and `sampling`. With `auto`,
+    `sys.monitoring` is used wherever it is available, and `sys.setprofile`
+    otherwise. The `sampling` backend is never picked automatically.
+
+    With the `scoped` option, only threads inside a tracing scope are traced.
+    This needs a profiler per thread, so it is only supported by the
+    `setprofile` backend, which `auto` picks then.
+    """
+    backend = options.get('tracer_backend') or 'auto'
+    tool_id = options.get('monitoring_tool_id', defaults.MONITORING_TOOL_ID)
+
+    if backend not in ('auto', 'monitoring', 'setprofile', 'sampling'):
+        raise ConfigurationError(
+            "Invalid tracer backend: {}".format(backend))
+
+    if options.get('scoped'):
+        if backend not in ('auto', 'setprofile'):
+            raise ConfigurationError(
+                "Scoped tracing is not supported by the {} tracer "
+                "backend".format(backend))
+        return Tracer(buffer, **options)
+
+    if backend == 'sampling':
+        return SamplingTracer(buffer, **options)
+
+    if backend == 'monitoring' or (
+            backend == 'auto' and MonitoringTracer.is_available(tool_id)):
+        return MonitoringTracer(buffer, **options)
+
+    return Tracer(buffer, **options)
@@ -0,0 +1,492 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""The transport sends the batches of the buffers to the server from a
+dedicated thread, so that a slow server does not hold up the flushes."""
+import logging
+import random
+import threading
+from collections import OrderedDict, deque
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import grpc
+
+from . import defaults
+from .exceptions import CircuitOpenError
+from .utils import perf_counter
+
+logger = logging.getLogger('beacon')
+
+# what `Transport.call_stream` returns for a batch written to the stream,
+# which is only transmitted once the server confirms the stream
+STREAMED = object()
+
+# the status codes of the RPCs which are retried right away; gRPC also
+# fails the messages larger than its limit with RESOURCE_EXHAUSTED, which
+# are never retried, see `is_message_too_large`.
+RETRYABLE_CODES = (grpc.StatusCode.UNAVAILABLE,
+                   grpc.StatusCode.RESOURCE_EXHAUSTED)
+
+# the phrase in the details of the errors of messages larger than the limit
+MESSAGE_TOO_LARGE = 'message larger than max'
+
+
+def is_message_too_large(error):
+    """Whether an RPC failed with `error` because its request or response
+    was larger than the maximum size of a gRPC message.
+    """
+    code = getattr(error, 'code', None)
+    details = getattr(error, 'details', None)
+    return (callable(code) and
+            code() == grpc.StatusCode.RESOURCE_EXHAUSTED and
+            callable(details) and
+            MESSAGE_TOO_LARGE in (details() or '').lower())
+
+
+class RetryPolicy(object):
+    def __init__(self, attempts=None, base_delay=None, max_delay=None,
+                 jitter=None):
+        """The RetryPolicy decides how often an RPC is tried, and how long to
+           wait before each retry.
+
+        The delays grow exponentially, and are shortened by a random
+        fraction up to `jitter`, so that the agents of a fleet do not retry
+        in lockstep.
+
+        :param attempts: the maximum number of times an RPC is tried.
+
+        :param base_delay: the delay before the first retry, in seconds.
+
+        :param max_delay: the maximum delay, in seconds.
+
+        :param jitter: the maximum fraction of a delay taken off at random.
+
+        :return: an instance of RetryPolicy.
+        """
+        self.attempts = attempts or defaults.RETRY_ATTEMPTS
+        self.base_delay = base_delay or defaults.RETRY_BASE_DELAY
+        self.max_delay = max_delay or defaults.RETRY_MAX_DELAY
+        self.jitter = defaults.RETRY_JITTER if jitter is None else jitter
+
+    def delay(self, retry):
+        """Return the number of seconds to wait before the `retry`th retry,
+        counting from 1.
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (retry - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    def is_retryable(self, error):
+        """Whether an RPC which failed with `error` may be retried."""
+        code = getattr(error, 'code', None)
+        return (callable(code) and code() in RETRYABLE_CODES and
+                not is_message_too_large(error))
+
+
+class CircuitBreaker(object):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=None, backoff=None):
+        """The CircuitBreaker stops calling the server once calls to it have
+           failed a number of times in a row, and fails them fast instead.
+
+        After a while, the breaker lets a single call through, to probe
+        whether the server has recovered. If it has, the breaker closes
+        again; otherwise, it waits longer before the next probe.
+
+        :param failure_threshold: the number of failures in a row after which
+                                  the breaker opens.
+
+        :param backoff: the RetryPolicy that decides how long the breaker
+                        stays open before every probe.
+
+        :return: an instance of CircuitBreaker.
+        """
+        self.failure_threshold = (failure_threshold or
+                                  defaults.BREAKER_FAILURE_THRESHOLD)
+
+        self.backoff = backoff or RetryPolicy(
+            base_delay=defaults.BREAKER_RESET_TIMEOUT,
+            max_delay=defaults.BREAKER_MAX_RESET_TIMEOUT)
+
+        self.state = self.CLOSED
+
+        # the number of failures in a row, and of probes which failed since
+        # the breaker opened
+        self.failures = 0
+        self.failed_probes = 0
+
+        # the time at which the open breaker lets the next probe through, on
+        # the clock of `perf_counter`
+        self.retry_at = None
+
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        """Raise CircuitOpenError if the call should not be made."""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and perf_counter() >= self.retry_at:
+                # let this call through as the probe
+                self.state = self.HALF_OPEN
+                return
+            raise CircuitOpenError(
+                "The server is unavailable; not calling it.")
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.info("The server is available again.")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.failed_probes = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                self.failed_probes += 1
+            elif (self.state == self.OPEN or
+                    self.failures < self.failure_threshold):
+                return
+
+            delay = self.backoff.delay(self.failed_probes + 1)
+            if self.state == self.CLOSED:
+                logger.warning(
+                    "The server failed {} times in a row. Not calling it for "
+                    "{:.0f} seconds.".format(self.failures, delay))
+            self.state = self.OPEN
+            self.retry_at = perf_counter() + delay
+
+
+class _Call(object):
+    """A future of an RPC, which records its outcome with the transport, and
+    gives back its slot of the RPCs in flight, once its result is taken."""
+
+    def __init__(self, transport, future):
+        self.transport = transport
+        self.future = future
+        self.started_at = perf_counter()
+
+    def result(self):
+        try:
+            response = self.future.result()
+        except Exception as e:
+            self.transport.record(self.started_at, success=False, error=e)
+            raise
+        finally:
+            self.transport.in_flight.release()
+        self.transport.record(self.started_at, success=True)
+        return response
+
+
+class BatchStream(object):
+    """A client stream of batches to the server.
+
+    The server only responds once the stream is closed, so the batches
+    written to it are kept until then, to be transmitted again if the stream
+    fails.
+    """
+
+    def __init__(self, stub):
+        # the stub of the server, which the batches are transmitted again
+        # with if the stream fails
+        self.stub = stub
+
+        # the batches to write to the stream, ended by None
+        self.requests = queue.Queue()
+
+        # the two-tuples of the buffer and batch written to the stream
+        self.batches = []
+
+        self.opened_at = perf_counter()
+
+        self.future = stub.TransmitStream.future(self._iterate())
+
+    def _iterate(self):
+        while True:
+            batch = self.requests.get()
+            if batch is None:
+                return
+            yield batch
+
+    def write(self, buffer, batch):
+        self.requests.put(batch)
+        self.batches.append((buffer, batch))
+
+    def has_failed(self):
+        """Whether the server has ended the stream already, with an error."""
+        if not self.future.done():
+            return False
+        try:
+            self.future.result()
+        except Exception:
+            return True
+        return False
+
+    def end(self):
+        """End the stream, without waiting for the response."""
+        self.requests.put(None)
+
+    def close(self, timeout):
+        """End the stream, and return the response of the server, raising
+        its error if the stream failed. If the server does not respond in
+        time, the stream is cancelled, so that it does not confirm the
+        batches after they are transmitted again.
+        """
+        self.end()
+        try:
+            return self.future.result(timeout=timeout)
+        except grpc.FutureTimeoutError:
+            self.future.cancel()
+            raise
+
+
+class Transport(object):
+    def __init__(self, timeout=None, max_in_flight=None, retry=None,
+                 breaker=None, streaming=False):
+        """The Transport queues the buffers which have events to send, and
+           sends them from its sender thread.
+
+        Every buffer is in the queue at most once: the events of a buffer
+        flushed while it is still waiting are added to the ones it is going
+        to send, so the queue stays bounded by the number of buffers however
+        slow the server is.
+
+        :param timeout: the deadline of every RPC, in seconds.
+
+        :param max_in_flight: the maximum number of RPCs in flight at once,
+                              across the sender thread and the thread that
+                              drains the spool.
+
+        :param retry: the RetryPolicy of the RPCs.
+
+        :param breaker: the CircuitBreaker of the RPCs.
+
+        :param streaming: if True, batches of events are written to a
+                          long-lived stream, which is reopened after
+                          `STREAM_MAX_BATCHES` batches or `STREAM_MAX_AGE`
+                          seconds, rather than sent with one RPC each.
+
+        :return: an instance of Transport.
+        """
+        self.timeout = timeout or defaults.TRANSMIT_TIMEOUT
+
+        self.max_in_flight = max_in_flight or defaults.MAX_IN_FLIGHT
+        self.in_flight = threading.BoundedSemaphore(self.max_in_flight)
+
+        self.retry = retry or RetryPolicy()
+
+        self.breaker = breaker or CircuitBreaker()
+
+        # the open stream, if batches are streamed; this falls back to one
+        # RPC per batch for good if the server does not implement streams
+        self.streaming = streaming
+        self.stream = None
+
+        # the two-tuples of the buffer and batch of failed streams which
+        # could not be transmitted again; they are handed back to their
+        # buffers once the sender thread is done sending, since a stream
+        # may be closed while a buffer sends
+        self.failed = []
+
+        # the buffers waiting to send their events, in the order they were
+        # queued; the values are unused
+        self.queue = OrderedDict()
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+
+        # the latencies of the most recent RPCs, in seconds
+        self.latencies = deque(maxlen=defaults.LATENCY_WINDOW)
+
+        self.is_stopped = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run,
+                                       name='beacon-sender')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.is_stopped = True
+            self.ready.notify()
+        self.stopped.set()
+        if self.stream is not None:
+            self.stream.end()
+
+    def submit(self, buffer):
+        """Queue a buffer, unless it is queued already, for the sender thread
+        to call its `send` method. This does not block on the server.
+        """
+        with self.lock:
+            self.queue[buffer] = None
+            self.ready.notify()
+
+    def call(self, method, batch, **options):
+        """Call an RPC with the deadline of the transport, and retry it as the
+        retry policy allows. Raise CircuitOpenError right away if the circuit
+        breaker is open, and the error of the last attempt if they all fail.
+        """
+        attempt = 1
+        while True:
+            self.breaker.before_call()
+            started_at = perf_counter()
+            try:
+                with self.in_flight:
+                    response = method(batch, timeout=self.timeout, **options)
+            except Exception as e:
+                self.record(started_at, success=False, error=e)
+                if (attempt >= self.retry.attempts or
+                        not self.retry.is_retryable(e) or
+                        self.stopped.wait(self.retry.delay(attempt))):
+                    raise
+                attempt += 1
+                continue
+
+            self.record(started_at, success=True)
+            return response
+
+    def call_future(self, method, batch, **options):
+        """Start an RPC with the deadline of the transport, and return a future
+        of its response; it is not retried. Raise CircuitOpenError right away
+        if the circuit breaker is open. This waits while `max_in_flight` RPCs
+        are in flight already, so the result of the future must be taken.
+        """
+        self.breaker.before_call()
+        self.in_flight.acquire()
+        try:
+            future = method.future(batch, timeout=self.timeout, **options)
+        except Exception:
+            self.in_flight.release()
+            raise
+        return _Call(self, future)
+
+    def call_stream(self, stub, buffer, batch):
+        """Write a batch of a buffer to the stream, opening a new stream if
+        there is none, or if the open one is due to be closed, and return
+        STREAMED; the buffer is told once the server confirms the batch. If
+        the server does not accept streams, the batch is transmitted with an
+        RPC, and its response is returned. Raise CircuitOpenError right away
+        if the circuit breaker is open.
+        """
+        stream = self.stream
+        if stream is not None and (
+                stream.has_failed() or
+                len(stream.batches) >= defaults.STREAM_MAX_BATCHES or
+                perf_counter() - stream.opened_at >= defaults.STREAM_MAX_AGE):
+            self.close_stream()
+            if not self.streaming:
+                return self.call(stub.Transmit, batch)
+
+        if self.stream is None:
+            self.breaker.before_call()
+            self.stream = BatchStream(stub)
+        self.stream.write(buffer, batch)
+        return STREAMED
+
+    def close_stream(self):
+        """Close the stream, wait for the server to confirm its batches, and
+        tell their buffers. If the stream failed, its batches are transmitted
+        again with one RPC each; the ones for which that fails as well are
+        kept in `failed`, to be handed back to their buffers.
+        """
+        stream, self.stream = self.stream, None
+        if stream is None:
+            return
+
+        started_at = perf_counter()
+        try:
+            stream.close(self.timeout)
+        except Exception as e:
+            self.record(started_at, success=False, error=e)
+            code = getattr(e, 'code', None)
+            if callable(code) and code() == grpc.StatusCode.UNIMPLEMENTED:
+                logger.info("The server does not accept streams of batches. "
+                            "Sending them one by one.")
+                self.streaming = False
+            else:
+                logger.error("Error streaming events. Sending them again.")
+                logger.error(e)
+
+            for buffer, batch in stream.batches:
+                try:
+                    self.call(stream.stub.Transmit, batch)
+                except Exception:
+                    self.failed.append((buffer, batch))
+                else:
+                    buffer.confirm(batch)
+            return
+
+        self.record(started_at, success=True)
+        for buffer, batch in stream.batches:
+            buffer.confirm(batch)
+
+    def _restore_failed(self):
+        """Hand the batches of failed streams back to their buffers."""
+        failed, self.failed = self.failed, []
+        for buffer, batch in failed:
+            buffer.restore(batch)
+
+    def record(self, started_at, success, error=None):
+        """Record the outcome of an RPC, and its latency. An RPC which failed
+        because its message was too large, with `error`, says nothing about
+        the server, so the circuit breaker does not count it.
+        """
+        self.latencies.append(perf_counter() - started_at)
+        if success:
+            self.breaker.record_success()
+        elif not is_message_too_large(error):
+            self.breaker.record_failure()
+
+    def get_stats(self):
+        """Return the depth of the queue, the state of the circuit breaker,
+        and the mean and maximum latency of the most recent RPCs, in seconds,
+        which are None if there were none.
+        """
+        latencies = list(self.latencies)
+        return {
+            'queue_depth': len(self.queue),
+            'circuit': self.breaker.state,
+            'send_latency_mean': (sum(latencies) / len(latencies)
+                                  if latencies else None),
+            'send_latency_max': max(latencies) if latencies else None,
+        }
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self.queue and not self.is_stopped:
+                    # wake up to close an open stream once it is due, so
+                    # that the server confirms its batches
+                    self.ready.wait(None if self.stream is None
+                                    else defaults.STREAM_MAX_AGE)
+                if self.is_stopped:
+                    return
+                if not self.queue:
+                    buffer = None
+                else:
+                    buffer, _ = self.queue.popitem(last=False)
+
+            if buffer is None:
+                stream = self.stream
+                if (stream is not None and perf_counter() - stream.opened_at >=
+                        defaults.STREAM_MAX_AGE):
+                    self.close_stream()
+                    self._restore_failed()
+                continue
+
+            try:
+                buffer.send()
+            except Exception as e:
+                buffer.agent.logger.error("Error sending events.")
+                buffer.agent.logger.error(e)
+            self._restore_failed()
@@ -13,6 +13,39 @@ try:
 except ImportError:
     from urllib.parse import urlparse
 
+try:
+    from sys import intern
+except ImportError:
+    # Python 2 has `intern` as a builtin
+    intern = intern
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    # Python 3.6 and older; fall back to a value per thread
+    class ContextVar(object):
+        def __init__(self, name, default=None):
+            self.name = name
+            self.default = default
+            self.local = threading.local()
+
+        def get(self):
+            return getattr(self.local, 'value', self.default)
+
+        def set(self, value):
+            token = self.get()
+            self.local.value = value
+            return token
+
+        def reset(self, token):
+            self.local.value = token
+
+try:
+    from time import perf_counter
+except ImportError:
+    # Python 2 has no high resolution performance counter
+    from time import time as perf_counter
+
 
 class Timer(object):
     def __init__(self, interval, func, *args, **kwargs):
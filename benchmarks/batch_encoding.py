@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark the size on the wire, and the CPU time to serialize, a batch of
+events encoded as a `Batch` of `Event` messages, and as a `ColumnarBatch`.
+
+The columnar batch is measured twice: for the first flush of a stream, which
+carries the path table, and for a later flush, which does not.
+
+Usage: python benchmarks/batch_encoding.py [number of events] [files]
+"""
+from __future__ import print_function
+
+import mock
+
+from beacon.buffer import Buffer
+from beacon.utils import perf_counter
+
+REPEAT = 5
+
+
+def measure(serialize):
+    """Return the size in bytes of the serialized batch, and the best time in
+    seconds to build and serialize it.
+    """
+    best = None
+    for _ in range(REPEAT):
+        start = perf_counter()
+        data = serialize().SerializeToString()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(data), best
+
+
+def main():
+    import sys
+    event_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    file_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    agent = mock.Mock()
+    agent.stream_id = 'benchmark'
+    buffer = Buffer(agent, 'f')
+    counts = {}
+    for i in range(event_count):
+        loc_id = buffer.intern(
+            'app/package_{}/module_{}.py'.format(i % 50, i % file_count), i)
+        counts[loc_id] = i % 100 + 1
+
+    def columnar():
+        return buffer._serialize_columnar_batch(counts=counts, timestamp=1)
+
+    candidates = [
+        ('events', lambda: buffer._serialize_batch(counts=counts,
+                                                   timestamp=1)),
+        ('columnar, first', columnar),
+    ]
+
+    print('{:>16} {:>12} {:>12}'.format('encoding', 'bytes', 'time (ms)'))
+    for name, serialize in candidates:
+        size, elapsed = measure(serialize)
+        print('{:>16} {:>12} {:>12.2f}'.format(name, size, elapsed * 1e3))
+
+    # the server has the path table once the first batch was transmitted
+    buffer.acknowledged_paths = len(buffer.paths)
+    size, elapsed = measure(columnar)
+    print('{:>16} {:>12} {:>12.2f}'.format('columnar, later', size,
+                                           elapsed * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark `Buffer.add` under contention from many threads.
+
+Compares the per-thread counters of `Buffer` with a buffer that takes a
+single lock on every `add`, as Beacon used to do.
+
+Usage: python benchmarks/buffer_contention.py [events per thread]
+"""
+from __future__ import print_function
+
+import sys
+import threading
+import time
+from collections import Counter
+
+import mock
+
+from beacon.buffer import Buffer
+
+THREAD_COUNTS = (8, 16, 32, 64)
+
+LOCATIONS = [('app/module_{}.py'.format(i), i) for i in range(64)]
+
+
+class LockedBuffer(object):
+    """A buffer that takes a lock for every event."""
+
+    def __init__(self):
+        self.counter = Counter()
+        self.counter_lock = threading.Lock()
+
+    def add(self, filename, location):
+        with self.counter_lock:
+            self.counter[(filename, location)] += 1
+
+
+def run(buffer, thread_count, events):
+    barrier = threading.Event()
+
+    def target():
+        barrier.wait()
+        add = buffer.add
+        for index in range(events):
+            filename, location = LOCATIONS[index & 63]
+            add(filename, location)
+
+    threads = [threading.Thread(target=target) for _ in range(thread_count)]
+    for thread in threads:
+        thread.start()
+
+    start = time.time()
+    barrier.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    assert sum(buffer.counter.values()) == thread_count * events
+    return elapsed
+
+
+def main():
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    print('{:>8} {:>14} {:>14} {:>8}'.format(
+        'threads', 'locked (ev/s)', 'sharded (ev/s)', 'speedup'))
+    for thread_count in THREAD_COUNTS:
+        total = thread_count * events
+        locked = run(LockedBuffer(), thread_count, events)
+        sharded = run(Buffer(mock.Mock(), 'f'), thread_count, events)
+        print('{:>8} {:>14.0f} {:>14.0f} {:>7.2f}x'.format(
+            thread_count, total / locked, total / sharded, locked / sharded))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark the worst-case latency of `Buffer.add` while the buffer is being
+flushed.
+
+Compares the double-buffered `Buffer`, which only holds its lock to swap the
+counts, with a buffer that copies its counter under the lock on every flush,
+as Beacon used to do. Both serialize the batch outside of the lock; what
+remains of the worst case of the double-buffered buffer is the adding thread
+waiting for the GIL, and the garbage collector, during serialization.
+
+Usage: python benchmarks/flush_latency.py [number of locations]
+"""
+from __future__ import print_function
+
+import threading
+import time
+from collections import Counter
+from copy import deepcopy
+
+import mock
+
+from beacon import beacon_pb2
+from beacon.buffer import Buffer
+from beacon.utils import perf_counter
+
+FLUSHES = 3
+
+
+class CopyingBuffer(object):
+    """A buffer that copies its counter under the lock on flush, and then
+    serializes it outside of the lock, like `Buffer` does."""
+
+    def __init__(self):
+        self.counter = Counter()
+        self.counter_lock = threading.Lock()
+
+    def add(self, filename, location):
+        with self.counter_lock:
+            self.counter[(filename, location)] += 1
+
+    def flush(self):
+        with self.counter_lock:
+            counter = deepcopy(self.counter)
+            self.counter.clear()
+
+        return beacon_pb2.Batch(events=[
+            beacon_pb2.Event(file_path=filename, location=location,
+                             count=count)
+            for ((filename, location), count) in counter.items()])
+
+
+def run(buffer, locations):
+    """Add events from one thread while another flushes, and return the
+    worst and mean latency of `add`, in seconds.
+    """
+    done = threading.Event()
+    latencies = []
+
+    def target():
+        add = buffer.add
+        index = 0
+        while not done.is_set():
+            filename, location = locations[index % len(locations)]
+            start = perf_counter()
+            add(filename, location)
+            latencies.append(perf_counter() - start)
+            index += 1
+
+    for filename, location in locations:
+        buffer.add(filename, location)
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    for _ in range(FLUSHES):
+        time.sleep(0.05)
+        buffer.flush()
+        for filename, location in locations:
+            buffer.add(filename, location)
+    done.set()
+    thread.join()
+
+    return max(latencies), sum(latencies) / len(latencies)
+
+
+def main():
+    import sys
+    location_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    locations = [('app/module_{}.py'.format(i % 1000), i)
+                 for i in range(location_count)]
+
+    agent = mock.Mock()
+    agent.stream_id = 'benchmark'
+    buffer = Buffer(agent, 'f')
+    buffer._transmit = lambda batch: True
+
+    print('{:>16} {:>14} {:>14}'.format('buffer', 'worst (ms)', 'mean (us)'))
+    for name, candidate in (('copy under lock', CopyingBuffer()),
+                            ('double-buffered', buffer)):
+        worst, mean = run(candidate, locations)
+        print('{:>16} {:>14.2f} {:>14.2f}'.format(name, worst * 1e3,
+                                                  mean * 1e6))
+
+
+if __name__ == '__main__':
+    main()
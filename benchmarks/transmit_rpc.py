@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark the throughput and CPU time of transmitting batches through a
+`Transport` with one unary `Transmit` call each, and over a `TransmitStream`
+stream, to a servicer running in the same process.
+
+Every batch is flushed from a `Buffer` and sent as the sender thread of the
+transport would, so the RPCs go through its retry policy and its cap on the
+RPCs in flight; a stream is closed at the end, for the server to confirm its
+batches. The CPU time is that of the whole process, so it includes adding
+the events, serializing the batches, and the servicer.
+
+Usage: python benchmarks/transmit_rpc.py [number of batches] [events]
+"""
+from __future__ import print_function
+
+import time
+from concurrent import futures
+
+import grpc
+import mock
+
+from beacon import beacon_pb2
+from beacon import beacon_pb2_grpc as pb2_grpc
+from beacon.buffer import Buffer
+from beacon.transport import Transport
+from beacon.utils import perf_counter
+
+try:
+    process_time = time.process_time
+except AttributeError:
+    process_time = time.clock
+
+
+class Servicer(pb2_grpc.BeaconServicer):
+    def __init__(self):
+        self.batches = 0
+
+    def Transmit(self, request, context):
+        self.batches += 1
+        return beacon_pb2.Empty()
+
+    def TransmitStream(self, request_iterator, context):
+        for _ in request_iterator:
+            self.batches += 1
+        return beacon_pb2.Empty()
+
+
+def make_buffer(stub, streaming):
+    agent = mock.Mock()
+    agent.stream_id = 'benchmark'
+    agent.stub = stub
+    transport_buffer = Buffer(agent, 'f')
+    transport_buffer.transport = Transport(streaming=streaming)
+    return transport_buffer
+
+
+def measure(transport_buffer, batch_count, event_count):
+    """Return the number of batches per second, and the CPU time per batch
+    in microseconds, of flushing and sending the batches until the server
+    has confirmed them all.
+    """
+    started_at, cpu_started_at = perf_counter(), process_time()
+    for _ in range(batch_count):
+        for i in range(event_count):
+            transport_buffer.add('app/module_{}.py'.format(i % 10), i)
+        transport_buffer.flush()
+        transport_buffer.send()
+    transport_buffer.transport.close_stream()
+    elapsed, cpu = perf_counter() - started_at, process_time() - cpu_started_at
+
+    assert transport_buffer.stats['events'] == batch_count * event_count
+    return batch_count / elapsed, cpu / batch_count * 1e6
+
+
+def main():
+    import sys
+    batch_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    event_count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    servicer = Servicer()
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    pb2_grpc.add_BeaconServicer_to_server(servicer, server)
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+    stub = pb2_grpc.BeaconStub(
+        grpc.insecure_channel('127.0.0.1:{}'.format(port)))
+
+    # warm up the channel
+    measure(make_buffer(stub, streaming=False), 10, event_count)
+
+    print('{:>10} {:>14} {:>18}'.format('rpc', 'batches/s', 'cpu/batch (us)'))
+    for name, streaming in (('unary', False), ('streaming', True)):
+        rate, cpu = measure(make_buffer(stub, streaming), batch_count,
+                            event_count)
+        print('{:>10} {:>14.0f} {:>18.1f}'.format(name, rate, cpu))
+
+    server.stop(None)
+
+
+if __name__ == '__main__':
+    main()
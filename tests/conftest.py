@@ -0,0 +1,9 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys
+
+# the ASGI middleware and its tests use `async def`, which is a syntax error
+# before Python 3.5
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore.append('test_contrib_asgi.py')
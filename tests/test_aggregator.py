@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+from beacon.aggregator import HostAggregator, LeaderLock
+from beacon.buffer import Buffer
+import mock
+import pytest
+
+fcntl = pytest.importorskip('fcntl')
+
+
+@pytest.fixture
+def aggregators(tmpdir):
+    # two processes of the host, each with its own lock and segment files
+    def make():
+        leader = LeaderLock(str(tmpdir.join('leader.lock')))
+        return HostAggregator(str(tmpdir.join('f.segment')), leader,
+                              slots=8, heap_size=256)
+
+    first, second = make(), make()
+    yield first, second
+    for aggregator in (first, second):
+        aggregator.leader.release()
+        aggregator.close()
+
+
+def test_leader_should_transmit_counts_of_the_host(aggregators):
+    leader, worker = aggregators
+
+    counts, sampled = leader.exchange({('foo.py', 1): 1})
+    assert counts == {('foo.py', 1): 1}
+    assert not sampled
+
+    # the worker only adds its counts to the segment
+    assert worker.exchange({('foo.py', 1): 2, ('bar.py', 3): 1},
+                           sampled=True) == (None, True)
+
+    counts, sampled = leader.exchange({('bar.py', 3): 1})
+    assert counts == {('foo.py', 1): 2, ('bar.py', 3): 2}
+    assert sampled
+
+    # the counts were taken out of the segment
+    assert leader.exchange({}) == ({}, False)
+
+
+def test_leader_should_fail_over(aggregators):
+    leader, worker = aggregators
+
+    leader.exchange({})
+    assert worker.exchange({('foo.py', 1): 1}) == (None, False)
+
+    leader.leader.release()
+    assert worker.exchange({}) == ({('foo.py', 1): 1}, False)
+    assert worker.leader.is_leader
+    with open(worker.leader.path) as f:
+        assert f.read() == str(os.getpid())
+
+
+def test_worker_should_transmit_counts_that_do_not_fit(aggregators):
+    leader, worker = aggregators
+    leader.exchange({})
+
+    counts = dict((('file_{}.py'.format(i), i), 1) for i in range(10))
+    overflow, _ = worker.exchange(counts)
+    assert len(overflow) == 2
+
+    host_counts, _ = leader.exchange({})
+    assert len(host_counts) == 8
+    host_counts.update(overflow)
+    assert host_counts == counts
+
+    # the full segment was cleared, and takes new keys again
+    worker.exchange({('new.py', 1): 1})
+    assert leader.exchange({}) == ({('new.py', 1): 1}, False)
+
+
+def test_buffer_should_flush_through_aggregator(aggregators):
+    leader, worker = aggregators
+    leader.exchange({})
+
+    agent = mock.Mock()
+    agent.stream_id = 'dummy'
+    buffer = Buffer(agent, 'f')
+    buffer.aggregator = worker
+    buffer.add('foo.py', 42)
+
+    buffer.flush()
+    assert not agent.stub.Transmit.called
+
+    buffer.aggregator = leader
+    buffer.add('bar.py', 1)
+    buffer.flush()
+    batch = agent.stub.Transmit.call_args[0][0]
+    assert sorted((event.file_path, event.location, event.count)
+                  for event in batch.events) == [('bar.py', 1, 1),
+                                                 ('foo.py', 42, 1)]
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from beacon.buffer import Buffer
+import threading
+import time
+from array import array
+from beacon import beacon_pb2, buffer
+from beacon.buffer import COUNT_TYPECODE, Buffer, HistogramBuffer
 import mock
 import pytest
 
@@ -42,24 +46,27 @@ def test_buffer_should_not_trasmit_for_empty_counter(empty_buffer):
     assert not empty_buffer.agent.stub.Transmit.called
 
 
-def test_buffer_should_add_to_unflushed_on_trasmit_failure(sample_buffer):
+def test_buffer_should_keep_pending_events_on_trasmit_failure(sample_buffer):
     # make transmit raise error
     sample_buffer.agent.stub.Transmit.side_effect = mock.Mock(side_effect=Exception())  # noqa
     sample_buffer.flush()
-    assert len(sample_buffer.unflushed) == 1
+    assert dict(sample_buffer.pending.counts) == {0: 3, 1: 1}
 
 
-def test_buffer_should_clear_unflushed_if_flush_works(sample_buffer):
-    # first make transmit raise error
+def test_buffer_should_clear_pending_if_flush_works(sample_buffer):
+    # first make transmit raise error, twice
     sample_buffer.agent.stub.Transmit.side_effect = mock.Mock(side_effect=Exception())  # noqa
     sample_buffer.flush()
+    sample_buffer.add('foo.py', 42)
+    sample_buffer.flush()
 
     # now, add more stuff to the buffer
     sample_buffer.add('new_file.py', 4)
 
-    # assert that counter and unflushed both have data
+    # assert that counter and pending both have data, and that the failed
+    # batches were coalesced
     assert len(sample_buffer.counter) > 0
-    assert len(sample_buffer.unflushed) > 0
+    assert dict(sample_buffer.pending.counts) == {0: 4, 1: 1}
 
     # now make transmission work again, and flush everything
     sample_buffer.agent.stub.Transmit.side_effect = mock.Mock(side_effect=mock.Mock())  # noqa
@@ -67,7 +74,446 @@ def test_buffer_should_clear_unflushed_if_flush_works(sample_buffer):
 
     # assert that everything has been flushed
     assert len(sample_buffer.counter) == 0
-    assert len(sample_buffer.unflushed) == 0
+    assert not sample_buffer.pending.counts
 
-    # assert that Transmit was called thrice in total: once earlier, and twice this time.  # noqa
+    # assert that Transmit was called thrice in total: twice earlier, and
+    # once this time, with all the events.
     assert sample_buffer.agent.stub.Transmit.call_count == 3
+    batch = sample_buffer.agent.stub.Transmit.call_args[0][0]
+    assert sorted((event.file_path, event.location, event.count)
+                  for event in batch.events) == [
+                      ('baz/bar.py', 1, 1), ('foo.py', 42, 4),
+                      ('new_file.py', 4, 1)]
+
+
+@pytest.mark.parametrize('drop_policy, kept', [
+    ('new', [('foo.py', 1), ('foo.py', 2)]),
+    ('old', [('foo.py', 3), ('foo.py', 4)]),
+])
+def test_buffer_should_bound_pending_events(drop_policy, kept):
+    agent = mock.Mock()
+    agent.stream_id = 'dummy'
+    agent.stub.Transmit.side_effect = Exception()
+    bounded_buffer = Buffer(agent, 'f', max_pending=2,
+                            drop_policy=drop_policy)
+
+    for location in range(1, 5):
+        bounded_buffer.add('foo.py', location)
+        bounded_buffer.add('foo.py', location)
+        bounded_buffer.flush()
+
+    assert len(bounded_buffer.pending.counts) == 2
+    assert bounded_buffer.pending.dropped == 4
+
+    # the dropped events are reported once the server can be reached again
+    agent.stub.Transmit.side_effect = None
+    bounded_buffer.add('foo.py', 1)
+    bounded_buffer.flush()
+    batch = agent.stub.Transmit.call_args[0][0]
+    assert batch.dropped_events == 4
+    assert sorted((event.file_path, event.location)
+                  for event in batch.events) == sorted(
+                      set(kept) | {('foo.py', 1)})
+    assert bounded_buffer.pending.dropped == 0
+
+
+def test_buffer_flush_should_flag_sampled_batches(sample_buffer):
+    sample_buffer.sampled = True
+    sample_buffer.flush()
+
+    batch = sample_buffer.agent.stub.Transmit.call_args[0][0]
+    assert batch.sampled
+
+
+def test_buffer_should_merge_thread_counters_on_flush(empty_buffer):
+    def target():
+        for _ in range(100):
+            empty_buffer.add('foo.py', 42)
+
+    threads = [threading.Thread(target=target) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    empty_buffer.add('foo.py', 42)
+
+    assert empty_buffer.counter[('foo.py', 42)] == 801
+
+    empty_buffer.flush()
+
+    batch = empty_buffer.agent.stub.Transmit.call_args[0][0]
+    assert len(batch.events) == 1
+    assert batch.events[0].count == 801
+
+    # the shards of the exited threads should have been dropped
+    assert len(empty_buffer._shards) == 1
+
+
+def test_buffer_flush_should_report_mode_changes(sample_buffer):
+    sample_buffer.record_mode_change('sampling')
+    sample_buffer.sampled = True
+    sample_buffer.record_mode_change('tracing')
+    sample_buffer.sampled = False
+
+    sample_buffer.flush()
+
+    batch = sample_buffer.agent.stub.Transmit.call_args[0][0]
+    # some of the counts were sampled during this batch
+    assert batch.sampled
+    assert batch.tracer_mode == 'tracing'
+    assert [change.mode for change in batch.mode_changes] == [
+        'sampling', 'tracing']
+
+    # the next batch is neither sampled, nor has any mode changes
+    sample_buffer.add('foo.py', 42)
+    sample_buffer.flush()
+
+    batch = sample_buffer.agent.stub.Transmit.call_args[0][0]
+    assert not batch.sampled
+    assert batch.tracer_mode == 'tracing'
+    assert not batch.mode_changes
+
+
+def test_buffer_should_keep_mode_changes_of_empty_batches(empty_buffer):
+    empty_buffer.record_mode_change('sampling')
+    empty_buffer.flush()
+
+    assert not empty_buffer.agent.stub.Transmit.called
+    assert len(empty_buffer.mode_changes) == 1
+
+
+def test_buffer_should_intern_locations(empty_buffer):
+    foo = empty_buffer.intern('foo.py', 42)
+    bar = empty_buffer.intern('baz/bar.py', 1)
+
+    assert empty_buffer.intern('foo.py', 42) == foo
+    assert foo != bar
+    assert empty_buffer.locations[bar] == ('baz/bar.py', 1)
+
+    # locations interned after the thread's shard was created should grow it
+    empty_buffer.increment(foo)
+    new = empty_buffer.intern('new_file.py', 4)
+    empty_buffer.increment(new)
+    empty_buffer.increment(new)
+
+    assert empty_buffer.counter == {('foo.py', 42): 1,
+                                    ('new_file.py', 4): 2}
+
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_buffer_merge_should_sum_thread_counts(use_numpy):
+    if use_numpy:
+        pytest.importorskip('numpy')
+    arrays = [array(COUNT_TYPECODE, [0, 2, 0, 1]),
+              array(COUNT_TYPECODE, [1, 3]),
+              array(COUNT_TYPECODE)]
+
+    with mock.patch.object(buffer, 'numpy',
+                           buffer.numpy if use_numpy else None):
+        assert Buffer._merge(arrays) == {0: 1, 1: 5, 3: 1}
+
+
+def test_presence_buffer_should_send_bitmap_of_seen_locations():
+    agent = mock.Mock()
+    agent.stream_id = 'dummy'
+    presence_buffer = Buffer(agent, 'f', presence=True)
+    rearm = mock.Mock()
+    presence_buffer.flush_callbacks.append(rearm)
+
+    presence_buffer.add('foo.py', 42)
+    presence_buffer.add('foo.py', 42)
+    presence_buffer.intern('baz/bar.py', 1)
+    presence_buffer.add('baz/bar.py', 7)
+    assert not presence_buffer.counter
+
+    presence_buffer.flush()
+    assert rearm.called
+    batch = agent.stub.Transmit.call_args[0][0]
+    assert batch.presence
+    assert not batch.events
+    # location IDs 0 and 2 were seen
+    assert batch.seen == b'\x05'
+    assert batch.location_offset == 0
+    assert [(event.file_path, event.location)
+            for event in batch.locations] == [
+                ('foo.py', 42), ('baz/bar.py', 1), ('baz/bar.py', 7)]
+
+    # the next batch only carries the locations which are new
+    presence_buffer.add('baz/bar.py', 1)
+    presence_buffer.add('new.py', 3)
+    presence_buffer.flush()
+    batch = agent.stub.Transmit.call_args[0][0]
+    assert batch.seen == b'\x0a'
+    assert batch.location_offset == 3
+    assert [(event.file_path, event.location)
+            for event in batch.locations] == [('new.py', 3)]
+
+
+def test_buffer_flush_should_swap_double_buffered_counts(sample_buffer):
+    shard = sample_buffer._shards[0]
+    counts, spare = shard.counts, shard.spare
+
+    sample_buffer.flush()
+    assert shard.counts is spare
+    assert shard.spare is counts
+    # the old counts were cleared after they had been merged
+    assert not any(counts)
+
+    sample_buffer.add('foo.py', 42)
+    sample_buffer.flush()
+    assert shard.counts is counts
+    assert not any(spare)
+    batch = sample_buffer.agent.stub.Transmit.call_args[0][0]
+    assert [(event.file_path, event.location, event.count)
+            for event in batch.events] == [('foo.py', 42, 1)]
+
+
+@pytest.mark.parametrize('use_numpy', [False, True])
+def test_columnar_buffer_should_send_new_paths_only(use_numpy):
+    if use_numpy and buffer.numpy is None:
+        pytest.skip('numpy is not installed')
+
+    agent = mock.Mock()
+    agent.stream_id = 'dummy'
+    columnar_buffer = Buffer(agent, 'f', columnar=True)
+    columnar_buffer.add('foo.py', 42)
+    columnar_buffer.add('foo.py', 42)
+    columnar_buffer.add('baz/bar.py', 1)
+    columnar_buffer.add('foo.py', 7)
+
+    with mock.patch.object(buffer, 'numpy',
+                           buffer.numpy if use_numpy else None):
+        columnar_buffer.flush()
+        assert not agent.stub.Transmit.called
+        batch = agent.stub.TransmitColumnar.call_args[0][0]
+        assert batch.version == 1
+        assert batch.path_offset == 0
+        assert list(batch.paths) == ['foo.py', 'baz/bar.py']
+        assert sorted(zip(batch.path_ids, batch.locations,
+                          batch.counts)) == [(0, 7, 1), (0, 42, 2), (1, 1, 1)]
+
+        # the next batch only carries the paths which are new
+        columnar_buffer.add('foo.py', 42)
+        columnar_buffer.add('new.py', 3)
+        columnar_buffer.flush()
+        batch = agent.stub.TransmitColumnar.call_args[0][0]
+        assert batch.path_offset == 2
+        assert list(batch.paths) == ['new.py']
+        assert sorted(zip(batch.path_ids, batch.locations,
+                          batch.counts)) == [(0, 42, 1), (2, 3, 1)]
+
+
+def test_columnar_buffer_should_resend_paths_after_failure(empty_buffer):
+    empty_buffer.columnar = True
+    agent = empty_buffer.agent
+    agent.stub.TransmitColumnar.side_effect = Exception
+    empty_buffer.add('foo.py', 42)
+    empty_buffer.flush()
+
+    agent.stub.TransmitColumnar.side_effect = None
+    empty_buffer.add('bar.py', 1)
+    empty_buffer.flush()
+    batch = agent.stub.TransmitColumnar.call_args[0][0]
+    assert batch.path_offset == 0
+    assert list(batch.paths) == ['foo.py', 'bar.py']
+    assert sorted(zip(batch.path_ids, batch.counts)) == [(0, 1), (1, 1)]
+
+
+def test_buffer_should_split_large_batches_into_chunks(empty_buffer):
+    agent = empty_buffer.agent
+    for location in range(10):
+        empty_buffer.add('foo.py', location)
+    empty_buffer.record_mode_change('sampling')
+    empty_buffer.max_batch_size = 60
+
+    failure = mock.Mock()
+    failure.result.side_effect = Exception
+    agent.stub.Transmit.future.side_effect = [mock.Mock(), failure]
+    empty_buffer.flush()
+
+    # the first chunk is transmitted on its own, with the mode changes
+    first = agent.stub.Transmit.call_args[0][0]
+    assert len(first.mode_changes) == 1
+    chunks = [call[0][0] for call
+              in agent.stub.Transmit.future.call_args_list]
+    assert len(chunks) == 2
+    assert not any(chunk.mode_changes for chunk in chunks)
+    assert sorted(event.location for batch in [first] + chunks
+                  for event in batch.events) == list(range(10))
+
+    # the events of the chunk which failed are kept
+    assert sorted(empty_buffer.pending.counts) == sorted(
+        empty_buffer.location_ids[('foo.py', event.location)]
+        for event in chunks[1].events)
+    assert not empty_buffer.pending.mode_changes
+    assert empty_buffer.stats['chunked_batches'] == 1
+    assert empty_buffer.stats['chunks'] == 3
+    assert empty_buffer.stats['messages'] == 2
+    assert empty_buffer.stats['events'] == len(first.events) + len(
+        chunks[0].events)
+
+
+def test_presence_buffer_should_split_location_table_into_chunks():
+    agent = mock.Mock()
+    agent.stream_id = 'dummy'
+    presence_buffer = Buffer(agent, 'f', presence=True, max_batch_size=40)
+    for location in range(12):
+        presence_buffer.add('foo.py', location)
+
+    failure = mock.Mock()
+    failure.result.side_effect = Exception
+    agent.stub.Transmit.future.side_effect = [mock.Mock(), failure] + [
+        mock.Mock()] * 10
+    presence_buffer.flush()
+
+    first = agent.stub.Transmit.call_args[0][0]
+    chunks = [first] + [call[0][0] for call
+                        in agent.stub.Transmit.future.call_args_list]
+    assert len(chunks) > 3
+
+    # every chunk carries the new locations up to the last one it has seen
+    offset = 0
+    for chunk in chunks:
+        assert chunk.location_offset == offset
+        offset += len(chunk.locations)
+        seen = [loc_id for loc_id in range(len(chunk.seen) * 8)
+                if bytearray(chunk.seen)[loc_id >> 3] & 1 << (loc_id & 7)]
+        assert max(seen) < offset
+    assert offset == 12
+
+    # the locations are acknowledged up to the chunk which failed
+    assert presence_buffer.acknowledged == chunks[2].location_offset
+
+
+def test_buffer_should_compress_batches_above_threshold(empty_buffer):
+    agent = empty_buffer.agent
+    empty_buffer.compression = compression = object()
+    empty_buffer.compression_threshold = 40
+
+    empty_buffer.add('foo.py', 1)
+    empty_buffer.flush()
+    assert agent.stub.Transmit.call_args == mock.call(mock.ANY)
+
+    for location in range(10):
+        empty_buffer.add('foo.py', location)
+    empty_buffer.flush()
+    assert agent.stub.Transmit.call_args == mock.call(
+        mock.ANY, compression=compression)
+    assert empty_buffer.stats['compressed_messages'] == 1
+    assert (empty_buffer.stats['sampled_compressed_bytes'] <
+            empty_buffer.stats['sampled_bytes'])
+
+
+def test_buffer_should_request_early_flush_at_high_water_mark():
+    agent = mock.Mock()
+    agent.stream_id = 'dummy'
+    worker = buffer.FlushWorker(min_interval=0.05)
+    large_buffer = Buffer(agent, 'f', high_water_mark=3)
+    worker.watch(large_buffer)
+    large_buffer.flushed_at = buffer.perf_counter()
+
+    worker.start()
+    try:
+        with mock.patch.object(large_buffer, 'flush',
+                               wraps=large_buffer.flush) as flush:
+            large_buffer.add('foo.py', 1)
+            large_buffer.add('foo.py', 1)
+            large_buffer.add('foo.py', 2)
+            assert not large_buffer.needs_flush()
+            large_buffer.add('foo.py', 3)
+            assert large_buffer.needs_flush()
+            assert not flush.called
+
+            # the flush waits for the minimum interval, and happens on the
+            # thread of the worker
+            for _ in range(100):
+                if flush.called:
+                    break
+                time.sleep(0.01)
+            assert flush.call_count == 1
+            assert not large_buffer.needs_flush()
+            assert len(agent.stub.Transmit.call_args[0][0].events) == 3
+    finally:
+        worker.stop()
+        worker.thread.join()
+
+
+def test_buffer_should_count_distinct_locations_per_interval():
+    agent = mock.Mock()
+    agent.stream_id = 'dummy'
+    large_buffer = Buffer(agent, 'f', high_water_mark=3)
+    large_buffer.flush_worker = mock.Mock()
+
+    large_buffer.add('foo.py', 1)
+    large_buffer.add('foo.py', 2)
+    large_buffer.flush()
+
+    # the locations count again in the next interval, once per location in
+    # the shard of each thread
+    large_buffer.add('foo.py', 1)
+    large_buffer.add('foo.py', 1)
+    thread = threading.Thread(target=large_buffer.add, args=('foo.py', 1))
+    thread.start()
+    thread.join()
+    assert not large_buffer.needs_flush()
+    large_buffer.add('foo.py', 2)
+    assert large_buffer.needs_flush()
+    large_buffer.flush()
+
+    # the locations of the events taken back from a failed batch do not
+    # count
+    large_buffer.restore(beacon_pb2.Batch(
+        stream_id='dummy', event_type='f', timestamp=1,
+        events=[beacon_pb2.Event(file_path='bar.py', location=line, count=1)
+                for line in range(5)]))
+    assert not large_buffer.needs_flush()
+
+    # the traced threads leave the check of the high-water mark to the
+    # worker
+    assert not large_buffer.flush_worker.request.called
+
+
+def test_histogram_buffer_should_count_distinct_locations():
+    agent = mock.Mock()
+    agent.stream_id = 'dummy'
+    histogram_buffer = HistogramBuffer(agent, 'h', high_water_mark=2)
+
+    loc_id = histogram_buffer.intern('foo.py', 1)
+    histogram_buffer.record(loc_id, 0.000001)
+    histogram_buffer.record(loc_id, 1.0)
+    assert not histogram_buffer.needs_flush()
+    histogram_buffer.record(histogram_buffer.intern('foo.py', 2), 1.0)
+    assert histogram_buffer.needs_flush()
+
+
+def test_histogram_buffer_should_send_bucket_counts():
+    agent = mock.Mock()
+    agent.stream_id = 'dummy'
+    histogram_buffer = HistogramBuffer(agent, 'h', buckets=8)
+    loc_id = histogram_buffer.intern('foo.py', 42)
+
+    # below a microsecond, 3 microseconds, and far beyond the last bucket
+    for duration in (0.0000005, 0.000003, 0.000003, 10):
+        histogram_buffer.record(loc_id, duration)
+    assert histogram_buffer.counter == {('foo.py', 42, 0): 1,
+                                        ('foo.py', 42, 2): 2,
+                                        ('foo.py', 42, 7): 1}
+
+    histogram_buffer.flush()
+    batch = agent.stub.Transmit.call_args[0][0]
+    assert batch.event_type == 3
+    event, = batch.events
+    assert (event.file_path, event.location, event.count) == ('foo.py', 42, 4)
+    assert list(event.buckets) == [1, 0, 2, 0, 0, 0, 0, 1]
+
+    # trailing empty buckets are left out, and restored histograms are
+    # merged with the pending ones
+    histogram_buffer.record(loc_id, 0.0000005)
+    agent.stub.Transmit.side_effect = Exception
+    histogram_buffer.flush()
+    histogram_buffer.restore(batch)
+    agent.stub.Transmit.side_effect = None
+    histogram_buffer.flush()
+    event, = agent.stub.Transmit.call_args[0][0].events
+    assert event.count == 5
+    assert list(event.buckets) == [2, 0, 2, 0, 0, 0, 0, 1]
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys
+import mock
+import pytest
+from beacon.agent import Agent
+from beacon.contrib import RequestSampler
+from beacon.contrib.wsgi import BeaconMiddleware
+from beacon.exceptions import ConfigurationError
+
+DUMMY_DSN = "http://43f62c942790426c8b41220aade4a0d8@domain.com/33"
+
+
+@pytest.fixture
+def agent():
+    with mock.patch('grpc.insecure_channel'), \
+            mock.patch('beacon.beacon_pb2_grpc.BeaconStub'):
+        agent = Agent(dsn=DUMMY_DSN, project_root='dummy', scoped=True)
+    agent.start()
+    yield agent
+    agent.stop()
+
+
+def test_sampler_should_trace_one_in_every_n_requests():
+    sampler = RequestSampler(every=3)
+    assert sampler.is_sampling
+    assert [sampler.should_trace() for _ in range(6)] == [
+        True, False, False, True, False, False]
+
+    assert not RequestSampler().is_sampling
+    assert RequestSampler().should_trace()
+
+
+def test_sampler_should_limit_rate():
+    with mock.patch('beacon.contrib.perf_counter') as perf_counter:
+        perf_counter.return_value = 100.0
+        sampler = RequestSampler(rate=2)
+        assert [sampler.should_trace() for _ in range(3)] == [
+            True, True, False]
+
+        perf_counter.return_value = 100.5
+        assert [sampler.should_trace() for _ in range(2)] == [True, False]
+
+
+def test_sampler_should_validate_arguments():
+    with pytest.raises(ConfigurationError):
+        RequestSampler(every=2, rate=1)
+    with pytest.raises(ConfigurationError):
+        RequestSampler(rate=0)
+
+
+def test_wsgi_middleware_should_trace_sampled_requests(agent):
+    def app(environ, start_response):
+        return [sys.getprofile()]
+
+    middleware = BeaconMiddleware(app, every=2, agent=agent)
+    responses = [middleware({}, None)[0] for _ in range(4)]
+
+    tracer = agent.tracer
+    assert responses == [tracer._scoped_trace, None] * 2
+    assert agent.buffers['function'].sampled
+
+
+def test_middleware_should_not_sample_without_scoped_tracing():
+    with mock.patch('grpc.insecure_channel'), \
+            mock.patch('beacon.beacon_pb2_grpc.BeaconStub'):
+        agent = Agent(dsn=DUMMY_DSN, project_root='dummy')
+    agent.logger = mock.Mock()
+
+    middleware = BeaconMiddleware(lambda environ, start_response: [],
+                                  every=2, agent=agent)
+    for _ in range(4):
+        middleware({}, None)
+
+    # every request is traced, so the counts are exact
+    assert not agent.buffers['function'].sampled
+    assert agent.logger.warning.call_count == 1
+
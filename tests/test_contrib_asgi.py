@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys
+import mock
+import pytest
+from beacon.agent import Agent
+
+DUMMY_DSN = "http://43f62c942790426c8b41220aade4a0d8@domain.com/33"
+
+
+@pytest.fixture
+def agent():
+    with mock.patch('grpc.insecure_channel'), \
+            mock.patch('beacon.beacon_pb2_grpc.BeaconStub'):
+        agent = Agent(dsn=DUMMY_DSN, project_root='dummy', scoped=True)
+    agent.start()
+    yield agent
+    agent.stop()
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason="ASGI tracing needs context variables")
+def test_asgi_middleware_should_trace_sampled_requests(agent):
+    import asyncio
+    from beacon.contrib.asgi import BeaconMiddleware as ASGIMiddleware
+
+    traced = []
+
+    async def app(scope, receive, send):
+        # let the other requests run in between
+        await asyncio.sleep(0)
+        traced.append((scope['path'], agent.tracer._scope_depth.get()))
+
+    middleware = ASGIMiddleware(app, every=2, agent=agent)
+
+    async def serve():
+        await asyncio.gather(*[
+            middleware({'type': 'http', 'path': path}, None, None)
+            for path in ('/a', '/b', '/c')])
+
+    asyncio.run(serve())
+    assert sorted(traced) == [('/a', 1), ('/b', 0), ('/c', 1)]
+    assert sys.getprofile() is None
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import mock
+import pytest
+from beacon import governor
+from beacon.governor import Governor, SAMPLING, TRACING
+
+
+@pytest.fixture
+def agent():
+    mock_agent = mock.Mock()
+    mock_agent.tracer_mode = TRACING
+    mock_agent.tracer.overhead = 0.0
+
+    def set_tracer_mode(mode):
+        mock_agent.tracer_mode = mode
+
+    mock_agent.set_tracer_mode.side_effect = set_tracer_mode
+    return mock_agent
+
+
+def _check(gov, now, cpu_time, overhead):
+    gov.agent.tracer.overhead = overhead
+    with mock.patch('time.time', return_value=now), \
+            mock.patch.object(governor, '_cpu_time', return_value=cpu_time):
+        gov.check()
+
+
+def test_governor_should_stay_within_budget(agent):
+    gov = Governor(agent, 0.02)
+
+    _check(gov, 100, 0, 0)
+    _check(gov, 110, 5, 0.1)
+
+    assert gov.overhead == pytest.approx(0.01)
+    assert gov.load == pytest.approx(0.5)
+    assert not agent.set_tracer_mode.called
+
+
+def test_governor_should_step_down_and_up(agent):
+    gov = Governor(agent, 0.02, cooldown=30)
+
+    _check(gov, 100, 0, 0)
+    _check(gov, 110, 9, 0.5)
+
+    # 5% overhead is over the budget
+    agent.set_tracer_mode.assert_called_once_with(SAMPLING)
+    assert gov.step_down_load == pytest.approx(0.9)
+
+    # the load has dropped, but the cool-down has not passed yet
+    _check(gov, 120, 10, 0.5)
+    assert agent.tracer_mode == SAMPLING
+
+    # the cool-down has passed, but the load is still high
+    _check(gov, 140, 28, 0.5)
+    assert agent.tracer_mode == SAMPLING
+
+    # the load has dropped after the cool-down
+    _check(gov, 150, 29, 0.5)
+    assert agent.tracer_mode == TRACING
+    agent.set_tracer_mode.assert_called_with(TRACING)
+
+
+def test_governor_should_back_off_when_flapping(agent):
+    gov = Governor(agent, 0.02, cooldown=30, max_cooldown=100)
+
+    _check(gov, 0, 0, 0)
+    now, overhead = 0, 0
+    for cooldown in (30, 60, 100, 100):
+        # overhead goes over the budget
+        now += 10
+        overhead += 1
+        _check(gov, now, now, overhead)
+        assert agent.tracer_mode == SAMPLING
+        assert gov.cooldown == cooldown
+
+        # load drops after the cool-down
+        now += cooldown
+        _check(gov, now, now - cooldown, overhead)
+        assert agent.tracer_mode == TRACING
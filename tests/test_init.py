@@ -1,9 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
+import sys
+import grpc
 from mock import patch
+import pytest
 from six import string_types
-from beacon import VERSION, init
+import beacon
+from beacon import VERSION, beacon_pb2, init
 from beacon.agent import Agent
+from beacon.exceptions import ConfigurationError
+from beacon.spool import Spool
 
 
 def test_version():
@@ -32,3 +39,286 @@ def test_init_function_singleton(*_, **__):
     assert id(agent_1) == id(agent_2)
 
     agent_1.stop()
+
+
+@patch('grpc.insecure_channel')
+@patch('beacon.beacon_pb2_grpc.BeaconStub')
+def test_agent_should_flush_exceptions_separately(*_, **__):
+    agent = Agent(dsn=DUMMY_DSN, project_root='dummy')
+    agent.start()
+
+    assert set(agent.timers) == {'function_flush', 'exception_flush'}
+    assert (agent.timers['exception_flush'].interval ==
+            Agent.EXCEPTION_FLUSH_INTERVAL)
+
+    agent.stop()
+
+
+@patch('grpc.insecure_channel')
+@patch('beacon.beacon_pb2_grpc.BeaconStub')
+def test_agent_should_report_which_exceptions_are_counted(*_, **__):
+    agent = Agent(dsn=DUMMY_DSN, project_root='dummy')
+    agent.stream_id = 'dummy'
+    exception_buffer = agent.buffers['exception']
+    expected = ('raised' if agent.exception_tracer.use_monitoring
+                else 'unhandled')
+    assert exception_buffer.capture_mode == expected
+
+    exception_buffer.add('foo.py', 1)
+    exception_buffer.flush()
+    batch = agent.stub.Transmit.call_args[0][0]
+    assert batch.capture_mode == expected
+    assert not agent.buffers['function'].capture_mode
+
+
+@patch('grpc.insecure_channel')
+@patch('beacon.beacon_pb2_grpc.BeaconStub')
+def test_agent_should_switch_tracer_mode(*_, **__):
+    agent = Agent(dsn=DUMMY_DSN, project_root='dummy', overhead_budget=0.02)
+    assert agent.tracer_mode == 'tracing'
+    assert agent.governor is not None
+    assert agent.tracer.measure_overhead
+
+    agent.start()
+    tracer = agent.tracer
+
+    agent.set_tracer_mode('sampling')
+    assert agent.tracer_mode == 'sampling'
+    assert agent.tracer is agent.tracers['sampling']
+    assert tracer.paused
+    assert not agent.tracer.stopped
+
+    agent.set_tracer_mode('tracing')
+    assert agent.tracer is tracer
+    assert not tracer.paused
+    assert agent.tracers['sampling'].paused
+
+    assert [mode for (_, mode) in agent.buffers['function'].mode_changes] == [
+        'sampling', 'tracing']
+
+    agent.stop()
+    assert all(tracer.stopped for tracer in agent.tracers.values())
+
+
+@patch('grpc.insecure_channel')
+@patch('beacon.beacon_pb2_grpc.BeaconStub')
+def test_agent_should_restart_in_forked_child(stub, *_, **__):
+    agent = Agent(dsn=DUMMY_DSN, project_root='dummy')
+    agent.stream_id = 'parent'
+    agent.start()
+    buffer = agent.buffers['function']
+    buffer.add('file.py', 1)
+    buffer.acknowledged_paths = buffer.acknowledged = 1
+    agent.tracer._capture_cache[test_version.__code__] = 0
+    timers = dict(agent.timers)
+    stub.return_value.InitializeStream.return_value = (
+        beacon_pb2.AuthResponse(stream_id='child'))
+
+    # flushing is paused around the fork
+    agent._before_fork()
+    assert buffer.flush_lock.locked()
+    assert buffer.counter_lock.locked()
+
+    # another thread of the parent was pausing the agent
+    agent._pause_lock.acquire()
+
+    agent._after_fork_in_child()
+    assert not buffer.flush_lock.locked()
+    assert not buffer.counter_lock.locked()
+    assert not agent._pause_lock.locked()
+    assert not buffer.counter
+    assert set(agent.timers) == set(timers)
+    assert all(agent.timers[name] is not timers[name] for name in timers)
+    assert stub.call_count == 2
+
+    # the child starts a stream of its own, with new location IDs
+    assert agent.stream_id == 'child'
+    request = stub.return_value.InitializeStream.call_args[0][0]
+    assert request.repository_id == 33
+    assert buffer.locations == []
+    assert buffer.acknowledged == buffer.acknowledged_paths == 0
+    assert test_version.__code__ not in agent.tracer._capture_cache
+
+    agent.stop()
+    for timer in timers.values():
+        timer.stop()
+
+
+@patch('grpc.insecure_channel')
+@patch('beacon.beacon_pb2_grpc.BeaconStub')
+def test_agent_should_resume_flushing_in_parent_after_fork(*_, **__):
+    agent = Agent(dsn=DUMMY_DSN, project_root='dummy')
+    agent.start()
+    buffer = agent.buffers['function']
+    buffer.add('file.py', 1)
+
+    agent._before_fork()
+    agent._after_fork_in_parent()
+    assert not buffer.flush_lock.locked()
+    assert not buffer.counter_lock.locked()
+    assert buffer.counter == {('file.py', 1): 1}
+
+    agent.stop()
+
+    # the fork handlers of a stopped agent do nothing
+    agent._before_fork()
+    assert not buffer.flush_lock.locked()
+
+
+@patch('grpc.insecure_channel')
+@patch('beacon.beacon_pb2_grpc.BeaconStub')
+def test_agent_should_aggregate_on_host(_, __, tmpdir):
+    directory = str(tmpdir.join('beacon'))
+    agent = Agent(dsn=DUMMY_DSN, project_root='dummy',
+                  host_aggregation=directory)
+    aggregator = agent.buffers['function'].aggregator
+    assert aggregator.leader is agent.host_leader
+    assert aggregator.path == os.path.join(directory, 'function.segment')
+
+    agent.start()
+    aggregator.exchange({})
+    assert agent.host_leader.is_leader
+
+    agent.stop()
+    assert not agent.host_leader.is_leader
+
+
+@patch('grpc.insecure_channel')
+@patch('beacon.beacon_pb2_grpc.BeaconStub')
+def test_agent_should_not_aggregate_presence_on_host(_, __, tmpdir):
+    agent = Agent(dsn=DUMMY_DSN, project_root='dummy', presence=True,
+                  host_aggregation=str(tmpdir.join('beacon')))
+    assert agent.buffers['function'].aggregator is None
+    assert agent.buffers['exception'].aggregator is not None
+
+
+@patch('grpc.insecure_channel')
+@patch('beacon.beacon_pb2_grpc.BeaconStub')
+def test_agent_should_drain_spool_on_start(_, __, tmpdir):
+    path = str(tmpdir.join('beacon.spool'))
+    Spool(path).append(beacon_pb2.Batch(
+        event_type='f', events=[beacon_pb2.Event(file_path='foo.py',
+                                                 location=1, count=1)]))
+
+    agent = Agent(dsn=DUMMY_DSN, project_root='dummy', spool_path=path)
+    assert agent.buffers['exception'].spool is agent.spool
+
+    agent.start()
+    agent._spool_thread.join()
+    agent.stop()
+    assert agent.stub.Transmit.called
+    assert not agent.spool.has_records()
+
+
+@patch('grpc.insecure_channel')
+@patch('beacon.beacon_pb2_grpc.BeaconStub')
+def test_agent_should_report_compression_stats(*_, **__):
+    with pytest.raises(ConfigurationError):
+        Agent(dsn=DUMMY_DSN, project_root='dummy', compression='lz4')
+
+    agent = Agent(dsn=DUMMY_DSN, project_root='dummy', compression='gzip',
+                  compression_threshold=0)
+    assert agent.buffers['function'].compression == grpc.Compression.Gzip
+    assert agent.get_stats()['compression_ratio'] is None
+
+    agent.stream_id = 'dummy'
+    for buffer in agent.buffers.values():
+        buffer.add('foo.py', 1)
+        buffer.flush()
+    stats = agent.get_stats()
+    assert stats['messages'] == stats['compressed_messages'] == 2
+    assert stats['events'] == 2
+    assert stats['compression_ratio'] > 0
+
+
+@patch('grpc.insecure_channel')
+@patch('beacon.beacon_pb2_grpc.BeaconStub')
+def test_agent_should_compress_on_the_channel_with_old_grpcio(
+        _, insecure_channel, monkeypatch):
+    # grpcio before 1.23 has no per-call compression
+    monkeypatch.delattr(grpc, 'Compression', raising=False)
+    agent = Agent(dsn=DUMMY_DSN, project_root='dummy', compression='gzip')
+    assert agent.buffers['function'].compression is None
+    assert insecure_channel.call_args[1]['options'] == [
+        ('grpc.default_compression_algorithm', 2)]
+
+
+@patch('grpc.insecure_channel')
+@patch('beacon.beacon_pb2_grpc.BeaconStub')
+def test_agent_should_count_resumes_separately(*_, **__):
+    agent = Agent(dsn=DUMMY_DSN, project_root='dummy', count_resumes=True)
+    assert agent.buffers['resume'].event_type == 'r'
+    assert agent.tracer.resume_buffer is agent.buffers['resume']
+    assert agent.exception_tracer.resume_buffer is None
+
+    agent.start()
+    assert 'resume_flush' in agent.timers
+    agent.stop()
+
+
+@patch('grpc.insecure_channel')
+@patch('beacon.beacon_pb2_grpc.BeaconStub')
+def test_agent_should_record_latency_histograms(*_, **__):
+    agent = Agent(dsn=DUMMY_DSN, project_root='dummy',
+                  latency_histograms=True, histogram_buckets=16)
+    assert agent.buffers['histogram'].event_type == 'h'
+    assert agent.buffers['histogram'].buckets == 16
+    assert agent.tracer.histogram_buffer is agent.buffers['histogram']
+    assert agent.exception_tracer.histogram_buffer is None
+
+    agent.start()
+    assert 'histogram_flush' in agent.timers
+    agent.stop()
+
+    with pytest.raises(ConfigurationError):
+        Agent(dsn=DUMMY_DSN, project_root='dummy', latency_histograms=True,
+              presence=True)
+
+
+@patch('grpc.insecure_channel')
+@patch('beacon.beacon_pb2_grpc.BeaconStub')
+def test_agent_should_pause_until_every_pause_is_resumed(*_, **__):
+    agent = Agent(dsn=DUMMY_DSN, project_root='dummy')
+    agent.pause()
+    agent.start()
+    assert agent.tracer.paused
+    assert agent.exception_tracer.paused
+
+    agent.pause()
+    agent.resume()
+    assert agent.tracer.paused
+
+    agent.resume()
+    assert not agent.tracer.paused
+    assert not agent.exception_tracer.paused
+
+    # an unmatched resume does nothing
+    agent.resume()
+    assert not agent.is_paused
+    agent.stop()
+
+
+@patch('grpc.insecure_channel')
+@patch('beacon.beacon_pb2_grpc.BeaconStub')
+def test_tracing_scopes(*_, **__):
+    agent = Agent(dsn=DUMMY_DSN, project_root='dummy', scoped=True)
+    tracer = agent.tracer
+
+    @beacon.traced
+    def handler():
+        return sys.getprofile()
+
+    # without an agent, the scopes do nothing
+    with patch('beacon.__agent__', None):
+        with beacon.tracing():
+            assert sys.getprofile() is None
+        assert handler() is None
+
+    with patch('beacon.__agent__', agent):
+        agent.start()
+        assert sys.getprofile() is None
+        with beacon.tracing():
+            assert sys.getprofile() == tracer._scoped_trace
+        assert handler() == tracer._scoped_trace
+        assert sys.getprofile() is None
+        agent.stop()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from beacon.paths import PathMatcher
+
+
+def test_path_matcher_should_match_project_root():
+    matcher = PathMatcher(['/app'])
+
+    assert matcher.match('/app/foo.py') == 'foo.py'
+    assert matcher.match('/app/baz/bar.py') == 'baz/bar.py'
+    assert matcher.match('/usr/lib/python3/os.py') is None
+
+    # paths which only share a prefix with the root should not match
+    assert matcher.match('/application/foo.py') is None
+
+
+def test_path_matcher_should_support_several_roots():
+    matcher = PathMatcher(['/app', '/app/lib', '/srv/shared/'])
+
+    # paths are relative to the project root, which is the first one, and
+    # full paths outside of it
+    assert matcher.match('/app/foo.py') == 'foo.py'
+    assert matcher.match('/app/lib/bar.py') == 'lib/bar.py'
+    assert matcher.match('/srv/shared/baz.py') == '/srv/shared/baz.py'
+    assert matcher.match('/srv/other/baz.py') is None
+
+
+def test_path_matcher_should_keep_files_of_several_roots_apart():
+    matcher = PathMatcher(['/srv/app', '/srv/lib'], ['utils/'])
+
+    assert matcher.match('/srv/app/utils.py') == 'utils.py'
+    assert matcher.match('/srv/lib/utils.py') == '/srv/lib/utils.py'
+
+    # exclude paths are still relative to the root that matched
+    assert matcher.match('/srv/lib/utils/foo.py') is None
+
+
+def test_path_matcher_should_honor_exclude_subpaths():
+    matcher = PathMatcher(['/app'], ['tests/', 'app/migrations', 'setup.py'])
+
+    assert matcher.match('/app/tests/test_foo.py') is None
+    assert matcher.match('/app/app/migrations/0001_initial.py') is None
+    assert matcher.match('/app/setup.py') is None
+
+    assert matcher.match('/app/app/models.py') == 'app/models.py'
+    assert matcher.match('/app/testsuite.py') == 'testsuite.py'
+    assert matcher.match('/app/app/tests/foo.py') == 'app/tests/foo.py'
+
+
+def test_path_matcher_should_honor_exclude_globs():
+    matcher = PathMatcher(['/app'], ['**/site-packages', '*_test.py',
+                                     'app/*/vendor', 'lib/**/gen_*.py'])
+
+    assert matcher.match('/app/venv/lib/site-packages/six.py') is None
+    assert matcher.match('/app/site-packages/six.py') is None
+    assert matcher.match('/app/app/models_test.py') is None
+    assert matcher.match('/app/app/api/vendor/requests.py') is None
+    assert matcher.match('/app/lib/gen_pb2.py') is None
+    assert matcher.match('/app/lib/a/b/gen_pb2.py') is None
+
+    assert matcher.match('/app/app/models.py') == 'app/models.py'
+    assert matcher.match('/app/app/vendor/requests.py') == \
+        'app/vendor/requests.py'
+    assert matcher.match('/app/lib/a/pb2.py') == 'lib/a/pb2.py'
+
+
+def test_path_matcher_without_roots_should_match_nothing():
+    matcher = PathMatcher([None])
+
+    assert matcher.match('/app/foo.py') is None
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+from beacon import beacon_pb2
+from beacon.buffer import Buffer
+from beacon.spool import RECORD_HEADER, Spool
+import mock
+import pytest
+
+
+def make_batch(event_type='f', timestamp=1, **counts):
+    return beacon_pb2.Batch(
+        stream_id='dummy', event_type=event_type, timestamp=timestamp,
+        events=[beacon_pb2.Event(file_path=filename, location=1, count=count)
+                for (filename, count) in sorted(counts.items())])
+
+
+def event_counts(batch):
+    return dict((event.file_path, event.count) for event in batch.events)
+
+
+@pytest.fixture
+def spool(tmpdir):
+    return Spool(str(tmpdir.join('beacon.spool')))
+
+
+def test_spool_should_coalesce_batches_on_drain(spool):
+    spool.append(make_batch(timestamp=2, foo=1, bar=2))
+    spool.append(make_batch(timestamp=1, foo=3))
+    spool.append(make_batch(event_type='e', baz=1))
+
+    transmit = mock.Mock()
+    assert spool.drain(transmit) == 2
+
+    function_batch, exception_batch = [call[0][0] for call
+                                       in transmit.call_args_list]
+    assert event_counts(function_batch) == {'foo': 4, 'bar': 2}
+    assert function_batch.timestamp == 1
+    assert event_counts(exception_batch) == {'baz': 1}
+
+    # the spool is empty now
+    assert not spool.has_records()
+    assert spool.drain(transmit) == 0
+
+
+def test_spool_should_bound_the_size_of_merged_batches(tmpdir):
+    batch = make_batch(foo=1, bar=1)
+    spool = Spool(str(tmpdir.join('beacon.spool')),
+                  max_batch_size=2 * batch.ByteSize())
+    for filename in ('a', 'b', 'c', 'd', 'e'):
+        spool.append(make_batch(**{filename: 1, filename + 'x': 1}))
+
+    transmit = mock.Mock()
+    assert spool.drain(transmit) == 3
+    assert [sorted(event_counts(call[0][0]))
+            for call in transmit.call_args_list] == [
+        ['a', 'ax', 'b', 'bx'], ['c', 'cx', 'd', 'dx'], ['e', 'ex']]
+
+
+def test_spool_should_merge_histograms_on_drain(spool):
+    for buckets in ([1, 2], [0, 1, 3]):
+        spool.append(beacon_pb2.Batch(
+            stream_id='dummy', event_type='h', timestamp=1,
+            events=[beacon_pb2.Event(file_path='foo', location=1,
+                                     count=sum(buckets), buckets=buckets)]))
+
+    transmit = mock.Mock()
+    assert spool.drain(transmit) == 1
+    event, = transmit.call_args[0][0].events
+    assert event.count == 7
+    assert list(event.buckets) == [1, 3, 3]
+
+
+def test_spool_should_keep_batches_that_fail(spool):
+    spool.append(make_batch(foo=1))
+    spool.append(make_batch(event_type='e', bar=1))
+
+    assert spool.drain(mock.Mock(side_effect=Exception)) == 0
+
+    transmit = mock.Mock()
+    assert spool.drain(transmit) == 2
+    assert not spool.has_records()
+
+
+def test_spool_should_keep_batches_written_while_draining(spool):
+    spool.append(make_batch(foo=1))
+
+    def transmit(batch):
+        spool.append(make_batch(bar=1))
+
+    assert spool.drain(transmit) == 1
+
+    transmit = mock.Mock()
+    spool.drain(transmit)
+    assert event_counts(transmit.call_args[0][0]) == {'bar': 1}
+
+
+def test_spool_should_enforce_limits(tmpdir):
+    batch = make_batch(foo=1)
+    record_size = RECORD_HEADER.size + batch.ByteSize()
+    spool = Spool(str(tmpdir.join('beacon.spool')),
+                  max_size=2 * record_size, max_age=60)
+
+    assert spool.append(batch)
+    assert spool.append(batch)
+    assert not spool.append(batch)
+
+    # the batches older than the maximum age are dropped
+    with mock.patch('time.time', return_value=os.path.getmtime(spool.path) +
+                    120):
+        transmit = mock.Mock()
+        assert spool.drain(transmit) == 0
+    assert not spool.has_records()
+
+
+def test_spool_should_ignore_a_truncated_record(spool):
+    spool.append(make_batch(foo=1))
+    spool.append(make_batch(bar=1))
+    with open(spool.path, 'r+b') as f:
+        f.truncate(os.path.getsize(spool.path) - 1)
+
+    transmit = mock.Mock()
+    spool.drain(transmit)
+    assert event_counts(transmit.call_args[0][0]) == {'foo': 1}
+
+
+def test_buffer_should_write_failed_batches_to_spool(spool):
+    agent = mock.Mock()
+    agent.stream_id = 'dummy'
+    buffer = Buffer(agent, 'f')
+    buffer.spool = spool
+
+    agent.stub.Transmit.side_effect = Exception
+    buffer.add('foo.py', 42)
+    buffer.flush()
+    assert spool.has_records()
+    assert not buffer.pending.counts
+
+    # the spool is drained once the server can be reached again
+    agent.stub.Transmit.side_effect = None
+    buffer.add('foo.py', 42)
+    buffer.flush()
+    assert agent.drain_spool.called
+
+    transmit = mock.Mock()
+    spool.drain(transmit)
+    assert event_counts(transmit.call_args[0][0]) == {'foo.py': 1}
+
+
+def test_buffer_should_split_batches_written_to_spool(spool):
+    agent = mock.Mock()
+    agent.stream_id = 'dummy'
+    buffer = Buffer(agent, 'f', max_batch_size=100)
+    buffer.spool = spool
+
+    agent.stub.Transmit.side_effect = Exception
+    for index in range(20):
+        buffer.add('module{}.py'.format(index), 42)
+    buffer.flush()
+
+    with open(spool.path, 'rb') as f:
+        records = Spool._read(f.fileno(), os.path.getsize(spool.path))
+    assert len(records) > 1
+    for written_at, data in records:
+        assert len(data) <= 100
+
+
+def test_buffer_should_split_batches_drained_from_spool(spool):
+    agent = mock.Mock()
+    agent.stream_id = 'dummy'
+    buffer = Buffer(agent, 'f', max_batch_size=100)
+    buffer.spool = spool
+
+    batch = make_batch(**dict(('module{}.py'.format(index), 1)
+                              for index in range(20)))
+    agent.stub.Transmit.side_effect = [None, Exception] + [None] * 20
+    buffer.transmit_spooled(batch)
+
+    # the batches after the one that failed are written back to the spool
+    sent = agent.stub.Transmit.call_args_list
+    assert len(sent) == 2
+    for call in sent:
+        assert call[0][0].ByteSize() <= 100
+    assert buffer.stats['events'] == len(sent[0][0][0].events)
+
+    transmit = mock.Mock()
+    spool.drain(transmit)
+    drained = sum(len(call[0][0].events) for call in transmit.call_args_list)
+    assert drained == 20 - len(sent[0][0][0].events)
+
+
+def test_presence_buffer_should_keep_failed_batches_pending(spool):
+    agent = mock.Mock()
+    agent.stream_id = 'dummy'
+    buffer = Buffer(agent, 'f', presence=True)
+    buffer.spool = spool
+
+    agent.stub.Transmit.side_effect = Exception
+    for _ in range(1000):
+        buffer.add('foo.py', 42)
+    buffer.flush()
+
+    # presence batches are not spooled as counts of one
+    assert not spool.has_records()
+    assert buffer.pending.counts == {0: 1}
+
+
+def test_buffer_should_not_acknowledge_spooled_batches(spool):
+    agent = mock.Mock()
+    agent.stream_id = 'dummy'
+    buffer = Buffer(agent, 'f', presence=True)
+    buffer.spool = spool
+
+    # a presence batch spooled by another process, with its locations
+    batch = beacon_pb2.Batch(stream_id='other', event_type='f',
+                             presence=True, seen=b'\x1f',
+                             locations=[beacon_pb2.Event(file_path='foo.py',
+                                                         location=line)
+                                        for line in range(5)])
+    buffer.transmit_spooled(batch)
+    assert agent.stub.Transmit.called
+    assert buffer.acknowledged == 0
+    assert buffer.stats['messages'] == 1
@@ -1,9 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import json
+import os
 import sys
+import threading
+import time
 import mock
 import pytest
-from beacon.tracer import Tracer
+from beacon.exceptions import ConfigurationError
+from beacon.tracer import (ExceptionTracer, MonitoringTracer, SamplingTracer,
+                           Tracer, get_tracer)
 
 
 @pytest.fixture
@@ -33,11 +39,542 @@ def test_trace_function_behavior(tracer):
     # create a dummy frame first, with filename under the project path
     mocked_frame = mock.Mock(spec=sys._getframe(1))
     mocked_frame.f_code.co_filename = '/dummy/root/foo.py'
+    mocked_frame.f_code.co_firstlineno = 42
+    mocked_frame.f_code.co_flags = 0
     mocked_frame.f_lineno = 42
 
     tracer.start()
     # pass it to the trace function, and assert it has been captured
     tracer._trace(mocked_frame, 'call', None)
 
-    # the add method should have been called on the buffer
-    assert tracer.buffer.add.called
+    # the location should have been interned, and counted in the buffer
+    tracer.buffer.intern.assert_called_once_with('foo.py', 42)
+    tracer.buffer.increment.assert_called_once_with(
+        tracer.buffer.intern.return_value)
+
+
+def test_trace_function_should_cache_capture_decision(tracer):
+    mocked_frame = mock.Mock(spec=sys._getframe(1))
+    mocked_frame.f_code.co_filename = '/dummy/root/foo.py'
+    mocked_frame.f_code.co_firstlineno = 42
+    mocked_frame.f_code.co_flags = 0
+    mocked_frame.f_lineno = 42
+
+    # mark the tracer as running, without installing it as the profiler
+    tracer.stopped = False
+    with mock.patch.object(tracer, '_should_capture',
+                           wraps=tracer._should_capture) as should_capture:
+        tracer._trace(mocked_frame, 'call', None)
+        tracer._trace(mocked_frame, 'call', None)
+        tracer._trace(mocked_frame, 'call', None)
+
+    # the path matcher should only have been consulted once
+    assert should_capture.call_count == 1
+    assert tracer.buffer.intern.call_count == 1
+    assert tracer.buffer.increment.call_count == 3
+
+    info = tracer.cache_info()
+    assert info.hits == 2
+    assert info.misses == 1
+    assert info.currsize == 1
+
+
+def test_capture_cache_should_be_bounded():
+    tracer = Tracer(buffer=mock.Mock(), project_root='/dummy/root',
+                    capture_cache_size=2)
+
+    tracer.stopped = False
+    for index in range(5):
+        mocked_frame = mock.Mock(spec=sys._getframe(1))
+        mocked_frame.f_code.co_filename = '/other/{}.py'.format(index)
+        tracer._trace(mocked_frame, 'call', None)
+
+    assert tracer.cache_info().currsize <= 2
+    assert tracer.cache_info().misses == 5
+    assert not tracer.buffer.increment.called
+
+
+def _project_function():
+    return 42
+
+
+def _project_generator():
+    yield 1
+    yield 2
+
+
+requires_monitoring = pytest.mark.skipif(
+    not hasattr(sys, 'monitoring'),
+    reason="sys.monitoring is only available on Python 3.12+")
+
+
+@requires_monitoring
+def test_monitoring_tracer_captures_project_code():
+    buffer = mock.Mock()
+    project_root = os.path.dirname(os.path.abspath(__file__))
+    tracer = MonitoringTracer(buffer=buffer, project_root=project_root)
+
+    tracer.start()
+    try:
+        _project_function()
+    finally:
+        tracer.stop()
+
+    code = _project_function.__code__
+    buffer.intern.assert_any_call('test_tracer.py', code.co_firstlineno)
+    assert buffer.increment.called
+    assert sys.monitoring.get_tool(tracer.tool_id) is None
+
+
+@requires_monitoring
+def test_monitoring_tracer_disables_code_outside_project():
+    tracer = MonitoringTracer(buffer=mock.Mock(), project_root='/dummy/root')
+
+    result = tracer._on_py_start(os.path.join.__code__, 0)
+
+    assert result is sys.monitoring.DISABLE
+    assert not tracer.buffer.increment.called
+
+
+def test_get_tracer_should_pick_backend():
+    buffer = mock.Mock()
+
+    tracer = get_tracer(buffer=buffer, project_root='/dummy/root',
+                        tracer_backend='setprofile')
+    assert type(tracer) is Tracer
+
+    tracer = get_tracer(buffer=buffer, project_root='/dummy/root')
+    if hasattr(sys, 'monitoring'):
+        assert isinstance(tracer, MonitoringTracer)
+    else:
+        assert type(tracer) is Tracer
+
+    tracer = get_tracer(buffer=buffer, project_root='/dummy/root',
+                        tracer_backend='sampling')
+    assert isinstance(tracer, SamplingTracer)
+
+    with pytest.raises(ConfigurationError):
+        get_tracer(buffer=buffer, project_root='/dummy/root',
+                   tracer_backend='foo')
+
+
+def test_sampling_tracer_attributes_samples_to_project_code():
+    buffer = mock.Mock()
+    project_root = os.path.dirname(os.path.abspath(__file__))
+    tracer = SamplingTracer(buffer=buffer, project_root=project_root,
+                            sample_interval=0.001)
+
+    tracer.start()
+    assert buffer.sampled is True
+
+    # keep this thread busy inside the project, so that it gets sampled
+    deadline = time.time() + 0.2
+    while time.time() < deadline:
+        _project_function()
+
+    tracer.stop()
+    assert buffer.sampled is False
+    assert tracer.sampler is None
+
+    assert buffer.add.called
+    for call in buffer.add.call_args_list:
+        filename, _ = call[0]
+        assert filename == 'test_tracer.py'
+
+
+def test_tracer_should_trace_new_threads(tracer):
+    profilers = []
+
+    def target():
+        profilers.append(sys.getprofile())
+
+    tracer.start()
+    try:
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+    finally:
+        tracer.stop()
+
+    assert profilers == [tracer._trace]
+
+    # threads started after the tracer has stopped should not be traced
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    assert profilers[-1] is None
+
+
+def test_tracer_should_not_capture_excluded_paths():
+    tracer = Tracer(buffer=mock.Mock(), project_root='/dummy/root',
+                    exclude_paths=['tests/'])
+
+    assert tracer._should_capture('/dummy/root/foo.py')
+    assert not tracer._should_capture('/dummy/root/tests/test_foo.py')
+    assert not tracer._should_capture('/other/root/foo.py')
+
+
+def _raise_in_project():
+    raise ValueError('foo')
+
+
+def _raise_site():
+    return _raise_in_project.__code__.co_firstlineno + 1
+
+
+@requires_monitoring
+def test_exception_tracer_counts_project_exceptions():
+    buffer = mock.Mock()
+    project_root = os.path.dirname(os.path.abspath(__file__))
+    tracer = ExceptionTracer(buffer=buffer, project_root=project_root)
+    assert tracer.use_monitoring
+
+    tracer.start()
+    try:
+        for _ in range(3):
+            try:
+                _raise_in_project()
+            except ValueError:
+                pass
+    finally:
+        tracer.stop()
+
+    buffer.intern.assert_called_once_with('test_tracer.py', _raise_site())
+    assert buffer.increment.call_args_list.count(
+        mock.call(buffer.intern.return_value)) == 3
+    assert sys.monitoring.get_tool(tracer.tool_id) is None
+
+
+def test_exception_tracer_excepthook_fallback():
+    buffer = mock.Mock()
+    project_root = os.path.dirname(os.path.abspath(__file__))
+    tracer = ExceptionTracer(buffer=buffer, project_root=project_root)
+    tracer.use_monitoring = False
+
+    original_excepthook = sys.excepthook
+    tracer.start()
+    assert sys.excepthook == tracer._excepthook
+
+    try:
+        _raise_in_project()
+    except ValueError:
+        exc_info = sys.exc_info()
+
+    with mock.patch.object(tracer, '_original_excepthook') as excepthook:
+        sys.excepthook(*exc_info)
+        excepthook.assert_called_once_with(*exc_info)
+
+    tracer.stop()
+    assert sys.excepthook == original_excepthook
+
+    buffer.add.assert_called_once_with('test_tracer.py', _raise_site())
+
+
+@pytest.mark.parametrize('use_monitoring', [
+    False,
+    pytest.param(True, marks=requires_monitoring),
+])
+def test_exception_tracer_ignores_exceptions_raised_in_libraries(
+        use_monitoring):
+    buffer = mock.Mock()
+    project_root = os.path.dirname(os.path.abspath(__file__))
+    tracer = ExceptionTracer(buffer=buffer, project_root=project_root)
+    tracer.use_monitoring = use_monitoring
+
+    tracer.start()
+    try:
+        # raised in the `json` module, and propagated through this frame
+        json.loads('{')
+    except ValueError:
+        exc_info = sys.exc_info()
+    finally:
+        if not use_monitoring:
+            with mock.patch.object(tracer, '_original_excepthook'):
+                sys.excepthook(*exc_info)
+        tracer.stop()
+
+    assert not buffer.add.called
+    assert not buffer.increment.called
+
+
+def test_tracer_should_not_capture_while_paused(tracer):
+    mocked_frame = mock.Mock(spec=sys._getframe(1))
+    mocked_frame.f_code.co_filename = '/dummy/root/foo.py'
+    mocked_frame.f_code.co_firstlineno = 42
+    mocked_frame.f_code.co_flags = 0
+    mocked_frame.f_lineno = 42
+
+    tracer.start()
+    tracer.pause()
+    tracer._trace(mocked_frame, 'call', None)
+    assert not tracer.buffer.increment.called
+
+    tracer.resume()
+    tracer._trace(mocked_frame, 'call', None)
+    tracer.stop()
+    assert tracer.buffer.increment.called
+
+
+def test_tracer_should_not_measure_itself_while_paused():
+    tracer = Tracer(buffer=mock.Mock(), project_root='/dummy/root',
+                    measure_overhead=True)
+    mocked_frame = mock.Mock(spec=sys._getframe(1))
+    mocked_frame.f_code.co_filename = '/dummy/root/foo.py'
+
+    tracer.start()
+    try:
+        tracer.pause()
+        overhead = tracer.overhead
+        tracer._timed_trace(mocked_frame, 'call', None)
+        assert tracer.overhead == overhead
+        assert not tracer.buffer.increment.called
+    finally:
+        tracer.stop()
+
+
+def test_tracer_should_trace_threads_started_while_paused():
+    buffer = mock.Mock()
+    project_root = os.path.dirname(os.path.abspath(__file__))
+    tracer = Tracer(buffer=buffer, project_root=project_root)
+    started = threading.Event()
+    resumed = threading.Event()
+
+    def target():
+        started.set()
+        resumed.wait(5)
+        _project_function()
+
+    tracer.start()
+    try:
+        # the governor pauses and resumes the tracer from its own thread
+        pausing = threading.Thread(target=tracer.pause)
+        pausing.start()
+        pausing.join()
+
+        thread = threading.Thread(target=target)
+        thread.start()
+        assert started.wait(5)
+
+        resuming = threading.Thread(target=tracer.resume)
+        resuming.start()
+        resuming.join()
+        resumed.set()
+        thread.join()
+    finally:
+        tracer.stop()
+
+    lines = [call[0][1] for call in buffer.intern.call_args_list]
+    assert _project_function.__code__.co_firstlineno in lines
+
+
+def test_tracer_should_measure_overhead():
+    tracer = Tracer(buffer=mock.Mock(), project_root='/dummy/root',
+                    measure_overhead=True)
+
+    tracer.start()
+    assert sys.getprofile() == tracer._timed_trace
+    _project_function()
+    tracer.stop()
+
+    assert sys.getprofile() is None
+    assert tracer.overhead > 0
+
+
+def test_tracer_should_compute_relative_paths_once(tracer):
+    with mock.patch.object(tracer.path_matcher, 'match',
+                           wraps=tracer.path_matcher.match) as match:
+        path = tracer._relative_path('/dummy/root/baz/bar.py')
+        assert path == 'baz/bar.py'
+        assert tracer._relative_path('/dummy/root/baz/bar.py') is path
+        assert tracer._relative_path('/other/root/foo.py') is None
+        assert tracer._relative_path('/other/root/foo.py') is None
+
+    assert match.call_count == 2
+
+
+def test_tracer_should_keep_files_of_several_roots_apart():
+    tracer = Tracer(buffer=mock.Mock(), project_root='/srv/app',
+                    include_paths=['/srv/lib'])
+
+    assert tracer._relative_path('/srv/app/utils.py') == 'utils.py'
+    assert tracer._relative_path('/srv/lib/utils.py') == '/srv/lib/utils.py'
+
+
+def test_tracer_should_count_generators_once_per_invocation():
+    buffer = mock.Mock()
+    project_root = os.path.dirname(os.path.abspath(__file__))
+    tracer = Tracer(buffer=buffer, project_root=project_root)
+
+    tracer.start()
+    list(_project_generator())
+    tracer.stop()
+
+    code = _project_generator.__code__
+    loc_id = buffer.intern.return_value
+    buffer.intern.assert_called_once_with('test_tracer.py',
+                                          code.co_firstlineno)
+    assert buffer.increment.call_args_list == [mock.call(loc_id)]
+
+
+@pytest.mark.parametrize('backend', [
+    'setprofile',
+    pytest.param('monitoring', marks=requires_monitoring),
+])
+def test_tracer_should_count_resumes_separately(backend):
+    buffer, resume_buffer = mock.Mock(), mock.Mock()
+    project_root = os.path.dirname(os.path.abspath(__file__))
+    tracer = get_tracer(buffer=buffer, resume_buffer=resume_buffer,
+                        project_root=project_root, tracer_backend=backend)
+
+    tracer.start()
+    list(_project_generator())
+    tracer.stop()
+
+    code = _project_generator.__code__
+    resume_buffer.intern.assert_called_once_with('test_tracer.py',
+                                                 code.co_firstlineno)
+    assert buffer.increment.call_count == 1
+    # the generator is resumed after each of its two yields
+    assert resume_buffer.increment.call_args_list == [
+        mock.call(resume_buffer.intern.return_value)] * 2
+
+
+@pytest.mark.parametrize('backend', [
+    'setprofile',
+    pytest.param('monitoring', marks=requires_monitoring),
+])
+def test_tracer_should_skip_seen_code_in_presence_mode(backend):
+    buffer = mock.Mock()
+    buffer.flush_callbacks = []
+    project_root = os.path.dirname(os.path.abspath(__file__))
+    tracer = get_tracer(buffer=buffer, presence=True,
+                        project_root=project_root, tracer_backend=backend)
+    assert buffer.flush_callbacks == [tracer.rearm]
+
+    tracer.start()
+    try:
+        _project_function()
+        _project_function()
+        assert buffer.increment.call_count == 1
+
+        # the code is captured again once the buffer has been flushed
+        tracer.rearm()
+        _project_function()
+        _project_function()
+    finally:
+        tracer.stop()
+
+    assert buffer.increment.call_count == 2
+
+
+@requires_monitoring
+def test_monitoring_tracer_should_not_rearm_other_tools():
+    buffer = mock.Mock()
+    buffer.flush_callbacks = []
+    project_root = os.path.dirname(os.path.abspath(__file__))
+    tracer = MonitoringTracer(buffer=buffer, presence=True,
+                              project_root=project_root)
+
+    tracer.start()
+    sys.monitoring.use_tool_id(5, 'coverage')
+    try:
+        with mock.patch('sys.monitoring.restart_events') as restart_events:
+            # the events disabled by the other tool stay disabled
+            tracer.rearm()
+            assert not restart_events.called
+
+            sys.monitoring.free_tool_id(5)
+            tracer.rearm()
+            assert restart_events.called
+    finally:
+        if sys.monitoring.get_tool(5) is not None:
+            sys.monitoring.free_tool_id(5)
+        tracer.stop()
+
+
+def _project_failure():
+    raise ValueError
+
+
+@pytest.mark.parametrize('backend', [
+    'setprofile',
+    pytest.param('monitoring', marks=requires_monitoring),
+])
+def test_tracer_should_record_call_durations(backend):
+    buffer, histogram_buffer = mock.Mock(), mock.Mock()
+    project_root = os.path.dirname(os.path.abspath(__file__))
+    tracer = get_tracer(buffer=buffer, histogram_buffer=histogram_buffer,
+                        project_root=project_root, tracer_backend=backend)
+
+    tracer.start()
+    try:
+        _project_function()
+        with pytest.raises(ValueError):
+            _project_failure()
+        list(_project_generator())
+    finally:
+        tracer.stop()
+
+    # generators are not timed
+    assert histogram_buffer.intern.call_args_list == [
+        mock.call('test_tracer.py', _project_function.__code__.co_firstlineno),
+        mock.call('test_tracer.py', _project_failure.__code__.co_firstlineno),
+    ]
+    assert histogram_buffer.record.call_count == 2
+    for call in histogram_buffer.record.call_args_list:
+        hist_id, duration = call[0]
+        assert hist_id is histogram_buffer.intern.return_value
+        assert 0 <= duration < 1
+
+
+def test_tracer_should_forget_calls_not_seen_to_return(tracer):
+    tracer.histogram_buffer = mock.Mock()
+    outer, inner = object(), object()
+    tracer._enter(outer, 1)
+    tracer._enter(inner, 2)
+
+    # the inner call returned while the tracer was paused
+    tracer._exit(outer)
+    assert tracer.histogram_buffer.record.call_args[0][0] == 1
+    assert tracer._calls.stack == []
+
+    tracer._exit(outer)
+    assert tracer.histogram_buffer.record.call_count == 1
+
+
+def test_scoped_tracer_should_only_trace_inside_scopes():
+    buffer = mock.Mock()
+    project_root = os.path.dirname(os.path.abspath(__file__))
+    tracer = get_tracer(buffer=buffer, project_root=project_root,
+                        scoped=True)
+    assert type(tracer) is Tracer
+
+    tracer.start()
+    try:
+        _project_function()
+        assert sys.getprofile() is None
+
+        outer = tracer.enter_scope()
+        inner = tracer.enter_scope()
+        assert sys.getprofile() == tracer._scoped_trace
+        tracer.exit_scope(inner)
+        _project_function()
+
+        # other threads are not traced
+        thread = threading.Thread(target=_project_function)
+        thread.start()
+        thread.join()
+        tracer.exit_scope(outer)
+        assert sys.getprofile() is None
+
+        _project_function()
+    finally:
+        tracer.stop()
+
+    assert buffer.increment.call_count == 1
+
+
+def test_scoped_tracer_should_need_setprofile():
+    with pytest.raises(ConfigurationError):
+        get_tracer(buffer=mock.Mock(), project_root='/dummy/root',
+                   scoped=True, tracer_backend='sampling')
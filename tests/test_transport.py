@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+from concurrent import futures
+import grpc
+from beacon import beacon_pb2, beacon_pb2_grpc as pb2_grpc
+from beacon import transport as transport_module
+from beacon.buffer import Buffer
+from beacon.exceptions import CircuitOpenError
+from beacon.transport import CircuitBreaker, RetryPolicy, Transport
+import mock
+import pytest
+
+
+class Unavailable(grpc.RpcError):
+    def code(self):
+        return grpc.StatusCode.UNAVAILABLE
+
+
+class MessageTooLarge(grpc.RpcError):
+    def code(self):
+        return grpc.StatusCode.RESOURCE_EXHAUSTED
+
+    def details(self):
+        return 'Sent message larger than max (5000000 vs. 4194304)'
+
+
+@pytest.fixture
+def transport():
+    transport = Transport(timeout=5, max_in_flight=2)
+    yield transport
+    transport.stop()
+    if transport.thread is not None:
+        transport.thread.join()
+
+
+@pytest.fixture
+def transport_buffer(transport):
+    agent = mock.Mock()
+    agent.stream_id = 'dummy'
+    new_buffer = Buffer(agent, 'f')
+    new_buffer.transport = transport
+    return new_buffer
+
+
+def test_flush_should_queue_events_for_the_sender(transport,
+                                                  transport_buffer):
+    agent = transport_buffer.agent
+    transport_buffer.add('foo.py', 1)
+    transport_buffer.flush()
+    assert not agent.stub.Transmit.called
+    assert transport.get_stats()['queue_depth'] == 1
+
+    # the events flushed while the buffer waits are added to the queued ones
+    transport_buffer.add('foo.py', 1)
+    transport_buffer.add('bar.py', 2)
+    transport_buffer.flush()
+    assert transport.get_stats() == {'queue_depth': 1,
+                                     'circuit': 'closed',
+                                     'send_latency_mean': None,
+                                     'send_latency_max': None}
+
+    sent = threading.Event()
+    agent.stub.Transmit.side_effect = lambda *args, **kwargs: sent.set()
+    transport.start()
+    assert sent.wait(5)
+    transport.stop()
+    transport.thread.join()
+
+    assert agent.stub.Transmit.call_count == 1
+    batch = agent.stub.Transmit.call_args[0][0]
+    assert sorted((event.file_path, event.count)
+                  for event in batch.events) == [('bar.py', 1), ('foo.py', 2)]
+    # every RPC has a deadline
+    assert agent.stub.Transmit.call_args[1] == {'timeout': 5}
+
+    stats = transport.get_stats()
+    assert stats['queue_depth'] == 0
+    assert stats['send_latency_max'] >= stats['send_latency_mean'] >= 0
+
+
+def test_sender_should_cap_chunks_in_flight(transport_buffer):
+    agent = transport_buffer.agent
+    for location in range(10):
+        transport_buffer.add('foo.py', location)
+    transport_buffer.max_batch_size = 40
+
+    in_flight = []
+    peak = []
+
+    def start(batch, **options):
+        in_flight.append(batch)
+        peak.append(len(in_flight))
+        future = mock.Mock()
+        future.result.side_effect = lambda: in_flight.remove(batch)
+        return future
+
+    agent.stub.Transmit.future.side_effect = start
+    transport_buffer.flush()
+    transport_buffer.send()
+
+    assert agent.stub.Transmit.future.call_count > 2
+    assert max(peak) == 2
+    assert transport_buffer.stats['events'] == 10
+
+
+def test_retry_policy_should_back_off_with_jitter():
+    policy = RetryPolicy(base_delay=1, max_delay=5, jitter=0.5)
+    with mock.patch('random.random', return_value=0):
+        assert [policy.delay(retry) for retry in range(1, 5)] == [1, 2, 4, 5]
+    with mock.patch('random.random', return_value=1):
+        assert policy.delay(2) == 1
+
+    assert policy.is_retryable(Unavailable())
+    assert not policy.is_retryable(ValueError())
+
+
+def test_transport_should_retry_transient_errors():
+    transport = Transport(retry=RetryPolicy(attempts=3, base_delay=0.001))
+    method = mock.Mock(side_effect=[Unavailable(), 'response'])
+    assert transport.call(method, 'batch') == 'response'
+    assert method.call_count == 2
+
+    method = mock.Mock(side_effect=ValueError)
+    with pytest.raises(ValueError):
+        transport.call(method, 'batch')
+    assert method.call_count == 1
+
+    method = mock.Mock(side_effect=Unavailable())
+    with pytest.raises(Unavailable):
+        transport.call(method, 'batch')
+    assert method.call_count == 3
+
+
+def test_transport_should_not_retry_messages_too_large():
+    transport = Transport(retry=RetryPolicy(attempts=3, base_delay=0.001),
+                          breaker=CircuitBreaker(failure_threshold=1))
+    method = mock.Mock(side_effect=MessageTooLarge())
+    with pytest.raises(MessageTooLarge):
+        transport.call(method, 'batch')
+    assert method.call_count == 1
+    assert transport.breaker.state == 'closed'
+
+
+def test_transport_should_cap_calls_in_flight_across_threads():
+    transport = Transport(max_in_flight=1)
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_call(batch, **options):
+        started.set()
+        release.wait(5)
+
+    thread = threading.Thread(target=transport.call,
+                              args=(slow_call, 'batch'))
+    thread.start()
+    assert started.wait(5)
+
+    # the chunks of the sender thread wait for the spooled batch
+    method = mock.Mock()
+    pending = threading.Thread(target=transport.call_future,
+                               args=(method, 'chunk'))
+    pending.start()
+    pending.join(0.1)
+    assert not method.future.called
+
+    release.set()
+    thread.join()
+    pending.join()
+    assert method.future.called
+
+
+def test_circuit_breaker_should_fail_fast_and_probe():
+    clock = [0]
+    breaker = CircuitBreaker(failure_threshold=2, backoff=RetryPolicy(
+        base_delay=10, max_delay=100, jitter=0))
+    transport = Transport(retry=RetryPolicy(attempts=1), breaker=breaker)
+    failing = mock.Mock(side_effect=Unavailable())
+
+    with mock.patch.object(transport_module, 'perf_counter',
+                           lambda: clock[0]):
+        for _ in range(2):
+            with pytest.raises(Unavailable):
+                transport.call(failing, 'batch')
+        assert breaker.state == 'open'
+
+        # the server is not called while the breaker is open
+        with pytest.raises(CircuitOpenError):
+            transport.call(failing, 'batch')
+        assert failing.call_count == 2
+
+        # a failed probe opens the breaker for twice as long
+        clock[0] = 10
+        with pytest.raises(Unavailable):
+            transport.call(failing, 'batch')
+        assert breaker.state == 'open'
+        clock[0] = 29
+        with pytest.raises(CircuitOpenError):
+            transport.call(failing, 'batch')
+
+        # a successful probe closes it
+        clock[0] = 30
+        assert transport.call(mock.Mock(return_value='ok'), 'batch') == 'ok'
+        assert breaker.state == 'closed'
+
+
+def test_buffer_should_keep_events_while_circuit_is_open(transport_buffer):
+    agent = transport_buffer.agent
+    transport_buffer.transport.breaker.state = 'open'
+    transport_buffer.transport.breaker.retry_at = float('inf')
+
+    transport_buffer.add('foo.py', 1)
+    transport_buffer.flush()
+    transport_buffer.send()
+    assert not agent.stub.Transmit.called
+    assert not agent.logger.error.called
+    assert transport_buffer.pending.counts == {0: 1}
+
+
+class Servicer(pb2_grpc.BeaconServicer):
+    def __init__(self):
+        self.batches = []
+        self.streams = 0
+
+    def Transmit(self, request, context):
+        self.batches.append(request)
+        return beacon_pb2.Empty()
+
+    def TransmitStream(self, request_iterator, context):
+        self.streams += 1
+        for request in request_iterator:
+            self.batches.append(request)
+        return beacon_pb2.Empty()
+
+
+def serve(servicer):
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=2))
+    pb2_grpc.add_BeaconServicer_to_server(servicer, server)
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+    channel = grpc.insecure_channel('127.0.0.1:{}'.format(port))
+    return server, pb2_grpc.BeaconStub(channel)
+
+
+def make_streaming_buffer(stub):
+    agent = mock.Mock()
+    agent.stream_id = 'dummy'
+    agent.stub = stub
+    streaming_buffer = Buffer(agent, 'f')
+    streaming_buffer.transport = Transport(streaming=True)
+    return streaming_buffer
+
+
+def flush(streaming_buffer, filename):
+    streaming_buffer.add(filename, 1)
+    streaming_buffer.flush()
+    streaming_buffer.send()
+
+
+def test_transport_should_stream_batches():
+    servicer = Servicer()
+    server, stub = serve(servicer)
+    try:
+        streaming_buffer = make_streaming_buffer(stub)
+        flush(streaming_buffer, 'foo.py')
+        flush(streaming_buffer, 'bar.py')
+        # the batches are counted once the server confirms them
+        assert streaming_buffer.stats['events'] == 0
+        streaming_buffer.transport.close_stream()
+        assert streaming_buffer.stats['events'] == 2
+
+        assert servicer.streams == 1
+        assert [batch.events[0].file_path
+                for batch in servicer.batches] == ['foo.py', 'bar.py']
+        assert not streaming_buffer.pending.counts
+    finally:
+        server.stop(None)
+
+
+def test_transport_should_fall_back_to_unary_calls():
+    servicer = Servicer()
+    # a server which does not implement streams
+    servicer.TransmitStream = pb2_grpc.BeaconServicer.TransmitStream.__get__(
+        servicer)
+    server, stub = serve(servicer)
+    try:
+        streaming_buffer = make_streaming_buffer(stub)
+        transport = streaming_buffer.transport
+        flush(streaming_buffer, 'foo.py')
+        assert transport.stream is not None
+
+        # the stream failed; its batch is transmitted again, and so is the
+        # next one, without a stream
+        transport.stream.future.exception()
+        flush(streaming_buffer, 'bar.py')
+        assert not transport.streaming
+        assert transport.stream is None
+        assert [batch.events[0].file_path
+                for batch in servicer.batches] == ['foo.py', 'bar.py']
+    finally:
+        server.stop(None)
+
+
+def test_buffer_should_restore_batches_of_failed_streams(transport_buffer):
+    transport_buffer.add('foo.py', 1)
+    transport_buffer.flush()
+    transport_buffer.send()
+    batch = transport_buffer.agent.stub.Transmit.call_args[0][0]
+
+    transport_buffer.add('bar.py', 2)
+    transport_buffer.restore(batch)
+    transport_buffer.restore(batch)
+    assert transport_buffer.pending.counts == {0: 2}
+
+
+def test_buffer_should_keep_batches_of_streams_failed_while_sending():
+    agent = mock.Mock()
+    agent.stream_id = 'dummy'
+    streaming_buffer = Buffer(agent, 'f')
+    transport = streaming_buffer.transport = Transport(
+        streaming=True, retry=RetryPolicy(attempts=1))
+
+    failed_stream = mock.Mock()
+    failed_stream.done.return_value = True
+    failed_stream.result.side_effect = Unavailable()
+    agent.stub.TransmitStream.future.side_effect = [failed_stream,
+                                                    mock.Mock()]
+    agent.stub.Transmit.side_effect = Unavailable()
+
+    flush(streaming_buffer, 'foo.py')
+    # the stream failed, and its batch can not be transmitted again; it is
+    # handed back to the buffer once it is done sending the next one
+    flush(streaming_buffer, 'bar.py')
+    transport._restore_failed()
+
+    loc_id = streaming_buffer.location_ids[('foo.py', 1)]
+    assert streaming_buffer.pending.counts == {loc_id: 1}
+    assert streaming_buffer.stats['events'] == 0
+
+
+def test_stream_should_be_cancelled_on_timeout():
+    stub = mock.Mock()
+    stub.TransmitStream.future.return_value.result.side_effect = (
+        grpc.FutureTimeoutError())
+    stream = transport_module.BatchStream(stub)
+    with pytest.raises(grpc.FutureTimeoutError):
+        stream.close(timeout=1)
+    assert stream.future.cancel.called